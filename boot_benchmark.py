@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Run ec2autorun.py end to end off-cloud, against a local stand-in for the EC2
+instance metadata service and a local S3-compatible stub, and report boot
+latency distributions (see boot_stats.py).
+
+Both services can be slowed down and made to fail with 503 responses, e.g.:
+
+    boot_benchmark.py -n 50 --metadata-latency 0.2 --s3-failure-rate 0.1
+
+Each run is a fresh ec2autorun.py process in sandbox mode (CM_SANDBOX), so
+nothing on the local system is modified; everything it writes goes into a
+temporary directory. The boot script cache is shared between runs unless
+--cold is given, as it is across reboots of an instance.
+"""
+import os, sys, time, json, random, shutil, hashlib, tempfile, threading, subprocess
+from optparse import OptionParser
+from urlparse import urlparse
+from email.utils import formatdate
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import boot_stats
+
+CLUSTER_BUCKET = 'cm-bench'
+DEFAULT_BUCKET = 'cloudman'
+BOOT_SCRIPT_NAME = 'cm_boot.py'
+# Stands in for CloudMan's boot script: marks a couple of phases and takes --script-time seconds
+BOOT_SCRIPT = """#!/bin/sh
+echo BOOT_PHASE setup
+sleep %(half)s
+echo BOOT_PHASE start_cloudman
+sleep %(half)s
+echo done
+"""
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0, failure_rate=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _inject(self):
+        """Delay the request and decide whether to fail it. Returns True if a 503 was sent."""
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        with server.lock:
+            server.requests += 1
+            fail = random.random() < server.failure_rate
+            if fail:
+                server.failures += 1
+        if fail:
+            self._send(503, self._error('SlowDown', 'Please reduce your request rate.'))
+        return fail
+
+    def _error(self, code, message):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Error><Code>%s</Code><Message>%s</Message></Error>' % (code, message))
+
+    def _send(self, status, body='', headers=None, head=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head and status != 304:
+            self.wfile.write(body)
+
+class _MetadataHandler(_Handler):
+    """The parts of the EC2 instance metadata service ec2autorun.py reads"""
+    def do_GET(self):
+        if self._inject():
+            return
+        server = self.server
+        path = urlparse(self.path).path
+        if path == '/latest/user-data':
+            if server.user_data is None:
+                return self._send(404)
+            return self._send(200, server.user_data)
+        key = path[len('/latest/meta-data/'):] if path.startswith('/latest/meta-data/') else None
+        value = {'instance-id': 'i-bench%04d' % server.run,
+                 'local-hostname': 'ip-127-0-0-1.bench.internal',
+                 'local-ipv4': '127.0.0.1'}.get(key)
+        if value is None:
+            return self._send(404)
+        self._send(200, value)
+
+class _S3Handler(_Handler):
+    """Path-style S3 stub keeping objects in memory. Supports what ec2autorun.py and
+    s3_transfer.py use for small objects: HEAD/GET bucket, conditional GET and HEAD
+    of keys, and PUT of buckets and keys. Signatures are not checked."""
+    def _parse(self):
+        parts = urlparse(self.path).path.lstrip('/').split('/', 1)
+        return parts[0], (parts[1] if len(parts) > 1 else '')
+
+    def _get(self, head=False):
+        if self._inject():
+            return
+        bucket_name, key_name = self._parse()
+        bucket = self.server.buckets.get(bucket_name)
+        if bucket is None:
+            return self._send(404, self._error('NoSuchBucket', bucket_name), head=head)
+        if not key_name:
+            return self._send(200, '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<ListBucketResult><Name>%s</Name><IsTruncated>false</IsTruncated></ListBucketResult>'
+                % bucket_name, {'Content-Type': 'application/xml'}, head=head)
+        if key_name not in bucket:
+            return self._send(404, self._error('NoSuchKey', key_name), head=head)
+        data, etag, last_modified = bucket[key_name]
+        headers = {'ETag': etag, 'Last-Modified': last_modified,
+                   'Content-Type': 'application/octet-stream'}
+        if self.headers.getheader('If-None-Match') == etag \
+            or self.headers.getheader('If-Modified-Since') == last_modified:
+            return self._send(304, headers=headers)
+        self._send(200, data, headers, head=head)
+
+    def do_GET(self):
+        self._get()
+
+    def do_HEAD(self):
+        self._get(head=True)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        if self._inject():
+            return
+        if urlparse(self.path).query:
+            return self._send(501, self._error('NotImplemented', 'Only simple PUTs are supported'))
+        bucket_name, key_name = self._parse()
+        if not key_name:
+            self.server.buckets.setdefault(bucket_name, {})
+            return self._send(200)
+        if bucket_name not in self.server.buckets:
+            return self._send(404, self._error('NoSuchBucket', bucket_name))
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.server.buckets[bucket_name][key_name] = (data, etag, formatdate(usegmt=True))
+        self._send(200, headers={'ETag': etag})
+
+def _user_data(options, s3_url):
+    if options.user_data == 'empty':
+        return ''
+    ud = {'cluster_name': 'bench',
+          'access_key': 'bench',
+          'secret_key': 'bench',
+          'bucket_cluster': CLUSTER_BUCKET,
+          'bucket_default': DEFAULT_BUCKET,
+          's3_url': s3_url,
+          'boot_script_timeout': 60 + 2 * options.script_time}
+    if options.push_telemetry:
+        ud['push_boot_telemetry'] = True
+    return json.dumps(ud) # JSON is valid YAML
+
+def _run_boot(work_dir, run, cache_dir, metadata, s3, options):
+    local_path = os.path.join(work_dir, 'run%04d' % run)
+    os.makedirs(local_path)
+    metadata.run = run
+    env = dict(os.environ)
+    env.update({'CM_METADATA_SERVER': metadata.url,
+                'CM_S3_URL': s3.url,
+                'CM_LOCAL_PATH': local_path,
+                'CM_BOOT_CACHE_PATH': cache_dir,
+                'CM_SANDBOX': '1'})
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ec2autorun.py')
+    start = time.time()
+    with open(os.path.join(local_path, 'ec2autorun.log'), 'w') as log_file:
+        returncode = subprocess.call([sys.executable, script], env=env,
+            stdout=log_file, stderr=subprocess.STDOUT)
+    end = time.time()
+    try:
+        with open(os.path.join(local_path, 'boot_telemetry.json')) as f:
+            boot = json.load(f)
+    except (IOError, ValueError), e:
+        print >> sys.stderr, "Run %s (exit code %s) left no telemetry: %s; see '%s'" \
+            % (run, returncode, e, os.path.join(local_path, 'ec2autorun.log'))
+        return None
+    boot['file'] = local_path
+    # Includes interpreter startup and imports, which the 'total' phase does not
+    boot['phases'].append({'name': 'process', 'start': start, 'end': end, 'duration': end - start})
+    return boot
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('-n', '--runs', type='int', default=20, help="number of boots (default %default)")
+    parser.add_option('--metadata-latency', type='float', default=0.0,
+        help="mean seconds the metadata service takes per request")
+    parser.add_option('--metadata-failure-rate', type='float', default=0.0,
+        help="fraction of metadata requests answered with a 503")
+    parser.add_option('--s3-latency', type='float', default=0.0,
+        help="mean seconds the S3 stub takes per request")
+    parser.add_option('--s3-failure-rate', type='float', default=0.0,
+        help="fraction of S3 requests answered with a 503")
+    parser.add_option('--script-time', type='float', default=0.5,
+        help="seconds the stand-in boot script runs for (default %default)")
+    parser.add_option('--user-data', choices=['cluster', 'empty'], default='cluster',
+        help="'cluster' (YAML user data with a cluster bucket) or 'empty' (default %default)")
+    parser.add_option('--cold', action='store_true', default=False,
+        help="do not share the boot script cache between runs")
+    parser.add_option('--push-telemetry', action='store_true', default=False,
+        help="set push_boot_telemetry in user data")
+    parser.add_option('--keep', action='store_true', default=False,
+        help="keep the working directory with each run's files and logs")
+    options, args = parser.parse_args()
+
+    metadata = _Server(_MetadataHandler, options.metadata_latency, options.metadata_failure_rate).start()
+    s3 = _Server(_S3Handler, options.s3_latency, options.s3_failure_rate).start()
+    metadata.run = 0
+    metadata.user_data = _user_data(options, s3.url)
+    boot_script = BOOT_SCRIPT % {'half': options.script_time / 2}
+    s3.buckets = {DEFAULT_BUCKET: {BOOT_SCRIPT_NAME: (boot_script, '"%s"' % hashlib.md5(boot_script).hexdigest(),
+                                                      formatdate(usegmt=True))},
+                  CLUSTER_BUCKET: {}}
+    work_dir = tempfile.mkdtemp(prefix='cm_boot_benchmark')
+    boots = []
+    try:
+        for run in range(options.runs):
+            cache_dir = os.path.join(work_dir, 'cache%04d' % run if options.cold else 'cache')
+            boot = _run_boot(work_dir, run, cache_dir, metadata, s3, options)
+            if boot is not None:
+                boots.append(boot)
+    finally:
+        metadata.shutdown()
+        s3.shutdown()
+        if options.keep:
+            print "Kept run files in '%s'" % work_dir
+        else:
+            shutil.rmtree(work_dir)
+    print "%s/%s boots completed; metadata service: %s requests (%s failed), S3 stub: %s requests (%s failed)" \
+        % (len(boots), options.runs, metadata.requests, metadata.failures, s3.requests, s3.failures)
+    print
+    if boots:
+        boot_stats.summarize(boots)
+
+if __name__ == "__main__":
+    main()
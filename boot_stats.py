@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Summarize boot latency across instances from the boot telemetry files written
+by ec2autorun.py (/tmp/cm/boot_telemetry.json on each instance, or
+boot_telemetry/*.json in a cluster bucket when push_boot_telemetry is set
+in user data).
+
+Usage: boot_stats.py [-s] <telemetry file or directory> [...]
+
+For every boot phase, prints the number of instances that went through it and
+the 50th, 90th and 99th percentile and maximum of its duration, followed by
+the slowest instances overall and retry and transfer totals.
+"""
+import os, sys, json, math
+from optparse import OptionParser
+
+PERCENTILES = [50, 90, 99]
+# Phases spanning other phases: all of the boot, all of the ec2autorun.py
+# process (recorded by boot_benchmark.py) and the boot script, whose own
+# phases are recorded as '<script>:<phase>'
+AGGREGATE_PHASES = ['total', 'process', 'run_boot_script']
+
+def _telemetry_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.json'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def _load(paths):
+    boots = []
+    for path in _telemetry_files(paths):
+        try:
+            with open(path) as f:
+                boot = json.load(f)
+        except (IOError, ValueError), e:
+            print >> sys.stderr, "Skipping '%s': %s" % (path, e)
+            continue
+        boot['file'] = path
+        boots.append(boot)
+    return boots
+
+def _percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+def _phase_durations(boots):
+    """Durations of each phase across boots, with phases in the order they were
+    first seen. A phase run more than once in a boot counts with its total."""
+    durations = {}
+    order = []
+    for boot in boots:
+        totals = {}
+        for phase in boot.get('phases', []):
+            if phase['name'] not in durations:
+                durations[phase['name']] = []
+                order.append(phase['name'])
+            totals[phase['name']] = totals.get(phase['name'], 0) + phase['duration']
+        for name, duration in totals.items():
+            durations[name].append(duration)
+    return [(name, sorted(durations[name])) for name in order]
+
+def _total(boot):
+    for phase in boot.get('phases', []):
+        if phase['name'] == 'total':
+            return phase['duration']
+    return 0
+
+def _longest_phase(boot):
+    """The longest phase of a boot that does not just span other phases. The
+    boot script only counts as a whole if it reported no phases of its own."""
+    phases = boot.get('phases', [])
+    aggregate = list(AGGREGATE_PHASES)
+    if not [phase for phase in phases if ':' in phase['name']]:
+        aggregate.remove('run_boot_script')
+    leaves = [phase for phase in phases if phase['name'] not in aggregate]
+    if not leaves:
+        return None
+    return max(leaves, key=lambda phase: phase['duration'])
+
+def summarize(boots, slowest=5):
+    name_width = max([len(name) for name, values in _phase_durations(boots)] + [5])
+    header = "%-*s %6s" % (name_width, 'phase', 'count') \
+        + ''.join(["%9s" % ('p%s' % p) for p in PERCENTILES]) + "%9s" % 'max'
+    print header
+    print '-' * len(header)
+    for name, values in _phase_durations(boots):
+        print "%-*s %6s" % (name_width, name, len(values)) \
+            + ''.join(["%9.2f" % _percentile(values, p) for p in PERCENTILES]) + "%9.2f" % values[-1]
+    print
+    print "Slowest boots:"
+    for boot in sorted(boots, key=_total, reverse=True)[:slowest]:
+        longest = _longest_phase(boot)
+        print "  %8.2fs %s (%s); longest phase: %s" % (_total(boot), boot.get('instance_id'),
+            boot['file'], "%s %.2fs" % (longest['name'], longest['duration']) if longest else 'none')
+    retries = {}
+    for boot in boots:
+        for what, count in boot.get('retries', {}).items():
+            retries[what] = retries.get(what, 0) + count
+    print
+    print "Retries: %s" % (', '.join(["%s %s" % item for item in sorted(retries.items())]) or 'none')
+    print "Fetched %.1f MB, uploaded %.1f MB over %s boots" \
+        % (sum([boot.get('bytes_fetched', 0) for boot in boots]) / 1048576.0,
+           sum([boot.get('bytes_uploaded', 0) for boot in boots]) / 1048576.0, len(boots))
+
+def main():
+    parser = OptionParser(usage="%prog [options] <telemetry file or directory> [...]")
+    parser.add_option('-s', '--slowest', type='int', default=5,
+        help="number of slowest boots to list (default %default)")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no telemetry files given")
+    boots = _load(args)
+    if not boots:
+        parser.error("no readable telemetry files found")
+    summarize(boots, options.slowest)
+
+if __name__ == "__main__":
+    main()
@@ -12,18 +12,24 @@ process. As a result, the script should be invoked twice: the first time
 to setup the environment, then manually copying the data to the instance (this
 script provides you the exact command to run) and then invoking this script 
 again to cleanup the environment.
+Alternatively, 'run' does it all in one go: it sets up the environment, copies
+the data over parallel rsync streams, detaches the volume, terminates the
+instance as soon as the volume is detached and starts the snapshot without
+waiting for it. The snapshot is recorded in C_FILE; 'status' reports its
+progress and 'finalize' waits for it to complete and deletes the volume.
 
 Requires fabric, boto
 
 Usage: 
+    fab -f local_to_ebs_fab.py <run | status | finalize>
     fab -f local_to_ebs_fab.py <setup | cleanup>
 """
 
-import boto, time, os, datetime, socket, yaml, sys
+import boto, time, os, datetime, socket, yaml, sys, heapq, hashlib, shutil, subprocess, re
 from boto.regioninfo import RegionInfo
 from boto.ec2.connection import EC2Connection
 from boto.exception import EC2ResponseError, BotoServerError
-from fabric.api import sudo, env, local
+from fabric.api import sudo, env, local, put, get
 from fabric.contrib.console import confirm
 from fabric.contrib.files import exists, settings, hide
 from fabric.context_managers import settings as v_settings # virtualized settings: see http://stackoverflow.com/questions/2326797/how-to-set-target-hosts-in-fabric-file
@@ -56,6 +62,14 @@ KP_NAME = "tmp_snap_copy_kp"
 KP_FILE = "/tmp/%s" % KP_NAME
 # Configuration file for this script where info is saved between the environemnt setup and tear down
 C_FILE = '/tmp/copy_config.yaml'
+# Data is copied over this many concurrent rsync streams, each given a share of the files balanced by size
+RSYNC_STREAMS = 4
+# Where the shard file lists, rsync logs and checksum manifests are kept; a rerun skips completed shards
+RSYNC_STATE_DIR = '/tmp/copy_rsync_state'
+# Files with these extensions are already compressed; rsync sends them as is rather than spending CPU on them
+RSYNC_SKIP_COMPRESS = ['gz', 'bz2', 'zip', 'tgz', 'xz', '2bit', 'bam', 'bgz', 'bgzf', 'sra', 'jpg', 'png', 'gzi']
+# Compare MD5 checksums of every file at the source and destination once copying is done
+VERIFY_MANIFEST = True
 
 ## ---------------------------------- Driver -----------------------------------
 def setup():
@@ -77,10 +91,52 @@ def cleanup():
     _load_config_file()
     _get_instance_ref()
     _check_config()
-    _do_cleanup()
+    if _release_volume():
+        _finalize()
     end_time = datetime.datetime.now()
     print "End time: %s; cleanup duration: %s" % (end_time, (end_time-start_time))
 
+def run():
+    start_time = datetime.datetime.now()
+    print "Start time: %s" % start_time
+    _load_env()
+    _check_config()
+    if not _create_env():
+        print "ERROR: could not set up an instance with the data volume attached; fix the problem " \
+            "and rerun, or invoke 'cleanup' to remove whatever was created."
+        return
+    _setup_env()
+    _create_config_file()
+    if _parallel_rsync():
+        _release_volume()
+    else:
+        print "ERROR: copying the data did not complete. Fix the problem and rerun with INSTANCE_ID='%s' " \
+            "and -i %s to resume the copy, or copy the data by hand and invoke 'cleanup'." % (env.instance.id, KP_FILE)
+    end_time = datetime.datetime.now()
+    print "End time: %s; run duration: %s" % (end_time, (end_time-start_time))
+
+def status():
+    _load_env()
+    _load_config_file()
+    if not env.snapshot:
+        print "No snapshot recorded in '%s'; has the volume been released yet?" % C_FILE
+        return
+    ec2_conn = _get_conn()
+    snapshot = ec2_conn.get_all_snapshots([env.snapshot])[0]
+    print "Snapshot '%s' of volume '%s': status '%s', progress '%s'" % (snapshot.id, env.volume, snapshot.status, snapshot.progress)
+
+def finalize():
+    start_time = datetime.datetime.now()
+    print "Start time: %s" % start_time
+    _load_env()
+    _load_config_file()
+    if not env.snapshot:
+        print "ERROR: no snapshot recorded in '%s'; run 'cleanup' instead" % C_FILE
+        sys.exit(1)
+    _finalize()
+    end_time = datetime.datetime.now()
+    print "End time: %s; finalize duration: %s" % (end_time, (end_time-start_time))
+
 ## ------------------------------ Action methods -------------------------------
 def _load_env():
     """Setup for a Ubuntu 10.04 """
@@ -91,18 +147,24 @@ def _load_env():
     env.vol_device = DEVICE
     env.instance = INSTANCE_ID # Save handle to created EC2 instance object or INSTANCE_ID (which will lead to instance object)
     env.volume = None # Save handle to created EC2 volume object
+    env.snapshot = None # ID of the snapshot being created from the volume
 
 def _create_env():
+    """Start (or reconnect to) the instance and attach the data volume to it.
+    Returns the instance, or None if either step failed."""
     inst = _start_instance()
-    if inst:
-        _setup_volume(inst)
+    if inst and _setup_volume(inst):
+        return inst
+    return None
 
 def _setup_env():
     _install_packages()
     _mount_ebs()
+    if SNAP_ID:
+        _hydrate_volume()
 
 def _rsync():
-    cmd = 'time rsync -avz --delete -e "ssh -o StrictHostKeyChecking=no -i %s" %s/* %s@%s:%s/.' % (KP_FILE, SRC_DATA_DIR, env.user, env.instance.public_dns_name, DEST_DATA_DIR)
+    cmd = 'time rsync -avz --skip-compress=%s --delete -e "%s" %s/* %s@%s:%s/.' % ('/'.join(RSYNC_SKIP_COMPRESS), _ssh_cmd(), SRC_DATA_DIR, env.user, env.instance.public_dns_name, DEST_DATA_DIR)
     print "\n\n----------------------------------------------------------"
     print "Connect to the remote instance using the following command:"
     print "  ssh -o StrictHostKeyChecking=no -i %s %s@%s" % (KP_FILE, env.user, env.instance.public_dns_name)
@@ -110,24 +172,174 @@ def _rsync():
     print "rsync command (run it like so from local machine):"
     print "  %s" % cmd
     print "----------------------------------------------------------"
-    answer = confirm("Would you like this script to run rsync (answer 'No' if you want to run rsync by hand)?", default=False)
+    answer = confirm("Would you like this script to copy the data over %s parallel rsync streams (answer 'No' if you want to run rsync by hand)?" % RSYNC_STREAMS, default=False)
     if answer:
-        print "Now executing rsync command: %s" % cmd
-        local(cmd)
+        _parallel_rsync()
+
+def _ssh_cmd():
+    return "ssh -o StrictHostKeyChecking=no -i %s" % KP_FILE
+
+def _parallel_rsync(streams=RSYNC_STREAMS):
+    """Copy SRC_DATA_DIR to DEST_DATA_DIR on the instance over several concurrent rsync
+    streams, each given a share of the files balanced by size. Completed shards are
+    recorded in RSYNC_STATE_DIR so a rerun after a failure only redoes the rest
+    (rsync's --partial also keeps partly sent files). Returns True if all shards
+    were copied (and, with VERIFY_MANIFEST, the checksums match)."""
+    start_time = datetime.datetime.now()
+    shards, dirs = _plan_shards(SRC_DATA_DIR, streams)
+    state = _load_rsync_state(shards)
+    dest = "%s@%s:%s/" % (env.user, env.instance.public_dns_name, DEST_DATA_DIR)
+    procs = {}
+    for i, (shard_bytes, files) in enumerate(shards):
+        if i in state['done']:
+            print "Shard %s/%s (%s files, %.1f GB) already copied; skipping" % (i+1, len(shards), len(files), shard_bytes/1073741824.0)
+            continue
+        if not files:
+            state['done'].append(i)
+            continue
+        files_from = os.path.join(RSYNC_STATE_DIR, 'shard%s.txt' % i)
+        with open(files_from, 'w') as f:
+            # Directories go with the first shard so that empty ones are created too
+            f.write('\n'.join((dirs if i == 0 else []) + files) + '\n')
+        log_file = open(os.path.join(RSYNC_STATE_DIR, 'shard%s.log' % i), 'w')
+        cl = ['rsync', '-a', '-z', '--skip-compress=%s' % '/'.join(RSYNC_SKIP_COMPRESS), '--partial',
+              '--stats', '--files-from=%s' % files_from, '-e', _ssh_cmd(), SRC_DATA_DIR + '/', dest]
+        print "Starting rsync of shard %s/%s (%s files, %.1f GB)" % (i+1, len(shards), len(files), shard_bytes/1073741824.0)
+        procs[i] = (subprocess.Popen(cl, stdout=log_file, stderr=subprocess.STDOUT), log_file)
+    sent = 0
+    for i, (proc, log_file) in sorted(procs.items()):
+        proc.wait()
+        log_file.close()
+        sent += _rsync_bytes_sent(log_file.name)
+        if proc.returncode == 0:
+            state['done'].append(i)
+            print "Shard %s/%s copied" % (i+1, len(shards))
+        else:
+            print "ERROR: rsync of shard %s/%s failed with exit code %s; see '%s'. Rerun to resume." % (i+1, len(shards), proc.returncode, log_file.name)
+    _save_rsync_state(state)
+    seconds = max((datetime.datetime.now() - start_time).total_seconds(), 1)
+    copied = sum([shards[i][0] for i in procs])
+    print "Copied %.1f GB of data in %.0f sec over %s streams (%.1f MB/s); %.1f GB sent over the network" \
+        % (copied/1073741824.0, seconds, len(procs), copied/1048576.0/seconds, sent/1073741824.0)
+    if len(state['done']) < len(shards):
+        return False
+    # --files-from transfers never delete, so remove files no longer in the source in a separate pass
+    local('rsync -r --delete --existing --ignore-existing -e "%s" %s/ %s' % (_ssh_cmd(), SRC_DATA_DIR, dest))
+    if VERIFY_MANIFEST:
+        return _compare_manifests()
+    return True
 
-def _do_cleanup():
+def _plan_shards(src_dir, streams):
+    """Split the files under src_dir into shards of about equal size (largest file to the
+    currently smallest shard). Returns the shards as (bytes, relative paths) and the
+    relative paths of all directories."""
+    entries, dirs = [], []
+    for root, dir_names, file_names in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        for name in dir_names:
+            dirs.append(os.path.normpath(os.path.join(rel_root, name)))
+        for name in file_names:
+            path = os.path.join(root, name)
+            entries.append((os.lstat(path).st_size, os.path.normpath(os.path.join(rel_root, name))))
+    entries.sort(reverse=True)
+    heap = [(0, i) for i in range(streams)]
+    shards = [[0, []] for i in range(streams)]
+    for size, path in entries:
+        smallest, i = heapq.heappop(heap)
+        shards[i][0] += size
+        shards[i][1].append(path)
+        heapq.heappush(heap, (smallest + size, i))
+    return [(shard_bytes, sorted(files)) for shard_bytes, files in shards], sorted(dirs)
+
+def _load_rsync_state(shards):
+    """Load the shards completed by a previous run, unless the source or the shards changed since"""
+    plan = hashlib.md5(yaml.dump([SRC_DATA_DIR, DEST_DATA_DIR, [files for shard_bytes, files in shards]])).hexdigest()
+    state_file = os.path.join(RSYNC_STATE_DIR, 'state.yaml')
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = yaml.load(f)
+        if state.get('plan') == plan:
+            return state
+        print "Source files changed since the previous copy attempt; copying all shards again"
+        shutil.rmtree(RSYNC_STATE_DIR)
+    if not os.path.exists(RSYNC_STATE_DIR):
+        os.makedirs(RSYNC_STATE_DIR)
+    return {'plan': plan, 'done': []}
+
+def _save_rsync_state(state):
+    with open(os.path.join(RSYNC_STATE_DIR, 'state.yaml'), 'w') as f:
+        yaml.dump(state, f, default_flow_style=False)
+
+def _rsync_bytes_sent(log_file):
+    with open(log_file) as f:
+        m = re.search(r'Total bytes sent: ([\d,]+)', f.read())
+    return int(m.group(1).replace(',', '')) if m else 0
+
+def _compare_manifests():
+    """Compare MD5 checksums of every file in SRC_DATA_DIR and DEST_DATA_DIR"""
+    md5_cmd = "find . -type f -print0 | xargs -0 -r -n 64 -P %s md5sum | sort -k 2" % RSYNC_STREAMS
+    local_manifest = os.path.join(RSYNC_STATE_DIR, 'source.md5')
+    remote_manifest = os.path.join(RSYNC_STATE_DIR, 'destination.md5')
+    print "Computing checksums of the source and destination files"
+    with v_settings(host_string=env.hosts[0]):
+        local_md5 = subprocess.Popen(md5_cmd, shell=True, cwd=SRC_DATA_DIR, stdout=open(local_manifest, 'w'))
+        sudo("cd %s && %s > /tmp/destination.md5" % (DEST_DATA_DIR, md5_cmd))
+        get('/tmp/destination.md5', remote_manifest)
+        local_md5.wait()
+    manifests = []
+    for manifest in (local_manifest, remote_manifest):
+        with open(manifest) as f:
+            manifests.append(dict([(line[34:].rstrip('\n'), line[:32]) for line in f if line.strip()]))
+    src, dest = manifests
+    missing = [path for path in src if path not in dest]
+    differ = [path for path in src if path in dest and src[path] != dest[path]]
+    if missing or differ:
+        print "ERROR: %s of %s files missing and %s differing at the destination, e.g.: %s" \
+            % (len(missing), len(src), len(differ), ', '.join((missing + differ)[:10]))
+        return False
+    print "Checksums of all %s files match between source and destination" % len(src)
+    return True
+
+def _release_volume():
+    """Unmount and detach the data volume, terminate the instance as soon as the volume
+    is detached and start a snapshot of the volume without waiting for it to complete.
+    The snapshot is recorded in C_FILE for 'status' and 'finalize'."""
+    ec2_conn = _get_conn()
     with v_settings(host_string=env.hosts[0]):
-        ec2_conn = _get_conn()
         with settings(warn_only=True):
-            sudo("umount %s" % DEST_DATA_DIR)
-        if _get_volume_ref(env.instance, ec2_conn):
-            if _detach_volume(ec2_conn, env.volume.id, env.instance.id):
-                _terminate_instance(env.instance, ec2_conn)
-                if _create_snap(ec2_conn, env.volume.id):
-                    _delete_volume(ec2_conn, env.volume.id)
-                    os.remove(C_FILE) # Delete configuration file
-        else:
+            result = sudo("umount %s" % DEST_DATA_DIR)
+            if result.failed:
+                # The prewarming started by _hydrate_volume may still have files open
+                sudo("pkill -f '[h]ydrate_volume.py'")
+                time.sleep(5)
+                result = sudo("umount %s" % DEST_DATA_DIR)
+        if result.failed:
+            print "ERROR: could not unmount '%s'; not detaching the volume. Unmount it by hand " \
+                "and rerun with INSTANCE_ID='%s' and -i %s." % (DEST_DATA_DIR, env.instance.id, KP_FILE)
+            return False
+        if not _get_volume_ref(env.instance, ec2_conn):
             sudo("mount %s %s" % (env.vol_device, DEST_DATA_DIR))
+            return False
+        if not _detach_volume(ec2_conn, env.volume.id, env.instance.id):
+            return False
+    _terminate_instance(env.instance, ec2_conn)
+    snap_id = _start_snap(ec2_conn, env.volume.id)
+    if not snap_id:
+        return False
+    env.snapshot = snap_id
+    _update_config_file(snapshot=snap_id)
+    print "Snapshot '%s' of volume '%s' is being created. Check on it with 'fab -f local_to_ebs_fab.py status' " \
+        "and run 'fab -f local_to_ebs_fab.py finalize' to wait for it to complete and delete the volume." \
+        % (snap_id, env.volume.id)
+    return True
+
+def _finalize():
+    """Wait for the snapshot recorded in C_FILE to complete, then delete the volume"""
+    ec2_conn = _get_conn()
+    vol_id = getattr(env.volume, 'id', env.volume)
+    if _wait_for_snap(ec2_conn, env.snapshot):
+        _delete_volume(ec2_conn, vol_id)
+        os.remove(C_FILE) # Delete configuration file
 
 ## ------------------------------ Utility methods ------------------------------
 def _check_config():
@@ -218,9 +430,10 @@ def _setup_volume(inst):
     if SNAP_ID:
         snap = ec2_conn.get_all_snapshots([SNAP_ID])[0]
         vol_size = snap.volume_size
-    if not _get_volume_ref(inst, ec2_conn, snap):
-        if _create_vol(ec2_conn, inst.placement, vol_size, SNAP_ID):
-            return _attach_vol(ec2_conn, env.volume.id, inst.id)
+    if _get_volume_ref(inst, ec2_conn, snap):
+        return True
+    if _create_vol(ec2_conn, inst.placement, vol_size, SNAP_ID):
+        return _attach_vol(ec2_conn, env.volume.id, inst.id)
     return False
 
 def _test_ssh(ip_addr):
@@ -414,6 +627,10 @@ def _mount_ebs():
     with v_settings(host_string=env.hosts[0]):
         if not exists(DEST_DATA_DIR):
             sudo("mkdir -p %s" % DEST_DATA_DIR)
+        with settings(hide('everything'), warn_only=True):
+            if sudo("mountpoint -q %s" % DEST_DATA_DIR).succeeded:
+                print "Device already mounted at '%s' (resuming a previous run?)" % DEST_DATA_DIR
+                return
         # Check if DEST_DATA_DIR is empty before attempting to mount
         with settings(hide('stderr'), warn_only=True): 
             result = sudo('[ "$(ls -A %s)" ]' % DEST_DATA_DIR)
@@ -427,6 +644,16 @@ def _mount_ebs():
         else:
             print "ERROR: data dir '%s' is not empty? Did not mount device '%s'" % (DEST_DATA_DIR, env.vol_device)
 
+def _hydrate_volume():
+    """Start reading the volume recreated from SNAP_ID in the background so its
+    blocks are fetched from the snapshot before rsync needs them (see hydrate_volume.py)"""
+    with v_settings(host_string=env.hosts[0]):
+        remote_script = '/tmp/hydrate_volume.py'
+        put(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'hydrate_volume.py'), remote_script)
+        log_file = '/tmp/hydrate_volume.log'
+        sudo("nohup python %s %s %s > %s 2>&1 &" % (remote_script, DEST_DATA_DIR, env.vol_device, log_file), pty=False)
+        print "Prewarming volume '%s' in the background; progress is logged to '%s' on the instance" % (env.vol_device, log_file)
+
 def _detach_volume(ec2_conn, vol_id, inst_id):
     """
     Detach EBS volume from the given instance. Try it for some time.
@@ -449,21 +676,31 @@ def _detach_volume(ec2_conn, vol_id, inst_id):
         volumestatus = volumes[0].status
     return True
 
-def _create_snap(ec2_conn, vol_id, snap_description=SNAP_DESCRIPTION):
+def _start_snap(ec2_conn, vol_id, snap_description=SNAP_DESCRIPTION):
     print "Initiating creation of a snapshot for the volume '%s'" % vol_id
-    snapshot = ec2_conn.create_snapshot(vol_id, description=snap_description)
-    if snapshot: 
-        counter = 0
-        while snapshot.status != 'completed':
-            print "Snapshot '%s' progress (%s sec): '%s'; status: '%s'" % (snapshot.id, 6*counter, snapshot.progress, snapshot.status)
-            time.sleep(6)
-            snapshot.update()
-            counter += 1
-        print "Creation of a snapshot for the volume '%s' completed: '%s'" % (vol_id, snapshot.id)
-        return True
-    else:
-        print "ERROR: could not create snapshot from volume '%s'" % vol_id
-    return False
+    try:
+        snapshot = ec2_conn.create_snapshot(vol_id, description=snap_description)
+    except EC2ResponseError, e:
+        print "ERROR: could not create snapshot from volume '%s': %s" % (vol_id, e)
+        return None
+    if snapshot:
+        return snapshot.id
+    print "ERROR: could not create snapshot from volume '%s'" % vol_id
+    return None
+
+def _wait_for_snap(ec2_conn, snap_id):
+    snapshot = ec2_conn.get_all_snapshots([snap_id])[0]
+    counter = 0
+    while snapshot.status not in ('completed', 'error'):
+        print "Snapshot '%s' progress (%s sec): '%s'; status: '%s'" % (snapshot.id, 6*counter, snapshot.progress, snapshot.status)
+        time.sleep(6)
+        snapshot.update()
+        counter += 1
+    if snapshot.status == 'error':
+        print "ERROR: creation of snapshot '%s' failed" % snapshot.id
+        return False
+    print "Creation of snapshot '%s' for the volume '%s' completed" % (snapshot.id, snapshot.volume_id)
+    return True
 
 def _delete_volume(ec2_conn, vol_id):
     try:
@@ -512,6 +749,15 @@ def _create_config_file():
     # print "  ssh -o StrictHostKeyChecking=no -i %s %s@%s" % (KP_FILE, env.user, env.instance.public_dns_name)
     # print "----------------------------------------------------------"
 
+def _update_config_file(**items):
+    """Add items to (or replace them in) the configuration file"""
+    with open(C_FILE) as f:
+        config = yaml.load(f)
+    config['config'] = [i for i in config['config'] if not set(i.keys()) & set(items.keys())]
+    config['config'].extend([{key: value} for key, value in items.items()])
+    with open(C_FILE, 'w') as f:
+        yaml.dump(config, f, default_flow_style=False)
+
 def _load_config_file():
     with open(C_FILE) as f:
         conf = yaml.load(f)
@@ -524,3 +770,5 @@ def _load_config_file():
             env.volume = i['volume']
         elif i.has_key('key_file'):
             env.key_filename = i['key_file']
+        elif i.has_key('snapshot'):
+            env.snapshot = i['snapshot']
@@ -12,7 +12,9 @@ Usage:
 
 import os
 import operator
-from glob import glob
+import datetime
+import tempfile
+import yaml
 from contextlib import contextmanager
 
 from fabric.api import *
@@ -49,6 +51,11 @@ if not os.path.exists(lenfile):
 # -- Host specific setup for various groups of servers.
 
 env.remove_old_genomes = False
+env.install_pairwise = False
+env.install_uniref = False
+# Keep reference sequences as BGZF compressed FASTA with .fai and .gzi
+# indexes. Galaxy's samtools must be 1.3 or newer to read them.
+env.compress_refs = False
 
 def amazon_ec2():
     """Setup for a ubuntu amazon ec2 share.
@@ -78,8 +85,11 @@ class _DownloadHelper:
 
     def _exists(self, fname, seq_dir):
         """Check if a file exists in either download or final destination.
+
+        A BGZF compressed copy in the final destination also counts.
         """
-        return exists(fname) or exists(os.path.join(seq_dir, fname))
+        return exists(fname) or exists(os.path.join(seq_dir, fname)) or \
+               exists(os.path.join(seq_dir, fname + ".gz.gzi"))
 
 class UCSCGenome(_DownloadHelper):
     def __init__(self, genome_name):
@@ -91,8 +101,13 @@ class UCSCGenome(_DownloadHelper):
         return self._name
 
     def download(self, seq_dir):
-        for zipped_file in ["chromFa.tar.gz", "%s.fa.gz" % self._name,
-                            "chromFa.zip"]:
+        genome_file = "%s.fa" % self._name
+        zipped_files = ["chromFa.tar.gz", "%s.fa.gz" % self._name,
+                        "chromFa.zip"]
+        if self._exists(genome_file, seq_dir):
+            return genome_file, [z for z in zipped_files
+                                 if self._exists(z, seq_dir)]
+        for zipped_file in zipped_files:
             if not self._exists(zipped_file, seq_dir):
                 with settings(warn_only=True):
                     result = run("wget %s/%s" % (self._url, zipped_file))
@@ -100,7 +115,6 @@ class UCSCGenome(_DownloadHelper):
                     break
             else:
                 break
-        genome_file = "%s.fa" % self._name
         if not self._exists(genome_file, seq_dir):
             if zipped_file.endswith(".tar.gz"):
                 run("tar -xzpf %s" % zipped_file)
@@ -176,7 +190,8 @@ class EnsemblGenome(_DownloadHelper):
 
     def download(self, seq_dir):
         genome_file = "%s.fa" % self._name
-        if not self._exists(self._get_file, seq_dir):
+        if not self._exists(self._get_file, seq_dir) and \
+                not self._exists(genome_file, seq_dir):
             run("wget %s%s" % (self._url, self._get_file))
         if not self._exists(genome_file, seq_dir):
             run("gunzip -c %s > %s" % (self._get_file, genome_file))
@@ -197,62 +212,149 @@ class BroadGenome(_DownloadHelper):
             run("wget %s/%s" % (self._ftp_url, self._target))
         return self._target, []
 
-genomes = [
-           ("Amellifera_Honeybee", "apiMel3", UCSCGenome("apiMel3")),
-           ("Athaliana", "araTha_tair9", EnsemblGenome("plants", "3", "55",
-               "Arabidopsis_thaliana", "TAIR9")),
-           ("Btaurus", "bosTau4", UCSCGenome("bosTau4")),
-           ("Celegans", "ce6", UCSCGenome("ce6")),
-           ("Celegans", "WS200", EnsemblGenome("standard", "56", "56",
-               "Caenorhabditis_elegans", "WS200")),
-           ("Cfamiliaris_Dog", "canFam2", UCSCGenome("canFam2")),
-           ("Drerio_Zebrafish", "danRer6", UCSCGenome("danRer6")),
-           ("Dmelanogaster", "dm3", UCSCGenome("dm3")),
-           ("Ecoli", "eschColi_K12", NCBIRest("eschColi_K12", ["U00096.2"])),
-           ("Fcatus_Cat", "felCat3", UCSCGenome("felCat3")),
-           ("Ggallus_Chicken", "galGal3", UCSCGenome("galGal3")),
-           ("Hsapiens", "hg18", UCSCGenome("hg18")),
-           #("Hsapiens", "hg18-broad", BroadGenome("Homo_sapiens_assembly18.fasta")),
-           #("Hsapiens", "GRCh39", BroadGenome("Homo_sapiens_assembly19.fasta")),
-           ("Mmulatta", "rheMac2", UCSCGenome("rheMac2")),
-           ("Mmusculus", "mm8", UCSCGenome("mm8")),
-           ("Mmusculus", "mm9", UCSCGenome("mm9")),
-           ("Msmegmatis", "92", NCBIRest("92", ["NC_008596.1"])),
-           ("Mtuberculosis_H37Rv", "mycoTube_H37RV", NCBIRest("mycoTube_H37RV",
-               ["NC_000962"])),
-           ("Paeruginosa_UCBPP-PA14", "386", NCBIRest("386", ["CP000438.1"])),
-           ("phiX174", "phix", NCBIRest("phix", ["NC_001422.1"])),
-           ("Rnorvegicus", "rn4", UCSCGenome("rn4")),
-           ("Scerevisiae", "sacCer2", UCSCGenome("sacCer2")),
-           ("Spurpuratus", "strPur2", UCSCGenome("strPur2")),
-           ("Sscrofa", "susScr2", UCSCGenome("susScr2")),
-           ("Sscrofa", "Scrofa9.58", EnsemblGenome("standard", "58", "58",
-               "Sus_scrofa", "Sscrofa9")),
-
-           # No (or incomplete) PerM indexes in the current snapshot
-           ("Tguttata", "taeGut1", UCSCGenome("taeGut1")),
-           ("Xtropicalis", "xenTro2", UCSCGenome("xenTro2")),
-           ("Ecaballus_Horse", "equCab2", UCSCGenome("equCab2")),
-           ("Drerio_Zebrafish", "danRer5", UCSCGenome("danRer5")),
-           ("Hsapiens", "hg19", UCSCGenome("hg19")),
-          ]
-
-lift_over_genomes = [g.ucsc_name() for (_, _, g) in genomes if g.ucsc_name()]
-#lift_over_genomes = ['hg18', 'hg19', 'mm9', 'xenTro2', 'rn4']
+# Indexers that can be requested for a genome, in the order they are built,
+# and the indexes each of them relies on.
+INDEXERS = ["bwa", "bowtie", "bowtie_color", "perm", "twobit", "sam", "srma"]
+INDEXER_REQUIRES = {"srma": ["sam"]}
+# Rough relative cost of each indexer per GB of sequence, used to balance
+# genomes across hosts in a sharded build.
+INDEXER_COSTS = {"bwa": 4.0, "bowtie": 3.0, "bowtie_color": 3.0, "perm": 0.1,
+                 "twobit": 0.2, "sam": 0.1, "srma": 0.3}
+
+def _load_genomes(catalog_file=None):
+    """Read the catalog of genomes to prepare from a YAML configuration file.
+    """
+    if catalog_file is None:
+        catalog_file = os.path.join("conf_files", "genomes.yaml")
+    with open(catalog_file) as in_handle:
+        catalog = yaml.safe_load(in_handle)
+    default_indexers = catalog.get("default_indexers", INDEXERS)
+    genomes = []
+    for item in catalog["genomes"]:
+        build = str(item["build"])
+        genomes.append(dict(organism=item["organism"], build=build,
+            manager=_genome_manager(build, item["source"]),
+            indexers=_check_indexers(item.get("indexers", default_indexers)),
+            priority=item.get("priority", 0),
+            size=float(item.get("size", 0))))
+    return genomes
+
+def _genome_manager(build, source):
+    """Create the download helper described by a catalog source entry.
+    """
+    source_type = source["type"]
+    if source_type == "ucsc":
+        return UCSCGenome(source.get("name", build))
+    elif source_type == "ncbi":
+        return NCBIRest(str(source.get("name", build)), source["refs"])
+    elif source_type == "ensembl":
+        return EnsemblGenome(source["section"], source["release"],
+                source.get("release2"), source["organism"], source["name"])
+    elif source_type == "broad":
+        return BroadGenome(source["target"])
+    raise ValueError("Unknown genome source type for %s: %s" % (build,
+        source_type))
+
+def _check_indexers(indexers):
+    """Validate indexer names, adding any indexers they depend on.
+    """
+    unknown = [i for i in indexers if i not in INDEXERS]
+    if unknown:
+        raise ValueError("Unknown indexers %s; available: %s" % (
+            ", ".join(unknown), ", ".join(INDEXERS)))
+    wanted = set(indexers)
+    for indexer in indexers:
+        wanted.update(INDEXER_REQUIRES.get(indexer, []))
+    return [i for i in INDEXERS if i in wanted]
+
+def _select_genomes(genomes, targets=None, max_size=None):
+    """Choose the genomes and indexes to build.
+
+    targets is a ';' separated list of selectors, each a build or organism
+    name optionally followed by the indexers to build for it, for example
+    'hg19:bwa+sam;mm9'. Without indexers a selector builds those listed in
+    the catalog. max_size skips genomes larger than the given size in GB.
+    Raises ValueError if a selector matches no genome in the catalog.
+    """
+    selectors = []
+    if targets:
+        for target in targets.split(";"):
+            if not target.strip():
+                continue
+            name, _, indexers = target.strip().partition(":")
+            indexers = [i for i in indexers.replace("+", ",").split(",") if i]
+            selectors.append((name, indexers))
+    known = set([g["build"] for g in genomes] + [g["organism"] for g in genomes])
+    unmatched = [n for (n, i) in selectors if n not in known]
+    if unmatched:
+        raise ValueError("No genome in the catalog matches %s" % ", ".join(unmatched))
+    selected = []
+    for genome in genomes:
+        if max_size is not None and genome["size"] > float(max_size):
+            continue
+        indexers = genome["indexers"]
+        if selectors:
+            matches = [i for (n, i) in selectors
+                       if n in [genome["build"], genome["organism"]]]
+            if not matches:
+                continue
+            if not [i for i in matches if not i]:
+                indexers = _check_indexers(reduce(operator.add, matches))
+        selected.append(dict(genome, indexers=indexers))
+    selected.sort(key=lambda g: g["priority"])
+    return selected
 
 # -- Fabric instructions
 
-def install_data():
+def install_data(targets=None, max_size=None):
     """Main entry point for installing useful biological data.
+
+    Builds all genomes in conf_files/genomes.yaml by default. Pass targets
+    to build a subset, for example:
+        fab -f data_fabfile.py install_data:targets="hg19:bwa+sam;mm9"
+        fab -f data_fabfile.py install_data:max_size=1
     """
     amazon_ec2()
     #local_server()
+    genomes = _select_genomes(_load_genomes(), targets, max_size)
     _setup_bxpy()
-    #_data_uniref()
-    _data_ngs_genomes()
-    _data_liftover()
-    # NOTE: The pairwise method is incomplete (see below)
-    #_data_pairwise()
+    if env.install_uniref:
+        _data_uniref()
+    _data_ngs_genomes(genomes)
+    _data_liftover(genomes)
+    if env.install_pairwise:
+        _data_pairwise(genomes)
+
+@runs_once
+def install_data_sharded(target, targets=None, max_size=None):
+    """Build genomes concurrently on several hosts and collect them on one.
+
+    The selected genomes are divided between the hosts given with -H,
+    balanced by estimated indexing cost, and each host builds its share.
+    The finished genome directories are then copied onto the target host,
+    the loc files from all hosts are merged there and a manifest recording
+    which host built what is written next to the data:
+        fab -f data_fabfile.py -H host1,host2,host3 install_data_sharded:target=host4
+
+    The target pulls data directly from the build hosts over SSH using the
+    forwarded agent, so the key used for the build hosts must be loaded in
+    the local ssh-agent.
+    """
+    amazon_ec2()
+    hosts = list(env.hosts)
+    genomes = _select_genomes(_load_genomes(), targets, max_size)
+    partitions, costs = _partition_genomes(genomes, hosts)
+    env.genome_partitions = dict((h, [g["build"] for g in partitions[h]])
+                                 for h in hosts)
+    for host in hosts:
+        print("%s (estimated cost %.1f): %s" % (host, costs[host],
+              ", ".join(env.genome_partitions[host])))
+    build_logs = execute(_build_partition, targets, max_size, hosts=hosts)
+    with settings(host_string=target):
+        _collect_partitions(build_logs)
+        _merge_loc_files(hosts)
+        _data_liftover(genomes)
+        _write_build_manifest(target, build_logs, costs)
 
 # == Decorators and context managers
 
@@ -281,50 +383,81 @@ def _make_tmp_dir():
 
 # == NGS
 
-def _data_ngs_genomes():
+def _data_ngs_genomes(genomes):
     """Download and create index files for next generation genomes.
+
+    Returns a record of each genome built and how long it took.
     """
     genome_dir = os.path.join(env.data_files, "genomes")
     if not exists(genome_dir):
         run('mkdir %s' % genome_dir)
-    for organism, genome, manager in genomes:
+    build_log = []
+    for genome_info in genomes:
+        organism = genome_info["organism"]
+        genome = genome_info["build"]
+        indexers = genome_info["indexers"]
+        time_start = datetime.datetime.utcnow()
         cur_dir = os.path.join(genome_dir, organism, genome)
         if not exists(cur_dir):
             run('mkdir -p %s' % cur_dir)
+        indexes = {}
         with cd(cur_dir):
             if env.remove_old_genomes:
                 _clean_genome_directory()
             seq_dir = 'seq'
-            ref_file, base_zips = manager.download(seq_dir)
+            ref_file, base_zips = genome_info["manager"].download(seq_dir)
             ref_file = _move_seq_files(ref_file, base_zips, seq_dir)
-            bwa_index = _index_bwa(ref_file)
-            bowtie_index = _index_bowtie(ref_file)
-            bowtie_color_index = _index_bowtie_color(ref_file)
+            if env.compress_refs:
+                _uncompress_ref(ref_file, indexers)
+            if "bwa" in indexers:
+                indexes["bwa"] = _index_bwa(ref_file)
+            if "bowtie" in indexers:
+                indexes["bowtie"] = _index_bowtie(ref_file)
+            if "bowtie_color" in indexers:
+                indexes["bowtie_color"] = _index_bowtie_color(ref_file)
             #maq_index = _index_maq(ref_file)
             #_index_novoalign(ref_file)
-            perm_base_index = _index_perm(ref_file)
-            perm_color_index = _index_perm(ref_file, color=True)
-            twobit_index = _index_twobit(ref_file)
-            _chrom_length(ref_file)
+            if "perm" in indexers:
+                indexes["perm_base"] = _index_perm(ref_file)
+                indexes["perm_color"] = _index_perm(ref_file, color=True)
+            if "twobit" in indexers:
+                indexes["twobit"] = _index_twobit(ref_file)
+                _chrom_length(ref_file)
             #_index_eland(ref_file)
             # other indexers not supported by default
             if False:
                 bfast_index = _index_bfast(ref_file)
                 arachne_index = _index_arachne(ref_file)
-            with cd(seq_dir):
-                sam_index = _index_sam(ref_file)
+            # With compressed storage the uncompressed sam index is only
+            # kept for srma.
+            if "sam" in indexers and \
+                    (not env.compress_refs or "srma" in indexers):
+                with cd(seq_dir):
+                    indexes["sam"] = _index_sam(ref_file)
             # srma needs the sam index.
-            srma_index = _index_srma(ref_file)
-        for ref_index_file, cur_index, prefix, new_style in [
-                ("sam_fa_indices.loc", sam_index, "index", False),
-                ("srma_index.loc", srma_index, "", True),
-                ("alignseq.loc", twobit_index, "seq", False),
-                ("twobit.loc", twobit_index, "", False),
-                ("bowtie_indices.loc", bowtie_index, "", True),
-                ("bowtie_indices_color.loc", bowtie_color_index, "", True),
-                ("bwa_index.loc", bwa_index, "", True),
-                ("lastz_seqs.loc", twobit_index, "", True),
+            if "srma" in indexers:
+                indexes["srma"] = _index_srma(ref_file)
+            if env.compress_refs:
+                compressed_ref = _compress_ref(ref_file, base_zips,
+                        keep_uncompressed="srma" in indexers)
+                if compressed_ref and "sam" in indexers:
+                    indexes["sam"] = compressed_ref
+                elif "sam" in indexers and "sam" not in indexes:
+                    # Compression failed and the uncompressed reference is
+                    # kept, so index that instead
+                    with cd(seq_dir):
+                        indexes["sam"] = _index_sam(ref_file)
+        for ref_index_file, index_name, prefix, new_style in [
+                ("sam_fa_indices.loc", "sam", "index", False),
+                ("srma_index.loc", "srma", "", True),
+                ("alignseq.loc", "twobit", "seq", False),
+                ("twobit.loc", "twobit", "", False),
+                ("bowtie_indices.loc", "bowtie", "", True),
+                ("bowtie_indices_color.loc", "bowtie_color", "", True),
+                ("bwa_index.loc", "bwa", "", True),
+                ("lastz_seqs.loc", "twobit", "", True),
                 ]:
+            cur_index = indexes.get(index_name)
             if cur_index:
                 str_parts = [genome, os.path.join(cur_dir, cur_index)]
                 if new_style:
@@ -332,13 +465,19 @@ def _data_ngs_genomes():
                 if prefix:
                     str_parts.insert(0, prefix)
                 _update_loc_file(ref_index_file, str_parts)
-        for ref_index_file, cur_index in [
-                ("perm_base_index.loc", perm_base_index),
-                ("perm_color_index.loc", perm_color_index),
+        for ref_index_file, index_name in [
+                ("perm_base_index.loc", "perm_base"),
+                ("perm_color_index.loc", "perm_color"),
                 ]:
+            cur_index = indexes.get(index_name)
             if cur_index:
                 for str_parts in [[e[0], e[0], os.path.join(cur_dir, e[1])] for e in cur_index]:
                     _update_loc_file(ref_index_file, str_parts)
+        time_end = datetime.datetime.utcnow()
+        build_log.append(dict(organism=organism, build=genome,
+                              indexers=indexers, start=str(time_start),
+                              duration=str(time_end - time_start)))
+    return build_log
 
 def _clean_genome_directory():
     """Remove any existing sequence information in the current directory.
@@ -356,9 +495,73 @@ def _move_seq_files(ref_file, base_zips, seq_dir):
             run("mv %s %s" % (move_file, seq_dir))
     path, fname = os.path.split(ref_file)
     moved_ref = os.path.join(path, seq_dir, fname)
-    assert exists(moved_ref), moved_ref
+    assert exists(moved_ref) or exists(moved_ref + ".gz.gzi"), moved_ref
     return moved_ref
 
+# Directories holding the output of indexers that read the uncompressed
+# reference when they are built.
+INDEX_DIRS = {"bwa": "bwa", "bowtie": "bowtie", "bowtie_color": "bowtie_color",
+              "twobit": "ucsc", "srma": "srma"}
+
+def _uncompress_ref(ref_file, indexers):
+    """Restore the uncompressed reference when an index still needs building.
+    """
+    if exists(ref_file) or not exists(ref_file + ".gz"):
+        return
+    missing = [i for i in indexers
+               if i in INDEX_DIRS and not exists(INDEX_DIRS[i])]
+    if missing or "srma" in indexers:
+        run("bgzip -dc %s.gz > %s" % (ref_file, ref_file))
+
+def _compress_ref(ref_file, base_zips, keep_uncompressed=False):
+    """Store a reference as BGZF compressed FASTA with samtools indexes.
+
+    The compressed copy is checked against the original before the
+    downloaded archives, and the uncompressed FASTA unless it is still
+    needed, are removed; links to the removed FASTA in the index
+    directories are removed with it. Returns the compressed reference,
+    or None if it could not be verified.
+    """
+    seq_dir = os.path.dirname(ref_file)
+    gz_file = ref_file + ".gz"
+    with settings(hide('running', 'stdout')):
+        size_before = int(run("du -sb %s | cut -f1" % seq_dir))
+    if not exists(gz_file + ".gzi"):
+        run("bgzip -c %s > %s.tmp" % (ref_file, gz_file))
+        run("mv %s.tmp %s" % (gz_file, gz_file))
+        with settings(warn_only=True):
+            result = run("samtools faidx %s" % gz_file)
+        if result.failed:
+            run("rm -f %s %s.fai %s.gzi" % (gz_file, gz_file, gz_file))
+            return None
+    if exists(ref_file):
+        with settings(warn_only=True):
+            result = run('[ "$(bgzip -dc %s | md5sum)" = "$(md5sum < %s)" ]'
+                         % (gz_file, ref_file))
+        if result.failed:
+            print("Compressed copy of %s does not match; keeping the "
+                  "original" % ref_file)
+            run("rm -f %s %s.fai %s.gzi" % (gz_file, gz_file, gz_file))
+            return None
+    # UCSC's <build>.fa.gz download has the same name as the compressed
+    # reference and has been replaced by it.
+    for zipped_file in [z for z in base_zips
+                        if os.path.join(seq_dir, z) != gz_file]:
+        run("rm -f %s" % os.path.join(seq_dir, zipped_file))
+    if not keep_uncompressed:
+        run("rm -f %s %s.fai" % (ref_file, ref_file))
+        # Index directories may link to the removed FASTA; drop those links
+        # rather than leave them dangling
+        index_dirs = [d for d in sorted(set(INDEX_DIRS.values())) if exists(d)]
+        if index_dirs:
+            run("find %s -maxdepth 1 -xtype l -lname '*%s*' -delete"
+                % (" ".join(index_dirs), os.path.basename(ref_file)))
+    with settings(hide('running', 'stdout')):
+        size_after = int(run("du -sb %s | cut -f1" % seq_dir))
+    print("%s: compressed storage saved %.1f MB" % (ref_file,
+          (size_before - size_after) / 1048576.0))
+    return gz_file
+
 def _update_loc_file(ref_file, line_parts):
     """Add a reference to the given genome to the base index file.
     """
@@ -582,17 +785,21 @@ def _index_eland(ref_file):
 
 # == Liftover files
 
-def _data_liftover():
+def _data_liftover(genomes):
     """Download chain files for running liftOver.
 
-    Does not install liftOver binaries automatically.
+    Chains are retrieved from each of the given genomes to every other UCSC
+    genome in the catalog. Does not install liftOver binaries automatically.
     """
+    lift_over_genomes = [g["manager"].ucsc_name() for g in _load_genomes()
+                         if g["manager"].ucsc_name()]
     lo_dir = os.path.join(env.data_files, "liftOver")
     if not exists(lo_dir):
         run("mkdir %s" % lo_dir)
     lo_base_url = "ftp://hgdownload.cse.ucsc.edu/goldenPath/%s/liftOver/%s"
     lo_base_file = "%sTo%s.over.chain.gz"
-    for g1 in lift_over_genomes:
+    for g1 in [g["manager"].ucsc_name() for g in genomes
+               if g["manager"].ucsc_name()]:
         for g2 in [g for g in lift_over_genomes if g != g1]:
             g2u = g2[0].upper() + g2[1:]
             cur_file = lo_base_file % (g1, g2u)
@@ -629,46 +836,98 @@ def _setup_bxpy():
 
 # == Pairwise alignments
 
-def _data_pairwise():
+def _data_pairwise(genomes):
+    """Download pairwise alignments between the prepared UCSC genomes.
+    """
     genome_dir = os.path.join(env.data_files, "genomes")
-    for organism, genome, manager in [(o, g, m) for (o, g, m) in genomes if m.ucsc_name()]:
-        cur_dir = os.path.join(genome_dir, organism, genome)
+    ucsc_genomes = [(g["organism"], g["build"], g["manager"].ucsc_name())
+                    for g in _load_genomes() if g["manager"].ucsc_name()]
+    for genome_info in genomes:
+        ucsc_name = genome_info["manager"].ucsc_name()
+        if not ucsc_name:
+            continue
+        cur_dir = os.path.join(genome_dir, genome_info["organism"],
+                               genome_info["build"])
         with cd(cur_dir):
-            _fetch_pairwise(manager.ucsc_name())
+            _fetch_pairwise(ucsc_name, cur_dir, ucsc_genomes)
+
+def _fetch_pairwise(ucsc_name, cur_dir, ucsc_genomes):
+    """Download pairwise alignments and convert them to indexed MAF files.
 
-def _fetch_pairwise(ucsc_name):
-    """Download pairwise alignments."""
+    The axtNet files are kept compressed and streamed through axt_to_maf,
+    so conversion never needs the uncompressed alignments on disk.
+    """
     dir_name = "pairwise"
+    genome_dir = os.path.join(env.data_files, "genomes")
     base_url = "rsync://hgdownload.cse.ucsc.edu/goldenPath/%s/" % ucsc_name
     if not exists(dir_name):
         run("mkdir %s" % dir_name)
     with settings(warn_only=True):
         result = run("rsync %s" % base_url)
-    if not result.failed:
-        available = []
-        for line in result.split('\n'):
-            if line.split()[-1].startswith('vs'):
-                vs_name = line.split()[-1].replace('vs', '', 1)
-                vs_name = vs_name[0].lower() + vs_name[1:]
-                available.append( vs_name )
-        for org, gen, name in [(o, g, m.ucsc_name()) for (o, g, m) in genomes if m.ucsc_name()]:
-            subdir_name = os.path.join(dir_name, name)
-            if name in available and not exists(subdir_name):
-                url = base_url + 'vs' + name[0].upper() + name[1:] + '/axtNet'
-                with settings(warn_only=True):
-                    result = run("rsync %s" % url)
-                if not result.failed:
-                    run("mkdir %s" % subdir_name)
-                    with cd(subdir_name):
-                        url += '/'
-                        run("rsync -avP %s ." % url)
-                        run("gunzip *.gz")
-                        for axt in glob("*.axt"):
-                            maf = axt.replace('.axt','.maf')
-                            b1_length = os.path.join('..', 'seq', '%s.len' % ucsc_name)
-                            b2_length = os.path.join('..', '..', '..', org, gen, 'seq', '%s.len' % name)
-                            run("/tmp/axt_to_maf.py %s:%s %s:%s < %s > %s" % (ucsc_name, b1_length, name, b2_length, axt, maf))
-                            # TODO: finish writing this method...
+    if result.failed:
+        return
+    available = []
+    for line in result.split('\n'):
+        parts = line.split()
+        if parts and parts[-1].startswith('vs'):
+            vs_name = parts[-1].replace('vs', '', 1)
+            vs_name = vs_name[0].lower() + vs_name[1:]
+            available.append(vs_name)
+    b1_length = os.path.join(cur_dir, 'seq', '%s.len' % ucsc_name)
+    for org, gen, name in ucsc_genomes:
+        if name == ucsc_name or name not in available:
+            continue
+        b2_length = os.path.join(genome_dir, org, gen, 'seq', '%s.len' % name)
+        # axt_to_maf needs chromosome lengths for both genomes
+        if not (exists(b1_length) and exists(b2_length)):
+            continue
+        subdir_name = os.path.join(dir_name, name)
+        url = base_url + 'vs' + name[0].upper() + name[1:] + '/axtNet/'
+        if not exists(subdir_name):
+            run("mkdir %s" % subdir_name)
+        with cd(subdir_name):
+            # --partial lets an interrupted transfer resume where it stopped
+            with settings(warn_only=True):
+                result = run("rsync -avP --partial --include='*.axt.gz' "
+                             "--exclude='*' %s ." % url)
+            if result.failed:
+                continue
+            _axt_to_maf(ucsc_name, b1_length, name, b2_length)
+            mafs = run("ls *.maf 2>/dev/null || true").split()
+        if mafs:
+            maf_paths = [os.path.join(cur_dir, subdir_name, m) for m in mafs]
+            _update_loc_file("maf_index.loc",
+                    ["%s to %s pairwise" % (ucsc_name, name),
+                     "%s_%s" % (ucsc_name, name),
+                     "%s,%s" % (ucsc_name, name), # builds
+                     "%s,%s" % (ucsc_name, name), # species
+                     ",".join(maf_paths)])
+
+def _axt_to_maf(b1_name, b1_length, b2_name, b2_length):
+    """Convert each axt.gz in the current directory to an indexed MAF file.
+
+    Chromosomes are converted in parallel, one job per processor. Output
+    is written to a temporary name and moved into place once complete, so
+    a rerun skips finished chromosomes and redoes only partial ones.
+    """
+    convert = ("maf=${1%%.axt.gz}.maf; "
+               "[ -s $maf.index ] && exit 0; "
+               "if [ ! -s $maf ]; then "
+               "gunzip -c $1 | /tmp/axt_to_maf.py %s:%s %s:%s > $maf.tmp "
+               "&& mv $maf.tmp $maf || exit 1; fi; "
+               "/tmp/maf_build_index.py $maf $maf.index.tmp "
+               "&& mv $maf.index.tmp $maf.index" %
+               (b1_name, b1_length, b2_name, b2_length))
+    run("ls *.axt.gz 2>/dev/null | xargs -r -n 1 -P %s bash -o pipefail -c '%s' axt_to_maf"
+        % (_num_cores(), convert))
+
+def _num_cores():
+    """Number of processors on the remote machine, for sizing parallel jobs.
+    """
+    if not env.get("num_cores"):
+        with settings(hide('running', 'stdout')):
+            env.num_cores = int(run("grep -c ^processor /proc/cpuinfo"))
+    return env.num_cores
 
 # == UniRef
 def _data_uniref():
@@ -676,10 +935,10 @@ def _data_uniref():
 
     http://www.ebi.ac.uk/uniref/
 
-    These are currently indexed for FASTA searches. Are other indexes desired?
-    Should this be separated out and organized by program like genome data?
-    This should also check the release note and automatically download and
-    replace older versions.
+    The release note is checked first, and a database is only downloaded
+    and rebuilt when the release differs from the one already indexed.
+    These are currently indexed for BLAST searches. Should this be
+    separated out and organized by program like genome data?
     """
     site = "ftp://ftp.uniprot.org"
     base_url = site + "/pub/databases/uniprot/" \
@@ -690,13 +949,78 @@ def _data_uniref():
             run("mkdir -p %s" % work_dir)
         base_work_url = base_url % (uniref_db, uniref_db)
         fasta_url = base_work_url + ".fasta.gz"
-        base_file = os.path.splitext(os.path.basename(fasta_url))[0]
+        fasta_gz = os.path.basename(fasta_url)
+        release_note = "%s.release_note" % uniref_db
+        pending_note = "%s.pending" % release_note
         with cd(work_dir):
-            if not exists(base_file):
-                run("wget -c %s" % fasta_url)
-                run("gunzip %s" % os.path.basename(fasta_url))
-                run("wget %s" % (base_work_url + ".release_note"))
-        _index_blast_db(work_dir, base_file, "prot")
+            run("wget -q -O %s.latest %s" % (release_note,
+                base_work_url + ".release_note"))
+            if exists("%s.indexed" % uniref_db) and \
+                    _same_file("%s.latest" % release_note, release_note):
+                run("rm -f %s.latest" % release_note)
+                continue
+            # A pending note matching the latest release means an earlier
+            # download of the same release was interrupted; keep it so
+            # wget -c can resume it.
+            if _same_file("%s.latest" % release_note, pending_note):
+                run("rm -f %s.latest" % release_note)
+            else:
+                run("rm -f %s" % fasta_gz)
+                run("mv %s.latest %s" % (release_note, pending_note))
+            run("wget -c %s" % fasta_url)
+        _index_blast_db_volumes(work_dir, fasta_gz, "prot")
+        with cd(work_dir):
+            run("mv %s %s" % (pending_note, release_note))
+
+def _same_file(file1, file2):
+    """Check if two remote files exist and have identical contents.
+    """
+    with settings(hide('warnings', 'running', 'stdout', 'stderr'),
+                  warn_only=True):
+        result = run("cmp -s %s %s" % (file1, file2))
+    return result.succeeded
+
+def _index_blast_db_volumes(work_dir, fasta_gz, db_type, num_volumes=None):
+    """Index a gzipped FASTA database as blast+ volumes built in parallel.
+
+    The FASTA is decompressed as a stream, with pigz when it is installed,
+    and records are dealt round-robin into volumes. makeblastdb indexes
+    the volumes concurrently and an alias file joins them into a single
+    database. With one volume this falls back to _index_blast_db.
+    Either way, a <db_name>.indexed marker is written once the database
+    is complete, so an interrupted build is not mistaken for a finished one.
+    """
+    type_to_alias = dict(prot = "pal", nucl = "nal")
+    if num_volumes is None:
+        num_volumes = env.get("blast_db_volumes") or _num_cores()
+    base_file = os.path.splitext(fasta_gz)[0]
+    db_name = os.path.splitext(base_file)[0]
+    marker = "%s.indexed" % db_name
+    with cd(work_dir):
+        run("rm -f %s" % marker)
+        with settings(hide('running', 'stdout')):
+            unzip = "pigz -dc" if run("command -v pigz || true").strip() \
+                    else "gzip -dc"
+        # Drop the database files of an older release, which would
+        # otherwise make _index_blast_db skip the build
+        run("rm -f %s.%s?? %s.[0-9][0-9].*" % (db_name, db_type[0], db_name))
+        if num_volumes <= 1:
+            run("%s %s > %s" % (unzip, fasta_gz, base_file))
+            _index_blast_db(work_dir, base_file, db_type)
+            run("echo '%s' > %s" % (db_name, marker))
+            return
+        volumes = ["%s.%02d" % (db_name, i) for i in range(num_volumes)]
+        run("%s %s | awk -v base=%s -v n=%s '/^>/ {v = (v + 1) %% n} "
+            "{print > (sprintf(\"%%s.%%02d.fasta\", base, v))}'" %
+            (unzip, fasta_gz, db_name, num_volumes))
+        run("ls %s.[0-9][0-9].fasta | xargs -n 1 -P %s bash -c "
+            "'makeblastdb -in $1 -dbtype %s -out ${1%%.fasta} && rm -f $1' "
+            "makeblastdb" % (db_name, _num_cores(), db_type))
+        alias_file = "%s.%s" % (db_name, type_to_alias[db_type])
+        run("echo 'TITLE %s' > %s.tmp" % (db_name, alias_file))
+        run("echo 'DBLIST %s' >> %s.tmp" % (" ".join(volumes), alias_file))
+        run("mv %s.tmp %s" % (alias_file, alias_file))
+        run("echo '%s' > %s" % (" ".join(volumes), marker))
 
 def _index_blast_db(work_dir, base_file, db_type):
     """Index a database using blast+ for similary searching.
@@ -709,6 +1033,103 @@ def _index_blast_db(work_dir, base_file, db_type):
             run("makeblastdb -in %s -dbtype %s -out %s" %
                     (base_file, db_type, db_name))
 
+# == Sharded builds
+
+def _genome_cost(genome):
+    """Estimate the relative cost of building the indexes for a genome.
+    """
+    return genome["size"] * sum(INDEXER_COSTS.get(i, 1.0)
+                                for i in genome["indexers"])
+
+def _partition_genomes(genomes, hosts):
+    """Divide genomes between hosts so each has a similar build cost.
+
+    Genomes are handed out most expensive first, each to the host with the
+    least work assigned so far, and then ordered by priority on each host.
+    """
+    partitions = dict((h, []) for h in hosts)
+    costs = dict((h, 0.0) for h in hosts)
+    for genome in sorted(genomes, key=_genome_cost, reverse=True):
+        host = min(hosts, key=lambda h: (costs[h], hosts.index(h)))
+        partitions[host].append(genome)
+        costs[host] += _genome_cost(genome)
+    for host in hosts:
+        partitions[host].sort(key=lambda g: g["priority"])
+    return partitions, costs
+
+@parallel
+def _build_partition(targets, max_size):
+    """Build the genomes assigned to the current host.
+    """
+    amazon_ec2()
+    builds = env.genome_partitions[env.host_string]
+    genomes = [g for g in _select_genomes(_load_genomes(), targets, max_size)
+               if g["build"] in builds]
+    _setup_bxpy()
+    return _data_ngs_genomes(genomes)
+
+def _collect_partitions(build_logs):
+    """Copy genome directories built on other hosts onto the current host.
+    """
+    for host, build_log in sorted(build_logs.items()):
+        if host == env.host_string:
+            continue
+        source = host if "@" in host else "%s@%s" % (env.user, host)
+        for genome in build_log:
+            cur_dir = os.path.join(env.data_files, "genomes",
+                                   genome["organism"], genome["build"])
+            run("mkdir -p %s" % cur_dir)
+            with settings(forward_agent=True):
+                run("rsync -a -e 'ssh -o StrictHostKeyChecking=no' %s:%s/ %s/"
+                    % (source, cur_dir, cur_dir))
+
+def _merge_loc_files(hosts):
+    """Merge the loc files from every build host into the current host.
+
+    Comment lines are kept in the order first seen and entries are sorted,
+    so the merged files do not depend on which host finished first.
+    """
+    tools_dir = os.path.join(env.galaxy_base, "tool-data")
+    local_dir = tempfile.mkdtemp()
+    target = env.host_string
+    for host in sorted(set(hosts + [target])):
+        with settings(host_string=host, warn_only=True):
+            get(os.path.join(tools_dir, "*.loc"),
+                os.path.join(local_dir, "%(host)s", "%(path)s"))
+    merged = {}
+    for host_dir in sorted(os.listdir(local_dir)):
+        for loc_file in sorted(os.listdir(os.path.join(local_dir, host_dir))):
+            comments, entries = merged.setdefault(loc_file, ([], set()))
+            with open(os.path.join(local_dir, host_dir, loc_file)) as in_handle:
+                for line in in_handle:
+                    line = line.rstrip("\r\n")
+                    if line.startswith("#"):
+                        if line not in comments:
+                            comments.append(line)
+                    elif line.strip():
+                        entries.add(line)
+    run("mkdir -p %s" % tools_dir)
+    for loc_file, (comments, entries) in sorted(merged.items()):
+        out_file = os.path.join(local_dir, loc_file)
+        with open(out_file, "w") as out_handle:
+            for line in comments + sorted(entries):
+                out_handle.write("%s\n" % line)
+        put(out_file, os.path.join(tools_dir, loc_file))
+    local("rm -rf %s" % local_dir)
+
+def _write_build_manifest(target, build_logs, costs):
+    """Record which host built each genome, and how long it took.
+    """
+    manifest = dict(target=target, finished=str(datetime.datetime.utcnow()),
+                    hosts=dict((h, dict(estimated_cost=round(costs[h], 2),
+                                        genomes=build_logs[h]))
+                               for h in build_logs))
+    manifest_file = "data_build_manifest.yaml"
+    with open(manifest_file, "w") as out_handle:
+        yaml.safe_dump(manifest, out_handle, default_flow_style=False)
+    put(manifest_file, os.path.join(env.data_files, "build_manifest.yaml"))
+    print("Build manifest saved locally as %s" % manifest_file)
+
 # == Not used -- takes up too much space and time to index
 
 def _index_bfast(ref_file):
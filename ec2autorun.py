@@ -10,55 +10,230 @@ Assumptions:
 """
 
 import os, sys, yaml, urllib2, logging, hashlib, time, subprocess, random, glob
+import socket, threading, json, imp, re, shutil, signal
+import logging.handlers
+from collections import deque
+from contextlib import contextmanager
+from distutils.version import LooseVersion
 from urlparse import urlparse
 from tempfile import TemporaryFile
+
+BOTO_MIN_VERSION = '2.2.2' # 1.9 has a very different API, and CloudMan needs 2.2 (also read by mi_fabfile.py)
+VENDOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vendor') # Python packages bundled with the image
+
+def _installed_boto_version():
+    """Read the version of the installed boto from its source, without importing it"""
+    try:
+        boto_path = imp.find_module('boto')[1]
+        with open(os.path.join(boto_path, '__init__.py')) as f:
+            for line in f:
+                m = re.match(r"""^(?:__version__|Version)\s*=\s*['"]([^'"]+)['"]""", line)
+                if m:
+                    return m.group(1)
+    except (ImportError, IOError):
+        pass
+    return None
+
+def _use_vendored_boto():
+    """If the installed boto is missing or too old, put the copy bundled with the
+    image (see _install_boto in mi_fabfile.py) at the front of the import path.
+    Returns the path used, if any."""
+    version = _installed_boto_version()
+    if version and LooseVersion(version) >= LooseVersion(BOTO_MIN_VERSION):
+        return None
+    wheels = glob.glob(os.path.join(VENDOR_PATH, 'boto-*.whl'))
+    wheels.sort(key=lambda w: LooseVersion(os.path.basename(w).split('-')[1]))
+    if wheels:
+        sys.path.insert(0, wheels[-1])
+        return wheels[-1]
+    if os.path.isdir(os.path.join(VENDOR_PATH, 'boto')):
+        sys.path.insert(0, VENDOR_PATH)
+        return VENDOR_PATH
+    return None
+
+_vendored_boto = _use_vendored_boto()
 from boto.s3.connection import S3Connection, OrdinaryCallingFormat, SubdomainCallingFormat
 from boto.s3.key import Key
 from boto.exception import S3ResponseError, BotoServerError
 import boto # to get Version
+try: # Use the LibYAML bindings if PyYAML was built with them
+    from yaml import CSafeLoader as YAMLLoader, CSafeDumper as YAMLDumper
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader, SafeDumper as YAMLDumper
+import s3_transfer # installed next to this script
 logging.getLogger('boto').setLevel(logging.INFO) # Only log boto messages >=INFO
 
-USER_DATA_URL = 'http://169.254.169.254/latest/user-data'
+# The CM_* environment variables point this script at stand-in services (see boot_benchmark.py)
+METADATA_SERVER = os.environ.get('CM_METADATA_SERVER', 'http://169.254.169.254')
+USER_DATA_URL = '%s/latest/user-data' % METADATA_SERVER
+METADATA_URL = '%s/latest/meta-data/' % METADATA_SERVER
+METADATA_KEYS = ['local-hostname', 'local-ipv4', 'instance-id'] # Metadata fetched up front at boot
+METADATA_TIMEOUT = 2 # Seconds to wait for a single metadata service request
+METADATA_RETRIES = 3
 # USER_DATA_URL = 'http://userwww.service.emory.edu/~eafgan/content/userData.yaml.sample' # used for testing
 # USER_DATA_URL = 'http://userwww.service.emory.edu/~eafgan/content/url_ud.txt' # used for testing
-LOCAL_PATH = '/tmp/cm' # Local path destination used for storing/reading any files created by this script
+LOCAL_PATH = os.environ.get('CM_LOCAL_PATH', '/tmp/cm') # Local path destination used for storing/reading any files created by this script
 USER_DATA_FILE_NAME = 'userData.yaml' # Local file with user data formatted by this script
 USER_DATA_FILE = os.path.join(LOCAL_PATH, USER_DATA_FILE_NAME) 
 USER_DATA_ORIG = os.path.join(LOCAL_PATH, 'original_%s' % USER_DATA_FILE_NAME) # Local file containing user data in its original format
-S3_URL = 'http://s3.amazonaws.com/' # Default for Amazon's S3 - override in _handle_yaml(), based on s3_url in user-data 
+USER_DATA_JSON_FILE = os.path.join(LOCAL_PATH, 'userData.json') # Same content as USER_DATA_FILE, for consumers that do not parse YAML
+S3_URL = os.environ.get('CM_S3_URL', 'http://s3.amazonaws.com/') # Default for Amazon's S3 - override in _handle_yaml(), based on s3_url in user-data 
 DEFAULT_BUCKET_NAME = 'cloudman' # Ensure this bucket is accessible to anyone!
 DEFAULT_BOOT_SCRIPT_NAME = 'cm_boot.py' # Ensure this file is accessible to anyone in the public bucket!
 CLOUDMAN_HOME = '/mnt/cm'
+METADATA_CACHE_FILE = os.path.join(LOCAL_PATH, 'metadata.json') # Instance metadata cached for the current boot
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+BOOT_CACHE_PATH = os.environ.get('CM_BOOT_CACHE_PATH', '/var/cache/cloudman') # Boot artifacts kept across boots and revalidated with conditional requests
+BOOT_FETCH_TIMEOUT = 10 # Seconds to wait on the object store before falling back on a cached boot script
+BOOT_SCRIPT_LOG = os.path.join(LOCAL_PATH, 'cm_boot.log') # Output of the boot script, rotated at BOOT_SCRIPT_LOG_SIZE
+BOOT_SCRIPT_LOG_SIZE = 10 * 1024 * 1024
+BOOT_SCRIPT_STDERR_LINES = 50 # Lines of boot script stderr reported if the script fails
+BOOT_PHASE_MARKER = 'BOOT_PHASE ' # Boot script output lines starting with this mark the start of a named phase
+BOOT_TELEMETRY_FILE_NAME = 'boot_telemetry.json' # Boot phase timings, retries and bytes transferred; see boot_stats.py
+BOOT_TELEMETRY_FILE = os.path.join(LOCAL_PATH, BOOT_TELEMETRY_FILE_NAME)
+BOOT_TELEMETRY_PREFIX = 'boot_telemetry/' # Where in the cluster bucket telemetry is pushed when push_boot_telemetry is set
+HYDRATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hydrate_volume.py') # Prewarms volumes from snapshots
+HYDRATE_WAIT = 1800 # Seconds hydrate_volume.py waits for CloudMan to mount a volume listed in hydrate_volumes
+SANDBOX = os.environ.get('CM_SANDBOX', '') not in ('', '0') # Skip the steps that modify the system (hostname, logins, FreeNX)
+
+_metadata = {} # Instance metadata and user data fetched during this boot
+_boot_phases = [] # Dicts with the name, start, end and duration of each boot phase in the order phases finished
+_telemetry = {'retries': {}, 'bytes_fetched': 0, 'bytes_uploaded': 0} # Added to the boot telemetry file
+_telemetry_lock = threading.Lock()
+_telemetry_ud = None # User data of a cluster to push the boot telemetry to
+
+# ====================== Boot metadata ======================
+
+def _fetch_metadata_url(url):
+    """Fetch a metadata service URL with a short timeout and a few retries.
+    Returns the content, or None if the resource does not exist or cannot be
+    retrieved."""
+    for i in range(METADATA_RETRIES):
+        try:
+            fp = urllib2.urlopen(url, timeout=METADATA_TIMEOUT)
+            try:
+                return fp.read()
+            finally:
+                fp.close()
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return None
+            log.debug("Error fetching '%s', attempt %s/%s: %s" % (url, i+1, METADATA_RETRIES, e))
+        except (IOError, socket.error), e:
+            log.debug("Error fetching '%s', attempt %s/%s: %s" % (url, i+1, METADATA_RETRIES, e))
+        if i + 1 < METADATA_RETRIES:
+            _count_retries('metadata')
+        time.sleep(0.2 * 2**i)
+    return None
+
+def _get_boot_id():
+    try:
+        with open(BOOT_ID_FILE) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def _prefetch_metadata():
+    """Fetch user data and the instance metadata needed during boot
+    concurrently, and cache the metadata for the rest of this boot."""
+    boot_id = _get_boot_id()
+    if os.path.exists(METADATA_CACHE_FILE):
+        try:
+            with open(METADATA_CACHE_FILE) as f:
+                cached = json.load(f)
+            if boot_id and cached.get('boot_id') == boot_id:
+                _metadata.update([(key, value) for key, value in cached['metadata'].items() if value is not None])
+                log.debug("Using instance metadata cached in '%s'" % METADATA_CACHE_FILE)
+        except (IOError, ValueError, KeyError), e:
+            log.debug("Ignoring unreadable metadata cache '%s': %s" % (METADATA_CACHE_FILE, e))
+    urls = dict((key, METADATA_URL + key) for key in METADATA_KEYS if _metadata.get(key) is None)
+    urls['user-data'] = USER_DATA_URL
+    def fetch(key, url):
+        _metadata[key] = _fetch_metadata_url(url)
+    threads = [threading.Thread(target=fetch, args=item) for item in urls.items()]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    deadline = time.time() + METADATA_RETRIES * (METADATA_TIMEOUT + 1)
+    for t in threads:
+        t.join(max(0, deadline - time.time()))
+    # Values that could not be fetched are left out, so they are fetched again when needed
+    metadata = dict((key, _metadata[key]) for key in METADATA_KEYS if _metadata.get(key) is not None)
+    try:
+        with open(METADATA_CACHE_FILE, 'w') as f:
+            json.dump({'boot_id': boot_id, 'metadata': metadata}, f)
+    except IOError, e:
+        log.debug("Could not cache instance metadata: %s" % e)
+
+def _get_metadata(key):
+    """Return an instance metadata value, fetching it if it was not prefetched
+    (or could not be fetched before)."""
+    if _metadata.get(key) is None:
+        url = USER_DATA_URL if key == 'user-data' else METADATA_URL + key
+        _metadata[key] = _fetch_metadata_url(url)
+    return _metadata[key]
+
+def _record_boot_phase(name, start, end=None):
+    if end is None:
+        end = time.time()
+    _boot_phases.append({'name': name, 'start': start, 'end': end, 'duration': end - start})
+
+@contextmanager
+def _boot_phase(name):
+    """Time a phase of the boot process."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        _record_boot_phase(name, start)
+
+def _log_boot_phases():
+    log.info("Boot phase timings: %s" % ', '.join(["%s %.2fs" % (phase['name'], phase['duration'])
+        for phase in _boot_phases]))
+
+def _count_retries(what, count=1):
+    with _telemetry_lock:
+        _telemetry['retries'][what] = _telemetry['retries'].get(what, 0) + count
+
+def _record_transfer(what, stats):
+    """Add the stats of an s3_transfer download or upload to the boot telemetry"""
+    direction = 'bytes_uploaded' if 'parts' in stats else 'bytes_fetched'
+    with _telemetry_lock:
+        _telemetry[direction] += stats['bytes']
+    if stats['retries']:
+        _count_retries(what, stats['retries'])
+
+def _write_telemetry():
+    """Save the boot telemetry to BOOT_TELEMETRY_FILE and, if requested in the user
+    data, push it to the cluster bucket"""
+    telemetry = dict(_telemetry)
+    telemetry.update({'instance_id': _metadata.get('instance-id'),
+                      'hostname': _metadata.get('local-hostname'),
+                      'boot_id': _get_boot_id(),
+                      'phases': _boot_phases})
+    try:
+        with open(BOOT_TELEMETRY_FILE, 'w') as f:
+            json.dump(telemetry, f, indent=2)
+        log.debug("Saved boot telemetry to '%s'" % BOOT_TELEMETRY_FILE)
+    except IOError, e:
+        log.error("Could not save boot telemetry to '%s': %s" % (BOOT_TELEMETRY_FILE, e))
+        return
+    if _telemetry_ud is not None:
+        s3_conn = _get_s3_conn(_telemetry_ud)
+        if s3_conn is not None:
+            boot_start = time.gmtime(min([phase['start'] for phase in _boot_phases]))
+            remote_filename = '%s%s-%s.json' % (BOOT_TELEMETRY_PREFIX, telemetry['instance_id'],
+                time.strftime('%Y%m%d%H%M%S', boot_start))
+            _save_file_to_bucket(s3_conn, _telemetry_ud['bucket_cluster'], remote_filename,
+                BOOT_TELEMETRY_FILE_NAME, force=True)
 
 # ====================== Utility methods ======================
 
 def _get_self_private_ip():
-    self_private_ip = None
-    for i in range(0, 5):
-        try:
-            log.debug('Gathering instance private ip, attempt %s' % i)
-            fp = urllib2.urlopen('http://169.254.169.254/latest/meta-data/local-ipv4')
-            self_private_ip = fp.read()
-            fp.close()
-            if self_private_ip:
-                break
-        except IOError:
-            pass
-    return self_private_ip
+    return _get_metadata('local-ipv4')
 
 def _get_self_private_hostname():
-    self_private_hostname = None
-    for i in range(0, 5):
-        try:
-            log.debug('Gathering instance private hostname, attempt %s' % i)
-            fp = urllib2.urlopen('http://169.254.169.254/latest/meta-data/local-hostname')
-            self_private_hostname = fp.read()
-            fp.close()
-            if self_private_hostname:
-                break
-        except IOError:
-            pass
-    return self_private_hostname
+    return _get_metadata('local-hostname')
 
 def _is_ipv4(instr): # as taken from cloud-init
     """ determine if input string is a ipv4 address. return boolean"""
@@ -72,10 +247,11 @@ def _is_ipv4(instr): # as taken from cloud-init
     return (len(toks) == 4)    
 
 def _check_name_resolves(host):
-    dev_null=open('/dev/null','w')
-    host_not_found = subprocess.call( ('/bin/ping', '-c', '1', host), stdout=dev_null, stderr=dev_null) # only interested in return code
-    dev_null.close()
-    return not host_not_found
+    try:
+        socket.gethostbyname(host)
+        return True
+    except socket.error:
+        return False
 
 def _add_hostname_to_hosts():
     """Adds the hostname to /etc/hosts, if it is not being assigned by DNS -- required for rabbitmq
@@ -106,12 +282,18 @@ def _add_hostname_to_hosts():
 def _fix_hostname():
     """Checks that the hostname matches the private hostname from metadata, and updates /etc/hostname and /etc/hosts if
     it does not, and the hostname does not resolve"""
+    if SANDBOX:
+        log.info("Sandbox mode; not checking the hostname")
+        return
     hostname_file = open('/etc/hostname','r')
     hostname = hostname_file.readline().rstrip()
     hostname_file.close()
     if not _check_name_resolves(hostname):
         log.warning('Hostname "%s" does not resolve. Resetting hostname' % (hostname,))
         new_hostname=_get_self_private_hostname()
+        if not new_hostname:
+            log.error("Could not get the private hostname from instance metadata; not resetting the hostname")
+            return
         if _is_ipv4(new_hostname):
             new_hostname = "ip-%s" % new_hostname.replace(".", "-")
         log.warning('New hostname = %s' % (new_hostname,))
@@ -140,22 +322,16 @@ def _setup_logging():
 
 
 def _get_user_data():
-    ud = ''
-    for i in range(0, 5):
-        try:
-            log.info("Getting user data from '%s', attempt %s" % (USER_DATA_URL, i))
-            fp = urllib2.urlopen(USER_DATA_URL)
-            ud = fp.read()
-            fp.close()
-            log.debug("Saving user data in its original format to file '%s'" % USER_DATA_ORIG)
-            with open(USER_DATA_ORIG, 'w') as ud_orig:
-                ud_orig.write(ud)
-                if ud:
-                    log.debug("Got user data")
-                return ud
-        except IOError:
-            log.info("User data not found. Setting it to empty.")
-            return ''
+    log.info("Getting user data from '%s'" % USER_DATA_URL)
+    ud = _get_metadata('user-data')
+    if ud is None:
+        log.info("User data not found. Setting it to empty.")
+        return ''
+    log.debug("Saving user data in its original format to file '%s'" % USER_DATA_ORIG)
+    with open(USER_DATA_ORIG, 'w') as ud_orig:
+        ud_orig.write(ud)
+    if ud:
+        log.debug("Got user data")
     # Used for testing
     # return 'http://s3.amazonaws.com/cloudman/cm_boot'
     # return ''
@@ -188,11 +364,76 @@ def _guess_cloud_type(ud):
     # s3 paths including 'Walrus' are going to be eucalyptus
     if ('s3_url' in ud and 'Walrus' in ud['s3_url']) or ('s3_conn_path' in ud and 'Walrus' in ud['s3_conn_path']):
         cloud_type = 'eucalyptus'
-    elif '.novalocal' in _get_self_private_hostname():
+    elif '.novalocal' in (_get_self_private_hostname() or ''):
         cloud_type = 'openstack'
     # TODO add guesses for other cloud types
     return cloud_type
 
+def _random_cluster_name(ud):
+    return 'aCloudManCluster_%s' % random.randrange(1, 9999999)
+
+def _default_bucket_cluster(ud):
+    if ud['access_key'] is not None and ud['secret_key'] is not None:
+        return _get_bucket_name(ud['cluster_name'], ud['access_key'])
+    return None
+
+# Fields CloudMan expects in user data, in the order they are filled in:
+#   default: value used when the field is missing (or empty, if 'empty' is set). If
+#            callable, it is called with the user data; returning None leaves the field unset
+#   missing: level at which a missing field is logged
+#   empty:   level at which an empty field ('' or None) is logged and replaced with the
+#            default; if not set, empty values are kept
+#   convert: applied to values that are provided
+USER_DATA_SCHEMA = [
+    {'field': 'cluster_name', 'default': _random_cluster_name, 'missing': logging.WARNING, 'empty': logging.WARNING},
+    {'field': 'access_key', 'default': None, 'missing': logging.INFO, 'empty': logging.WARNING},
+    {'field': 'secret_key', 'default': None, 'missing': logging.INFO, 'empty': logging.WARNING},
+    {'field': 'password', 'missing': logging.WARNING, 'empty': logging.WARNING, 'convert': str},
+    {'field': 'bucket_default', 'default': DEFAULT_BUCKET_NAME, 'missing': logging.DEBUG, 'empty': logging.WARNING},
+    {'field': 'bucket_cluster', 'default': _default_bucket_cluster},
+    {'field': 'role', 'default': 'master'},
+    {'field': 'cloudman_home', 'default': CLOUDMAN_HOME},
+    {'field': 'boot_script_name', 'default': DEFAULT_BOOT_SCRIPT_NAME},
+    {'field': 'cloud_type', 'default': _guess_cloud_type}, # after the URLs are split
+]
+# URL fields split into (host, port, path, is_secure) fields, e.g. to point at Eucalyptus
+USER_DATA_URLS = [('s3_url', ('s3_host', 's3_port', 's3_conn_path', 'is_secure')),
+                  ('ec2_url', ('ec2_host', 'ec2_port', 'ec2_conn_path', 'ec2_is_secure'))]
+
+def _normalize_user_data(ud):
+    """Return a copy of user data (a dict) with the URLs in USER_DATA_URLS split into
+    their component fields and the fields in USER_DATA_SCHEMA filled in. Fields not in
+    the schema are passed through unchanged."""
+    ud = dict(ud)
+    for url_field, (host, port, path, is_secure) in USER_DATA_URLS:
+        if url_field in ud:
+            url = urlparse(ud[url_field])
+            ud[host] = url.hostname
+            ud[port] = url.port
+            ud[path] = url.path
+            ud[is_secure] = url.scheme == 'https'
+    for spec in USER_DATA_SCHEMA:
+        field = spec['field']
+        if field in ud:
+            if ud[field] in ('', None) and 'empty' in spec:
+                log.log(spec['empty'], "The %s field of user data should not be empty." % field)
+            elif ud[field] in ('', None) or 'convert' not in spec:
+                continue
+            else:
+                ud[field] = spec['convert'](ud[field])
+                continue
+        elif 'missing' in spec:
+            log.log(spec['missing'], "The provided user data does not contain %s field." % field)
+        if 'default' in spec:
+            default = spec['default']
+            if callable(default):
+                default = default(ud)
+                if default is None:
+                    continue
+            log.debug("Setting user data field %s to '%s'" % (field, default))
+            ud[field] = default
+    return ud
+
 def _get_s3_conn(ud):
     access_key = ud['access_key']
     secret_key = ud['secret_key']
@@ -215,6 +456,11 @@ def _get_s3_conn(ud):
         port=ud.get('s3_port', 8888) # TODO - determine what correct values would be for what cloud types -- e.g. Eucalyptus = 8773, and openstack = 
         path=ud.get('s3_conn_path', '/')
         is_secure=ud.get('is_secure', True)
+    # Do not let a slow object store hold up boot; a cached boot script is used instead
+    if not boto.config.has_section('Boto'):
+        boto.config.add_section('Boto')
+    boto.config.set('Boto', 'http_socket_timeout', str(BOOT_FETCH_TIMEOUT))
+    boto.config.set('Boto', 'num_retries', '2')
     calling_format=OrdinaryCallingFormat()
     if host and 'amazon' not in host:
         try:
@@ -239,40 +485,6 @@ def _get_s3_conn(ud):
             return None
     return s3_conn
     
-def _bucket_exists(s3_conn, bucket_name):
-    bucket = None
-    for i in range(1, 6):
-        try:
-            # log.debug("Looking for bucket '%s'" % bucket_name)
-            bucket = s3_conn.lookup(bucket_name)
-            break
-        except S3ResponseError: 
-            log.error ("Bucket '%s' not found, attempt %s/5" % (bucket_name, i+1))
-            time.sleep(2)
-            
-    if bucket is not None:
-        log.debug("Cluster bucket '%s' found." % bucket_name)
-        return True
-    else:
-        log.debug("Cluster bucket '%s' not found." % bucket_name)
-        return False
-
-def _remote_file_exists(s3_conn, bucket_name, remote_filename):
-    b = None
-    for i in range(0, 5):
-        try:
-            b = s3_conn.get_bucket(bucket_name)
-            break
-        except S3ResponseError: 
-            log.error ("Problem connecting to bucket '%s', attempt %s/5" % (bucket_name, i))
-            time.sleep(2)
-            
-    if b is not None:
-        k = Key(b, remote_filename)
-        if k.exists():
-            return True
-    return False
-
 def _save_file_to_bucket(s3_conn, bucket_name, remote_filename, local_file, force=False):
     local_file = os.path.join(LOCAL_PATH, local_file)
     # log.debug( "Establishing handle with bucket '%s'..." % bucket_name)
@@ -281,147 +493,274 @@ def _save_file_to_bucket(s3_conn, bucket_name, remote_filename, local_file, forc
         try:
             b = s3_conn.get_bucket(bucket_name)
             break
-        except S3ResponseError, e:
+        except BotoServerError, e:
             log.error ("Problem connecting to bucket '%s', attempt %s/5" % (bucket_name, i))
+            _count_retries('s3_bucket')
             time.sleep(2)
     
     if b is not None:
         # log.debug("Establishing handle with key object '%s'..." % remote_filename)
         k = Key(b, remote_filename)
-        if k.exists() and not force:
-            log.debug("Remote file '%s' already exists. Not overwriting it." % remote_filename)
-            return True
         log.debug( "Attempting to save local file '%s' to bucket '%s' as '%s'" 
             % (local_file, bucket_name, remote_filename))
         try:
-            k.set_contents_from_filename(local_file)
+            if not force and k.exists():
+                log.debug("Remote file '%s' already exists. Not overwriting it." % remote_filename)
+                return True
+            _record_transfer('s3_upload', s3_transfer.upload_file(b, remote_filename, local_file))
             log.info( "Successfully saved file '%s' to bucket '%s'." % (remote_filename, bucket_name))
             return True
-        except S3ResponseError, e:
+        except (BotoServerError, IOError, socket.error, s3_transfer.TransferError), e:
             log.error("Failed to save file local file '%s' to bucket '%s' as file '%s': %s" 
               % (local_file, bucket_name, remote_filename, e))
             return False
     else:
         return False
 
-def _get_file_from_bucket(s3_conn, bucket_name, remote_filename, local_filename):
+def _cache_files(source):
+    """Paths of the cached copy of a boot artifact and of its ETag/Last-Modified metadata"""
+    name = hashlib.md5(source).hexdigest()
+    return os.path.join(BOOT_CACHE_PATH, name), os.path.join(BOOT_CACHE_PATH, '%s.json' % name)
+
+def _cache_validators(source):
+    """Conditional request headers for a cached boot artifact, if one is cached"""
+    cached_file, meta_file = _cache_files(source)
+    headers = {}
+    if os.path.exists(cached_file) and os.path.exists(meta_file):
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        except (IOError, ValueError):
+            pass
+    return headers
+
+def _save_to_cache(source, local_file, etag, last_modified):
+    cached_file, meta_file = _cache_files(source)
+    try:
+        if not os.path.exists(BOOT_CACHE_PATH):
+            os.makedirs(BOOT_CACHE_PATH)
+        shutil.copyfile(local_file, cached_file)
+        with open(meta_file, 'w') as f:
+            json.dump({'source': source, 'etag': etag, 'last_modified': last_modified}, f)
+    except (IOError, OSError), e:
+        log.debug("Could not cache '%s': %s" % (source, e))
+
+def _restore_from_cache(source, local_file):
+    """Copy the cached version of a boot artifact to local_file, if there is one"""
+    cached_file = _cache_files(source)[0]
+    if not os.path.exists(cached_file):
+        return False
+    shutil.copyfile(cached_file, local_file)
+    os.chmod(local_file, 0744)
+    log.debug("Using cached copy of '%s'" % source)
+    return True
+
+def _get_cached_file_from_bucket(s3_conn, bucket_name, remote_filename, local_filename):
+    """Get a file from a bucket with a single conditional GET, reusing the cached copy
+    if it has not changed or if the object store cannot be reached.
+    Returns 'ok', 'missing_key', 'missing_bucket' or 'error'."""
     local_filename = os.path.join(LOCAL_PATH, local_filename)
+    source = 's3://%s/%s' % (bucket_name, remote_filename)
+    k = Key(s3_conn.get_bucket(bucket_name, validate=False), remote_filename)
+    log.debug("Attempting to retrieve file '%s' from bucket '%s'" % (remote_filename, bucket_name))
     try:
-        # log.debug("Establishing handle with bucket '%s'" % bucket_name)
-        b = s3_conn.get_bucket(bucket_name)
-        
-        # log.debug("Establishing handle with file object '%s'" % remote_filename)
-        k = Key(b, remote_filename)
-    
-        log.debug("Attempting to retrieve file '%s' from bucket '%s'" % (remote_filename, bucket_name))
-        if k.exists():
-            k.get_contents_to_filename(local_filename)
-            log.info("Successfully retrieved file '%s' from bucket '%s' to '%s'." 
-                % (remote_filename, bucket_name, local_filename))
-            return True
-        else:
-            log.error("File '%s' in bucket '%s' not found." % (remote_filename, bucket_name))
-            return False
+        _record_transfer('boot_script_fetch',
+            s3_transfer.download_key(k, local_filename, headers=_cache_validators(source), retries=1))
     except S3ResponseError, e:
+        if e.status == 304 and _restore_from_cache(source, local_filename):
+            log.info("File '%s' in bucket '%s' unchanged since cached." % (remote_filename, bucket_name))
+            return 'ok'
+        if e.error_code in ('NoSuchKey', 'NoSuchBucket'):
+            log.debug("File '%s' in bucket '%s' not found: %s" % (remote_filename, bucket_name, e.error_code))
+            return 'missing_key' if e.error_code == 'NoSuchKey' else 'missing_bucket'
         log.error("Failed to get file '%s' from bucket '%s': %s" % (remote_filename, bucket_name, e))
-        return False
-
-def _get_file_from_url(url):
-    local_filename = os.path.join(LOCAL_PATH, os.path.split(url)[1])
+        return 'ok' if _restore_from_cache(source, local_filename) else 'error'
+    except (BotoServerError, IOError, socket.error), e:
+        log.error("Failed to get file '%s' from bucket '%s': %s" % (remote_filename, bucket_name, e))
+        return 'ok' if _restore_from_cache(source, local_filename) else 'error'
+    os.chmod(local_filename, 0744)
+    _save_to_cache(source, local_filename, k.etag, k.last_modified)
+    log.info("Successfully retrieved file '%s' from bucket '%s' to '%s'."
+        % (remote_filename, bucket_name, local_filename))
+    return 'ok'
+
+def _get_file_from_url(url, local_filename=None):
+    """Get a file from a URL with a conditional GET, reusing the cached copy if it
+    has not changed or if the URL cannot be reached"""
+    if local_filename is None:
+        local_filename = os.path.split(url)[1]
+    local_filename = os.path.join(LOCAL_PATH, local_filename)
     log.info("Getting boot script from '%s' and saving it locally to '%s'" % (url, local_filename))
     try:
-        f = urllib2.urlopen(url)
-        with open(local_filename, 'w') as local_file:
-            local_file.write(f.read())
-        os.chmod(local_filename, 0744) 
-        if f:
-            log.debug("Got boot script from '%s'" % url)
+        stats = s3_transfer.download_url(url, local_filename, headers=_cache_validators(url),
+            timeout=BOOT_FETCH_TIMEOUT, retries=1)
+        _record_transfer('boot_script_fetch', stats)
+        headers = stats['headers']
+        os.chmod(local_filename, 0744)
+        _save_to_cache(url, local_filename, headers.getheader('ETag'), headers.getheader('Last-Modified'))
+        log.debug("Got boot script from '%s'" % url)
+        return True
+    except urllib2.HTTPError, e:
+        if e.code == 304 and _restore_from_cache(url, local_filename):
+            log.debug("Boot script at '%s' unchanged since cached." % url)
             return True
+        log.error("Boot script at '%s' not found: %s" % (url, e))
         return False
-    except IOError:
-        log.error("Boot script at '%s' not found." % url)
-        return False
+    except (IOError, socket.error), e:
+        log.error("Could not reach '%s': %s" % (url, e))
+        return _restore_from_cache(url, local_filename)
 
 def _get_boot_script(ud):
-    # Test if cluster bucket exists; if it does not, resort to the default
-    # bucket for downloading the boot script
-    use_default_bucket = False
-    if ud.has_key('bucket_default'):
-        default_bucket_name = ud['bucket_default']
-    else:
-        default_bucket_name = DEFAULT_BUCKET_NAME
-    if ud.has_key('bucket_cluster') and ud['access_key'] is not None and ud['secret_key'] is not None:
-        s3_conn = _get_s3_conn(ud)
-        # Check if cluster bucket exists or use the default one
-        if not _bucket_exists(s3_conn, ud['bucket_cluster']) or \
-           not _remote_file_exists(s3_conn, ud['bucket_cluster'], ud['boot_script_name']):
-            log.debug("Using default bucket '%s'" % default_bucket_name)
-            use_default_bucket = True
-        else:
-            log.debug("Using cluster bucket '%s'" % ud['bucket_cluster'])
-            use_default_bucket = False
-    else:
-        log.debug("bucket_cluster not specified or no credentials provided; defaulting to bucket '%s'" 
-            % default_bucket_name)
-        use_default_bucket = True
-        
+    """Get the boot script from the cluster bucket or, if it is not there, from the
+    public default bucket (also saving it to the cluster bucket for future invocations).
+    Both are fetched with conditional requests against a local cache, so in the
+    common case this takes a single request."""
+    boot_script_name = ud.get('boot_script_name', DEFAULT_BOOT_SCRIPT_NAME)
+    cluster_status = None
     # If using cluster bucket, use credentials because the boot script may not be accessible to everyone
-    got_boot_script = False
-    if use_default_bucket is False:
+    if ud.get('bucket_cluster') and ud.get('access_key') is not None and ud.get('secret_key') is not None:
+        s3_conn = _get_s3_conn(ud)
         log.debug("Trying to get boot script '%s' from cluster bucket '%s'"
-            % (ud['boot_script_name'], ud.get('bucket_cluster', None)))
-        got_boot_script = _get_file_from_bucket(s3_conn, ud['bucket_cluster'], ud['boot_script_name'],
-            DEFAULT_BOOT_SCRIPT_NAME)
-        if got_boot_script:
-            os.chmod(os.path.join(LOCAL_PATH, DEFAULT_BOOT_SCRIPT_NAME), 0744)
-    # If did not get boot script, fall back on the publicly available one
-    if not got_boot_script or use_default_bucket:
-        boot_script_url = os.path.join(_get_default_bucket_url(ud), ud.get('boot_script_name', 
-            DEFAULT_BOOT_SCRIPT_NAME))
-        log.debug("Could not get boot script '%s' from cluster bucket '%s'; retrieving the public one from bucket url '%s'" \
-            % (ud['boot_script_name'], ud.get('bucket_cluster', None), boot_script_url))
-        got_boot_script = _get_file_from_url(boot_script_url)
-    if got_boot_script:
-        log.debug("Saved boot script to '%s'" % os.path.join(LOCAL_PATH, DEFAULT_BOOT_SCRIPT_NAME))
-        # Save the downloaded boot script to cluster bucket for future invocations
-        if ud.has_key('bucket_cluster') and ud['bucket_cluster']:
-            s3_conn = _get_s3_conn(ud)
-            if _bucket_exists(s3_conn, ud['bucket_cluster']) and \
-               not _remote_file_exists(s3_conn, ud['bucket_cluster'], ud['boot_script_name']):
-                _save_file_to_bucket(s3_conn, ud['bucket_cluster'], ud['boot_script_name'], \
-                    DEFAULT_BOOT_SCRIPT_NAME)        
-        return True
-    log.debug("**Could not get the boot script**")
-    return False
-
-def _run_boot_script(boot_script_name):
+            % (boot_script_name, ud['bucket_cluster']))
+        with _boot_phase('s3_cluster_bucket'):
+            cluster_status = _get_cached_file_from_bucket(s3_conn, ud['bucket_cluster'], boot_script_name,
+                DEFAULT_BOOT_SCRIPT_NAME)
+    else:
+        log.debug("bucket_cluster not specified or no credentials provided; defaulting to the public bucket")
+    if cluster_status != 'ok':
+        # If did not get boot script, fall back on the publicly available one
+        boot_script_url = os.path.join(_get_default_bucket_url(ud), boot_script_name)
+        log.debug("Retrieving the public boot script from bucket url '%s'" % boot_script_url)
+        if not _get_file_from_url(boot_script_url, DEFAULT_BOOT_SCRIPT_NAME):
+            log.debug("**Could not get the boot script**")
+            return False
+        if cluster_status == 'missing_key':
+            with _boot_phase('s3_save_boot_script'):
+                _save_file_to_bucket(s3_conn, ud['bucket_cluster'], boot_script_name,
+                    DEFAULT_BOOT_SCRIPT_NAME, force=True)
+    log.debug("Saved boot script to '%s'" % os.path.join(LOCAL_PATH, DEFAULT_BOOT_SCRIPT_NAME))
+    return True
+
+def _get_boot_script_log():
+    """Logger for the boot script's output: it goes to this script's log as well as
+    to a rotating file of its own"""
+    boot_log = logging.getLogger('cm_boot')
+    if not boot_log.handlers:
+        log_file = logging.handlers.RotatingFileHandler(BOOT_SCRIPT_LOG,
+            maxBytes=BOOT_SCRIPT_LOG_SIZE, backupCount=3)
+        log_file.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        boot_log.addHandler(log_file)
+    return boot_log
+
+def _run_boot_script(boot_script_name, timeout=None):
+    """Run the boot script, streaming its output line by line to the log rather than
+    buffering it. Lines starting with BOOT_PHASE_MARKER (e.g. 'BOOT_PHASE mount_volumes')
+    start a named phase, recorded with the boot phase timings. If timeout (in seconds)
+    is given, the script is killed once it has run for that long."""
     script = os.path.join(LOCAL_PATH, boot_script_name)
     log.info("Running boot script '%s'" % script)
-    process = subprocess.Popen(script, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    if process.returncode == 0:
+    boot_log = _get_boot_script_log()
+    stderr_tail = deque(maxlen=BOOT_SCRIPT_STDERR_LINES)
+    phase = {'name': None, 'start': None}
+    def end_phase():
+        if phase['name']:
+            _record_boot_phase('%s:%s' % (boot_script_name, phase['name']), phase['start'])
+    def read_stdout(pipe):
+        for line in iter(pipe.readline, ''):
+            line = line.rstrip('\n')
+            boot_log.info("[stdout] %s" % line)
+            if line.startswith(BOOT_PHASE_MARKER):
+                end_phase()
+                phase['name'], phase['start'] = line[len(BOOT_PHASE_MARKER):].strip(), time.time()
+        pipe.close()
+    def read_stderr(pipe):
+        for line in iter(pipe.readline, ''):
+            line = line.rstrip('\n')
+            boot_log.info("[stderr] %s" % line)
+            stderr_tail.append(line)
+        pipe.close()
+    child_env = dict(os.environ)
+    if _vendored_boto:
+        # The boot script (and CloudMan it starts) need the same boto as this script
+        child_env['PYTHONPATH'] = os.pathsep.join([_vendored_boto]
+            + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    # Run in a process group of its own so a timeout also stops anything the script started
+    process = subprocess.Popen(script, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        preexec_fn=os.setsid, env=child_env)
+    readers = [threading.Thread(target=read_stdout, args=(process.stdout,)),
+               threading.Thread(target=read_stderr, args=(process.stderr,))]
+    for r in readers:
+        r.daemon = True
+        r.start()
+    timed_out = []
+    def kill():
+        timed_out.append(True)
+        log.error("Boot script '%s' did not finish within %ss; killing it" % (script, timeout))
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = None
+    if timeout:
+        timer = threading.Timer(float(timeout), kill)
+        timer.daemon = True
+        timer.start()
+    process.wait()
+    if timer:
+        timer.cancel()
+    for r in readers:
+        r.join(5) # Output still held by a background process started by the script is not waited on
+    end_phase()
+    _telemetry['boot_script_returncode'] = process.returncode
+    if process.returncode == 0 and not timed_out:
         log.debug("Successfully ran boot script '%s'" % script)
         return True
     else:
-        log.error("Error running boot script '%s'. Process returned code '%s' and following stderr: %s" 
-            % (script, process.returncode, stderr))
+        log.error("Error running boot script '%s'. Process returned code '%s' and following stderr "
+            "(full output in '%s'): %s" % (script, process.returncode, BOOT_SCRIPT_LOG, '\n'.join(stderr_tail)))
         return False
 
+def _start_volume_hydration(mount_points):
+    """Start prewarming the volumes CloudMan will mount at mount_points (e.g.
+    /mnt/galaxyIndices) in the background. Volumes created from snapshots are
+    otherwise slow to read until every block has been fetched once."""
+    if not os.path.exists(HYDRATE_SCRIPT):
+        log.warning("Cannot prewarm volumes; '%s' not found" % HYDRATE_SCRIPT)
+        return
+    for mount_point in mount_points:
+        log_file = os.path.join(LOCAL_PATH, 'hydrate_%s.log' % os.path.basename(mount_point.rstrip('/')))
+        log.info("Prewarming the volume to be mounted at '%s' in the background; see '%s'" % (mount_point, log_file))
+        with open(log_file, 'w') as f:
+            subprocess.Popen([sys.executable, HYDRATE_SCRIPT, '--wait', str(HYDRATE_WAIT), mount_point],
+                stdout=f, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+
 def _create_basic_user_data_file():
     # Create a basic YAML file that is expected by CloudMan 
-    with open(USER_DATA_FILE, 'w') as ud_file:
-        ud_formatted = {'access_key': None,
-                        'boot_script_name': DEFAULT_BOOT_SCRIPT_NAME,
-                        'boot_script_path': LOCAL_PATH,
-                        'bucket_default': DEFAULT_BUCKET_NAME,
-                        'bucket_cluster': None,
-                        'cloudman_home': CLOUDMAN_HOME,
-                        'cluster_name': 'aGalaxyCloudManCluster_%s' % random.randrange(1, 9999999),
-                        'role': 'master',
-                        'secret_key': None}
-        yaml.dump(ud_formatted, ud_file, default_flow_style=False)
+    ud_formatted = {'access_key': None,
+                    'boot_script_name': DEFAULT_BOOT_SCRIPT_NAME,
+                    'boot_script_path': LOCAL_PATH,
+                    'bucket_default': DEFAULT_BUCKET_NAME,
+                    'bucket_cluster': None,
+                    'cloudman_home': CLOUDMAN_HOME,
+                    'cluster_name': 'aGalaxyCloudManCluster_%s' % random.randrange(1, 9999999),
+                    'role': 'master',
+                    'secret_key': None}
+    _write_user_data_file(ud_formatted)
     return ud_formatted
 
+def _write_user_data_file(ud):
+    """Save the composed user data as USER_DATA_FILE, along with a JSON copy
+    (USER_DATA_JSON_FILE) for consumers that would rather not parse YAML"""
+    with open(USER_DATA_FILE, 'w') as ud_yaml:
+        yaml.dump(ud, ud_yaml, Dumper=YAMLDumper, default_flow_style=False)
+    with open(USER_DATA_JSON_FILE + '.part', 'w') as ud_json:
+        json.dump(ud, ud_json, default=str)
+    os.rename(USER_DATA_JSON_FILE + '.part', USER_DATA_JSON_FILE)
+
 def _get_default_bucket_url(ud=None):
     if ud and ud.has_key('bucket_default'):
         default_bucket_name = ud['bucket_default']
@@ -444,6 +783,9 @@ def _user_exists(username):
     return ep.find(username) > 0
 
 def _allow_password_logins(passwd):
+    if SANDBOX:
+        log.info("Sandbox mode; not enabling password logins")
+        return
     for user in ["ubuntu", "galaxy"]:
         if _user_exists(user):
             log.info("Setting up password-based login for user '{0}'".format(user))
@@ -458,6 +800,9 @@ def _allow_password_logins(passwd):
             subprocess.check_call(cl)
 
 def _handle_freenx(passwd):
+    if SANDBOX:
+        log.info("Sandbox mode; not configuring FreeNX")
+        return
     # Check if FreeNX is installed on the image before trying to configure it
     cl = "/usr/bin/dpkg --get-selections | /bin/grep freenx"
     retcode = subprocess.call(cl, shell=True)
@@ -483,21 +828,31 @@ def _handle_empty():
     # Get & run boot script
     file_url = os.path.join(_get_default_bucket_url(), DEFAULT_BOOT_SCRIPT_NAME)
     log.debug("Resorting to the default bucket to get the boot script: %s" % file_url)
-    _get_file_from_url(file_url)
-    _run_boot_script(DEFAULT_BOOT_SCRIPT_NAME)
+    with _boot_phase('get_boot_script'):
+        _get_file_from_url(file_url)
+    with _boot_phase('run_boot_script'):
+        _run_boot_script(DEFAULT_BOOT_SCRIPT_NAME)
 
 def _handle_url(url):
     log.info("Handling user data provided URL: '%s'" % url)
-    _get_file_from_url(url)
+    with _boot_phase('get_boot_script'):
+        _get_file_from_url(url)
     boot_script_name = os.path.split(url)[1]
-    _run_boot_script(boot_script_name)
+    with _boot_phase('run_boot_script'):
+        _run_boot_script(boot_script_name)
 
 def _handle_yaml(user_data):
     """ Process user data in YAML format"""
+    global _telemetry_ud
     log.info("Handling user data in YAML format.")
-    ud = yaml.load(user_data)
+    parse_start = time.time()
+    try:
+        ud = yaml.load(user_data, Loader=YAMLLoader)
+    except yaml.YAMLError, e:
+        log.warning("Could not parse user data as YAML: %s" % e)
+        ud = user_data
     # Handle bad user data as a string
-    if ud == user_data:
+    if not isinstance(ud, dict):
         return _handle_empty()
     # Allow password based logins. Do so also in case only NX is being setup.
     if "freenxpass" in ud or "password" in ud:
@@ -508,111 +863,45 @@ def _handle_yaml(user_data):
         _handle_freenx(ud["freenxpass"])
         if len(ud) == 1:
             return _handle_empty()
-    # If passed S3_URL and/or EC2_URL, split them into component pieces
-    if 's3_url' in ud: # override the S3 host to e.g. Eucalyptus
-        url = urlparse(ud['s3_url'])
-        ud['s3_host'] = url.hostname
-        ud['s3_port'] = url.port
-        ud['s3_conn_path']= url.path
-        if url.scheme == 'https':
-            ud['is_secure'] = True
-        else:
-            ud['is_secure'] = False
-            
-    if 'ec2_url' in ud:
-        url = urlparse(ud['ec2_url'])
-        ud['ec2_host'] = url.hostname
-        ud['ec2_port'] = url.port
-        ud['ec2_conn_path'] = url.path
-        if url.scheme == 'https':
-            ud['ec2_is_secure'] = True
-        else:
-            ud['ec2_is_secure'] = False
-    
-    if 'cloud_type' not in ud:
-        ud['cloud_type'] = _guess_cloud_type(ud)
-
+    if ud.get('no_start', None) is not None:
+        log.info("Received 'no_start' user data option. Not doing anything else.")
+        return
     
     # Create a YAML file from user data and store it as USER_DATA_FILE
     # This code simply ensures fields required by CloudMan are in the 
     # created file. Any other fields that might be included as user data
     # are also included in the created USER_DATA_FILE
-    if ud.get('no_start', None) is not None:
-        log.info("Received 'no_start' user data option. Not doing anything else.")
-        return
-    if not ud.has_key('cluster_name'):
-        log.warning("The provided user data should contain cluster_name field.")
-        ud['cluster_name'] = 'aCloudManCluster_%s' % random.randrange(1, 9999999)
-    elif ud['cluster_name'] == '':
-        log.warning("The cluster_name field of user data should not be empty.")
-        ud['cluster_name'] = 'aCloudManCluster_%s' % random.randrange(1, 9999999)
-    
-    if not ud.has_key('access_key'):
-        log.info("The provided user data does not contain access_key field; setting it to None..")
-        ud['access_key'] = None
-    elif ud['access_key'] == '' or ud['access_key'] is None:
-        log.warning("The access_key field of user data should not be empty; setting it to None.")
-        ud['access_key'] = None
-    
-    if not ud.has_key('secret_key'):
-        log.info("The provided user data does not contain secret_key field; setting it to None.")
-        ud['secret_key'] = None
-    elif ud['secret_key'] == '' or ud['secret_key'] is None:
-        log.warning("The secret_key field of user data should not be empty; setting it to None.")
-        ud['secret_key'] = None
-    
-    if not ud.has_key('password'):
-        log.warning("The provided user data should contain password field.")
-    elif ud['password'] == '':
-        log.warning("The password field of user data should not be empty.")
-    else: # ensure the password is a string
-        ud['password'] = str(ud['password'])
-    
-    if not ud.has_key('bucket_default'):
-        log.debug("The provided user data does not contain bucket_default field; setting it to '%s'." 
-            % DEFAULT_BUCKET_NAME)
-        ud['bucket_default'] = DEFAULT_BUCKET_NAME
-    elif ud['bucket_default'] == '':
-        log.warning("The bucket_default field of user data was empty; setting it to '%s'." 
-            % DEFAULT_BUCKET_NAME)
-        ud['bucket_default'] = DEFAULT_BUCKET_NAME
-    
-    if not ud.has_key('bucket_cluster'):
-        if ud['access_key'] is not None and ud['secret_key'] is not None:
-            ud['bucket_cluster'] = _get_bucket_name(ud['cluster_name'], ud['access_key'])
-    
-    if not ud.has_key('role'):
-        ud['role'] = 'master'
-    
-    if not ud.has_key('cloudman_home'):
-        ud['cloudman_home'] = CLOUDMAN_HOME
-    
-    if not ud.has_key('boot_script_name'):
-        ud['boot_script_name'] = DEFAULT_BOOT_SCRIPT_NAME
+    ud = _normalize_user_data(ud)
     ud['boot_script_path'] = LOCAL_PATH # Marks where boot script was saved
-    
     log.debug("Composed user data: %s" % ud)
-    with open(USER_DATA_FILE, 'w') as ud_yaml:
-        yaml.dump(ud, ud_yaml, default_flow_style=False)
+    _write_user_data_file(ud)
+    _record_boot_phase('parse_user_data', parse_start)
+    if ud.get('push_boot_telemetry') and ud.get('bucket_cluster') \
+        and ud['access_key'] is not None and ud['secret_key'] is not None:
+        _telemetry_ud = ud
     
+    # Start prewarming before the boot script has CloudMan mount the volumes
+    # and start Galaxy; hydrate_volume.py waits for each volume to be mounted
+    if ud.get('hydrate_volumes'):
+        _start_volume_hydration(ud['hydrate_volumes'])
     # Get & run boot script
-    if _get_boot_script(ud):
-        _run_boot_script(DEFAULT_BOOT_SCRIPT_NAME)
-
-# if only an old version is installed, install the newer one (1.9 has a very different API, and cloudman needs 2.2)
-def _install_new_boto():
-    boto_ver = '2.2.2'
-    if boto.Version < boto_ver:
-        log.debug('Updating Boto to %s' % (boto_ver) )
-        tmpdir='/tmp'
-        out_file="{0}/tar_boto-{1}.tar.gz".format(tmpdir,boto_ver)
-        boto_url = 'https://github.com/boto/boto/tarball/{0}'.format(boto_ver)
-        subprocess.check_call(('wget', boto_url, '-O', out_file))
-        os.chdir(tmpdir)
-        subprocess.check_call(('tar', '-zxf', out_file))
-        boto_source_dir=glob.glob('boto-boto*')[0]
-        os.chdir(boto_source_dir)
-        subprocess.check_call(('sudo', 'python', 'setup.py', 'install'))
+    with _boot_phase('get_boot_script'):
+        got_boot_script = _get_boot_script(ud)
+    if got_boot_script:
+        with _boot_phase('run_boot_script'):
+            _run_boot_script(DEFAULT_BOOT_SCRIPT_NAME, ud.get('boot_script_timeout'))
+
+def _check_boto():
+    """Report which boto is in use. The required version is baked into the image
+    at build time so nothing is installed from the network at boot."""
+    if _vendored_boto:
+        log.info("Installed boto is older than %s; using boto %s bundled at '%s'"
+            % (BOTO_MIN_VERSION, boto.Version, _vendored_boto))
+    if LooseVersion(boto.Version) < LooseVersion(BOTO_MIN_VERSION):
+        log.error("boto %s is older than the required %s and no bundled copy was found in '%s'"
+            % (boto.Version, BOTO_MIN_VERSION, VENDOR_PATH))
+    else:
+        log.debug("Using boto %s" % boto.Version)
 
 # ====================== Driver code ======================
 
@@ -626,17 +915,27 @@ def _parse_user_data(ud):
 
 def main():
     if not os.path.exists(LOCAL_PATH):
-        os.mkdir(LOCAL_PATH)
+        os.makedirs(LOCAL_PATH)
     global log
     log = _setup_logging()
-    ud = _get_user_data()
-    if ud:
-        _fix_hostname() # make sure this is done on first boot
-        _install_new_boto()
-        _parse_user_data(ud)
-        log.info("---> %s done <---" % sys.argv[0])
-    else:
-        log.info('---> Nothing to do. No user data passed to instance <---')
+    try:
+        with _boot_phase('total'):
+            with _boot_phase('metadata'):
+                _prefetch_metadata()
+            ud = _get_user_data()
+            if ud:
+                with _boot_phase('fix_hostname'):
+                    _fix_hostname() # make sure this is done on first boot
+                with _boot_phase('boto_check'):
+                    _check_boto()
+                _parse_user_data(ud)
+                log.info("---> %s done <---" % sys.argv[0])
+            else:
+                log.info('---> Nothing to do. No user data passed to instance <---')
+    finally:
+        # Keep the timings of a failed boot too; they are most wanted then
+        _log_boot_phases()
+        _write_telemetry()
 
 if __name__ == "__main__":
     main()
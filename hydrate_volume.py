@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Prewarm ("hydrate") an EBS volume created from a snapshot.
+
+Blocks of a volume restored from a snapshot are only fetched from S3 the first
+time they are read, so the first jobs touching e.g. galaxyIndices run at a
+fraction of normal I/O speed. This script reads the volume up front:
+
+  1. hot files first: the files referenced by Galaxy loc files (genome indices)
+     and any listed in --hot-list are read in parallel, so the indices are
+     fast as soon as possible
+  2. then the whole block device, split into chunks read by parallel 'dd'
+     readers, so every block is fetched once
+
+Progress and throughput are reported as it goes. Needs root to read the
+device; the file pass alone (--files-only) does not.
+
+Usage: hydrate_volume.py [options] <mount point> [device]
+
+Installed next to ec2autorun.py on the image; also run remotely by
+volume_manipulations_fab.py and copy_snap/local_to_ebs_fab.py after attaching
+a volume created from a snapshot.
+"""
+import os, sys, glob, time, threading, subprocess, Queue
+from optparse import OptionParser
+
+READERS = 8 # Parallel readers
+READ_SIZE = 1024 * 1024 # Bytes read at a time from a hot file
+CHUNK_SIZE = 256 * 1024 * 1024 # Bytes of the device read by a single dd
+PROGRESS_INTERVAL = 10 # Seconds between progress reports
+# Galaxy tool-data directories whose loc files point at the hot files
+# (relative ones are under the volume's mount point; data_fabfile.py writes an
+# indices volume's loc files to galaxy/tool-data on it)
+LOC_DIRS = ['galaxy/tool-data', 'tool-data', '/mnt/galaxyTools/galaxy-central/tool-data']
+
+def _log(msg):
+    print "[%s] %s" % (time.strftime('%H:%M:%S'), msg)
+    sys.stdout.flush()
+
+def _device_for(mount_point):
+    mount_point = os.path.realpath(mount_point)
+    with open('/proc/mounts') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) > 1 and parts[1] == mount_point:
+                return parts[0]
+    return None
+
+def _device_size(device):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+def _loc_paths(loc_file, mount_point):
+    """Absolute paths under mount_point referenced by a loc file"""
+    paths = []
+    with open(loc_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            for field in line.rstrip('\n').split('\t'):
+                field = field.strip()
+                if field.startswith(mount_point + '/'):
+                    paths.append(field)
+    return paths
+
+def _expand(path):
+    """Files making up an index: a loc file may name a directory, a file or an
+    index prefix (e.g. bwa's 'hg19.fa' for 'hg19.fa.bwt', 'hg19.fa.sa', ...)"""
+    files = []
+    for match in glob.glob(path + '*') or [path]:
+        if os.path.isdir(match):
+            for root, dirs, names in os.walk(match):
+                files.extend([os.path.join(root, name) for name in names])
+        elif os.path.isfile(match):
+            files.append(match)
+    return files
+
+def hot_files(mount_point, loc_dirs=LOC_DIRS, hot_list=None):
+    """Files to warm first, in the order found and without duplicates"""
+    mount_point = os.path.realpath(mount_point)
+    paths = []
+    for loc_dir in loc_dirs:
+        loc_dir = os.path.join(mount_point, loc_dir) # absolute loc_dir is kept as is
+        for loc_file in sorted(glob.glob(os.path.join(loc_dir, '*.loc'))):
+            paths.extend(_loc_paths(loc_file, mount_point))
+    if hot_list:
+        with open(hot_list) as f:
+            paths.extend([line.strip() for line in f if line.strip() and not line.startswith('#')])
+    seen = set()
+    files = []
+    for path in paths:
+        for f in _expand(path):
+            if f not in seen:
+                seen.add(f)
+                files.append(f)
+    return files
+
+class _Progress(object):
+    def __init__(self, what, total):
+        self.what = what
+        self.total = total
+        self.done = 0
+        self.start = self.last_report = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, num_bytes):
+        with self.lock:
+            self.done += num_bytes
+            if time.time() - self.last_report >= PROGRESS_INTERVAL:
+                self.last_report = time.time()
+                self.report()
+
+    def report(self, final=False):
+        seconds = max(time.time() - self.start, 0.001)
+        _log("%s: %s%.1f/%.1f GB (%.0f%%) in %.0fs, %.1f MB/s" % (self.what, 'done, ' if final else '',
+            self.done / 1073741824.0, self.total / 1073741824.0, 100.0 * self.done / max(self.total, 1),
+            seconds, self.done / seconds / 1048576))
+
+def _run_parallel(work, func, readers):
+    """Call func on every item of work from a pool of reader threads"""
+    queue = Queue.Queue()
+    for item in work:
+        queue.put(item)
+    def reader():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            func(item)
+    threads = [threading.Thread(target=reader) for i in range(min(readers, len(work)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(1) # Stay responsive to Ctrl-C
+
+def warm_files(files, readers=READERS):
+    progress = _Progress("Hot files", sum([os.path.getsize(f) for f in files]))
+    def read_file(path):
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(READ_SIZE)
+                    if not data:
+                        break
+                    progress.add(len(data))
+        except IOError, e:
+            _log("Could not read '%s': %s" % (path, e))
+    _run_parallel(files, read_file, readers)
+    progress.report(final=True)
+
+def warm_device(device, readers=READERS, chunk_size=CHUNK_SIZE):
+    size = _device_size(device)
+    progress = _Progress("Device %s" % device, size)
+    block = 1024 * 1024
+    blocks_per_chunk = chunk_size / block
+    chunks = range(0, (size + chunk_size - 1) / chunk_size)
+    errors = []
+    def read_chunk(chunk):
+        # O_DIRECT keeps the page cache for the hot files and Galaxy
+        cl = ['dd', 'if=%s' % device, 'of=/dev/null', 'bs=%s' % block, 'iflag=direct',
+              'skip=%s' % (chunk * blocks_per_chunk), 'count=%s' % blocks_per_chunk]
+        p = subprocess.Popen(cl, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr = p.communicate()[1]
+        if p.returncode != 0:
+            errors.append(stderr.strip())
+        progress.add(min(chunk_size, size - chunk * chunk_size))
+    _run_parallel(chunks, read_chunk, readers)
+    progress.report(final=True)
+    for error in errors[:5]:
+        _log("Error reading '%s': %s" % (device, error))
+    return not errors
+
+def main():
+    parser = OptionParser(usage="%prog [options] <mount point> [device]")
+    parser.add_option('-j', '--readers', type='int', default=READERS,
+        help="number of parallel readers (default %default)")
+    parser.add_option('--hot-list', help="file listing additional files to warm first, one per line")
+    parser.add_option('--loc-dir', action='append', dest='loc_dirs',
+        help="directory of loc files referencing the hot files, relative to the mount point "
+             "or absolute; may be repeated (default: %s)" % ', '.join(LOC_DIRS))
+    parser.add_option('--files-only', action='store_true', default=False,
+        help="only warm the hot files, not the whole device")
+    parser.add_option('--wait', type='int', default=0,
+        help="seconds to wait for the volume to be mounted, e.g. when started at boot")
+    options, args = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.error("give the mount point of the volume and optionally its device")
+    mount_point = args[0]
+    deadline = time.time() + options.wait
+    while _device_for(mount_point) is None and time.time() < deadline:
+        time.sleep(5)
+    device = args[1] if len(args) == 2 else _device_for(mount_point)
+    start = time.time()
+    files = hot_files(mount_point, options.loc_dirs or LOC_DIRS, options.hot_list)
+    _log("Warming %s hot files under '%s'" % (len(files), mount_point))
+    warm_files(files, options.readers)
+    ok = True
+    if not options.files_only:
+        if not device:
+            parser.error("could not find the device mounted at '%s'; give it explicitly" % mount_point)
+        _log("Warming device '%s'" % device)
+        ok = warm_device(device, options.readers)
+    _log("Hydration of '%s' finished in %.0fs" % (mount_point, time.time() - start))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,7 @@ import os, os.path, time, contextlib, tempfile, yaml, sys, boto
 import datetime as dt
 import re
 from urlparse import urlparse
+from distutils.version import LooseVersion
 
 from boto.ec2.connection import EC2Connection
 from boto.exception import EC2ResponseError
@@ -25,7 +26,7 @@ from boto.ec2 import EC2Connection
 from boto.ec2.regioninfo import RegionInfo
 from boto.ec2.blockdevicemapping import BlockDeviceType, BlockDeviceMapping
 
-from fabric.api import sudo, run, env, cd, put, local
+from fabric.api import sudo, run, env, cd, put, local, abort
 from fabric.contrib.console import confirm
 from fabric.contrib.files import exists, settings, hide, contains, append, sed
 from fabric import context_managers
@@ -34,6 +35,8 @@ from fabric.colors import red, green, yellow
 
 from util.shared import (_yaml_to_packages, _if_not_installed, _make_tmp_dir,
                         _get_install, _configure_make, _setup_apt_automation)
+from util.volumes import _attached_volumes, _root_volume
+from util.remote_script import RemoteScript
 
 AMI_DESCRIPTION = "CloudMan for Galaxy on Ubuntu 12.04" # Value used for AMI description field
 # -- Adjust this link if using content from another location
@@ -44,6 +47,13 @@ MOUNTPOINT_FOR_BUNDLE = '/mnt/ebs'
 DEFAULT_EUCA_CONFIG_DIR='{0}/.euca'.format(os.environ['HOME'])
 FUNCTIONAL_EUCA2OOLS_URL='https://github.com/razrichter/euca2ools/zipball/working_bundle_vol' # gets a .zip file (not .tar.gz)
 
+def _boto_min_version():
+    """BOTO_MIN_VERSION as set in ec2autorun.py, read from its source since importing
+    it would pick a boto for this process"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ec2autorun.py')) as f:
+        return re.search(r"^BOTO_MIN_VERSION = '([^']+)'", f.read(), re.M).group(1)
+BOTO_VERSION = _boto_min_version() # Minimum boto version required by ec2autorun.py and CloudMan
+
 # REPO_ROOT_URL = "https://bitbucket.org/afgane/mi-deployment/raw/tip"
 
 # EDIT FOLLOWING TWO LINES IF NEEDED/DESIRED:
@@ -547,8 +557,31 @@ def _required_libraries():
     libraries = ['setuptools','simplejson', 'amqplib', 'pyyaml', 'mako', 'paste', 'routes', 'webhelpers', 'pastescript', 'webob', 'oca']
     for library in libraries:
         sudo("pip install -U %s" % library)
+    _install_boto()
     print(green("----- Required python libraries installed -----"))
 
+def _install_boto():
+    """Bake the boto version required at boot into the image.
+
+    Besides the system-wide install, a copy of boto is bundled next to
+    ec2autorun.py, which falls back on it if the installed boto is older than
+    it needs; instances then never install packages from the network at boot.
+    """
+    vendor_dir = os.path.join(env.install_dir, 'vendor')
+    sudo('pip install -U "boto>=%s"' % BOTO_VERSION)
+    sudo("mkdir -p %s" % vendor_dir)
+    sudo("rm -rf %s/boto %s/boto-*.whl" % (vendor_dir, vendor_dir))
+    with settings(warn_only=True):
+        result = sudo('pip wheel --no-deps -w %s "boto>=%s"' % (vendor_dir, BOTO_VERSION))
+    if result.failed:
+        # Older pip cannot build wheels; bundle the installed package instead
+        sudo("cp -r $(python -c 'import os, boto; print os.path.dirname(boto.__file__)') %s"
+            % vendor_dir)
+    version = run("python -c 'import boto; print boto.Version'")
+    if LooseVersion(version) < LooseVersion(BOTO_VERSION):
+        abort("Installed boto %s is older than the required %s" % (version, BOTO_VERSION))
+    print(green("----- boto %s installed and bundled in %s -----" % (version, vendor_dir)))
+
 # == environment
 
 def _configure_environment():
@@ -566,6 +599,9 @@ def _configure_ec2_autorun():
     ec2_autorun_file = "ec2autorun.py"
     remote_ec2_autorun_path = os.path.join(env.install_dir,ec2_autorun_file)
     _put_as_user(ec2_autorun_file,remote_ec2_autorun_path, user='root')
+    # Modules imported by ec2autorun.py and the volume prewarming tool it can start
+    for module_file in ['s3_transfer.py', 'hydrate_volume.py']:
+        _put_as_user(module_file, os.path.join(env.install_dir, module_file), user='root')
     # Create upstart configuration file for boot-time script
     cloudman_boot_file = 'cloudman.conf'
     with open( cloudman_boot_file, 'w' ) as f:
@@ -669,14 +705,11 @@ def _configure_xvfb():
         print >> f, xvfb_default_template
     remote_file = '/etc/default/xvfb'
     _put_as_user(xvfb_default_file, remote_file, user='root')
-    sudo("ln -s /etc/init.d/xvfb /etc/rc0.d/K01xvfb")
-    sudo("ln -s /etc/init.d/xvfb /etc/rc1.d/K01xvfb")
-    sudo("ln -s /etc/init.d/xvfb /etc/rc2.d/S99xvfb")
-    sudo("ln -s /etc/init.d/xvfb /etc/rc3.d/S99xvfb")
-    sudo("ln -s /etc/init.d/xvfb /etc/rc4.d/S99xvfb")
-    sudo("ln -s /etc/init.d/xvfb /etc/rc5.d/S99xvfb")
-    sudo("ln -s /etc/init.d/xvfb /etc/rc6.d/K01xvfb")
-    sudo("mkdir /var/lib/xvfb; chown root:root /var/lib/xvfb; chmod 0755 /var/lib/xvfb")
+    script = RemoteScript("xvfb runlevels", use_sudo=True)
+    for runlevel, link in [(0, 'K01'), (1, 'K01'), (2, 'S99'), (3, 'S99'), (4, 'S99'), (5, 'S99'), (6, 'K01')]:
+        script.add("ln -s /etc/init.d/xvfb /etc/rc%s.d/%sxvfb" % (runlevel, link))
+    script.add("mkdir /var/lib/xvfb; chown root:root /var/lib/xvfb; chmod 0755 /var/lib/xvfb")
+    script.run()
     print(green("----- configured xvfb -----"))
 
 # == Machine image rebundling code
@@ -1267,13 +1300,12 @@ def _clean():
 
 def _get_root_vol_size(ec2_conn, instance_id):
     print(yellow("Trying to discover the size of the current root volume"))
-    try:
-        f = {'attachment.instance-id': instance_id}
-        volumes = ec2_conn.get_all_volumes(filters=f)
-    except EC2ResponseError, e:
-        print(red("Error checking for attached volumes: {0}".format(e)))
+    volumes = _attached_volumes(ec2_conn, instance_id)
+    root_volume = _root_volume(ec2_conn, instance_id)
     size = 20 # The default size for the root partition
-    if len(volumes) == 1:
+    if root_volume:
+        size = root_volume.size
+    elif len(volumes) == 1:
         size = volumes[0].size
     else:
         print(red("Found more than 1 attached volume: {0}".format(volumes)))
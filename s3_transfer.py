@@ -0,0 +1,179 @@
+"""
+Streaming, chunked transfers to and from S3 and S3-compatible object stores.
+
+Used by ec2autorun.py (and installed next to it on the image) as well as by
+volume_manipulations_fab.py.
+
+Downloads are written to disk a chunk at a time and checked against the
+expected MD5 (by default taken from the object's ETag). Uploads at or above
+MULTIPART_THRESHOLD are sent as a multipart upload with parts sent in
+parallel. Every request is retried with exponential backoff, and each
+transfer logs its throughput.
+"""
+
+import os, re, time, math, socket, logging, hashlib, threading, urllib2, Queue
+from cStringIO import StringIO
+from boto.s3.key import Key
+from boto.exception import BotoServerError
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+CHUNK_SIZE = 1024 * 1024 # Bytes read and written at a time when streaming a download
+MULTIPART_THRESHOLD = 64 * 1024 * 1024 # Files at least this large are uploaded in parts
+PART_SIZE = 16 * 1024 * 1024 # Size of each part of a multipart upload (S3 requires at least 5MB)
+UPLOAD_THREADS = 4 # Number of parts uploaded concurrently
+RETRIES = 4 # Number of times a failed request is retried
+BACKOFF = 1 # Seconds to wait before the first retry; doubled for every following one
+
+class TransferError(Exception):
+    pass
+
+def _is_retryable(e):
+    """Client errors (other than timeouts and throttling) will not go away on retry"""
+    status = getattr(e, 'status', None) or getattr(e, 'code', None)
+    if isinstance(status, int) and status < 500 and status not in (408, 429):
+        return False
+    return True
+
+def _retry(func, description, retries=RETRIES):
+    """Call func, retrying it on failure. Returns its result and the number of retries."""
+    for attempt in range(retries + 1):
+        try:
+            return func(), attempt
+        except (BotoServerError, IOError, socket.error), e:
+            if attempt == retries or not _is_retryable(e):
+                raise
+            delay = BACKOFF * 2 ** attempt
+            log.warning("%s failed (attempt %s/%s): %s; retrying in %ss"
+                % (description, attempt + 1, retries + 1, e, delay))
+            time.sleep(delay)
+
+def _stats(action, name, num_bytes, start, **kwargs):
+    seconds = time.time() - start
+    log.info("%s '%s': %s bytes in %.2fs (%.2f MB/s)"
+        % (action, name, num_bytes, seconds, num_bytes / max(seconds, 0.001) / 1048576))
+    stats = {'bytes': num_bytes, 'seconds': seconds}
+    stats.update(kwargs)
+    return stats
+
+def _etag_md5(etag):
+    """Return the MD5 digest an ETag corresponds to, unless it is not a plain MD5
+    (e.g. the ETag of a multipart upload)"""
+    if etag:
+        etag = etag.strip('"')
+        if re.match('^[0-9a-f]{32}$', etag):
+            return etag
+    return None
+
+def stream_to_file(fp, local_file, expected_md5=None, chunk_size=CHUNK_SIZE):
+    """Write the readable fp to local_file a chunk at a time, verifying the MD5 of
+    the data if expected_md5 is given. Data is written to a temporary file that is
+    only moved into place once complete. Returns the number of bytes written."""
+    md5 = hashlib.md5()
+    num_bytes = 0
+    part_file = local_file + '.part'
+    with open(part_file, 'wb') as out:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            out.write(chunk)
+            md5.update(chunk)
+            num_bytes += len(chunk)
+    if expected_md5 and md5.hexdigest() != expected_md5:
+        os.remove(part_file)
+        raise IOError("Checksum mismatch for '%s': expected %s, got %s"
+            % (local_file, expected_md5, md5.hexdigest()))
+    os.rename(part_file, local_file)
+    return num_bytes
+
+def download_url(url, local_file, headers=None, timeout=None, expected_md5=None, retries=RETRIES):
+    """Stream url to local_file. HTTP errors, including 304 Not Modified in reply to
+    conditional headers, are raised as urllib2.HTTPError. Returns transfer stats,
+    with the response headers under 'headers'."""
+    start = time.time()
+    def fetch():
+        f = urllib2.urlopen(urllib2.Request(url, headers=headers or {}), timeout=timeout)
+        try:
+            info = f.info()
+            md5 = expected_md5 or _etag_md5(info.getheader('ETag'))
+            return info, stream_to_file(f, local_file, md5)
+        finally:
+            f.close()
+    (info, num_bytes), num_retries = _retry(fetch, "Download of '%s'" % url, retries)
+    return _stats("Downloaded", url, num_bytes, start, retries=num_retries, headers=info)
+
+def download_key(key, local_file, headers=None, retries=RETRIES):
+    """Stream the contents of a boto Key to local_file, verifying them against the
+    key's ETag. S3 errors, including 304 Not Modified in reply to conditional
+    headers, are raised as S3ResponseError. Returns transfer stats."""
+    start = time.time()
+    def fetch():
+        # Drop the response of a failed attempt, or open_read would reuse it
+        key.close()
+        key.open_read(headers=headers)
+        try:
+            return stream_to_file(key, local_file, _etag_md5(key.etag))
+        finally:
+            key.close()
+    num_bytes, num_retries = _retry(fetch, "Download of '%s'" % key.name, retries)
+    return _stats("Downloaded", key.name, num_bytes, start, retries=num_retries)
+
+def upload_file(bucket, key_name, local_file, metadata=None, threshold=MULTIPART_THRESHOLD,
+    part_size=PART_SIZE, threads=UPLOAD_THREADS, retries=RETRIES, headers=None):
+    """Upload local_file to bucket as key_name, storing metadata (a dict) with it.
+    Files smaller than threshold are sent in a single request, larger ones as a
+    multipart upload. S3 checks every request against its Content-MD5. headers
+    (e.g. If-Match or x-amz-acl) are sent with the upload request, or with the
+    request starting a multipart upload. Returns transfer stats, including the
+    number of requests retried."""
+    size = os.path.getsize(local_file)
+    start = time.time()
+    if size < threshold:
+        k = Key(bucket, key_name)
+        for name, value in (metadata or {}).items():
+            k.set_metadata(name, value)
+        num_retries = _retry(lambda: k.set_contents_from_filename(local_file, headers=headers),
+            "Upload of '%s'" % key_name, retries)[1]
+        return _stats("Uploaded", key_name, size, start, retries=num_retries, parts=1)
+    num_parts = int(math.ceil(size / float(part_size)))
+    num_retries = _multipart_upload(bucket, key_name, local_file, size, metadata, part_size,
+        num_parts, threads, retries, headers)
+    return _stats("Uploaded", key_name, size, start, retries=num_retries, parts=num_parts)
+
+def _multipart_upload(bucket, key_name, local_file, size, metadata, part_size,
+    num_parts, threads, retries, headers=None):
+    mp = bucket.initiate_multipart_upload(key_name, headers=headers, metadata=metadata or {})
+    parts = Queue.Queue()
+    for part_num in range(1, num_parts + 1):
+        parts.put(part_num)
+    errors = []
+    part_retries = []
+    def upload_parts():
+        while not errors:
+            try:
+                part_num = parts.get_nowait()
+            except Queue.Empty:
+                return
+            offset = (part_num - 1) * part_size
+            def send():
+                with open(local_file, 'rb') as f:
+                    f.seek(offset)
+                    data = StringIO(f.read(min(part_size, size - offset)))
+                mp.upload_part_from_file(data, part_num)
+            try:
+                part_retries.append(_retry(send, "Upload of part %s/%s of '%s'"
+                    % (part_num, num_parts, key_name), retries)[1])
+            except Exception, e:
+                errors.append(e)
+    workers = [threading.Thread(target=upload_parts) for i in range(min(threads, num_parts))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if errors:
+        mp.cancel_upload()
+        raise TransferError("Multipart upload of '%s' failed: %s" % (key_name, errors[0]))
+    mp.complete_upload()
+    return sum(part_retries)
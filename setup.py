@@ -24,6 +24,8 @@ package_files = ['data_fabfile.py',
                  'mi_fabfile.py', 
                  'tools_fabfile.py', 
                  'volume_manipulations_fab.py', 
+                 's3_transfer.py', 
+                 'hydrate_volume.py', 
                  'util', 
                  'tools']
 
@@ -16,25 +16,22 @@ from shogun_fab import Shogun as shogun
 from util import base_conf
 from util import util
 from util import common
+from util import graph
 import os
 
 class ASP(base_conf.Deployment):
+    dependencies = [shogun]
     
     def resolve_dependencies(self, install=True):
         """Check if tool dependencies are installed. If the optional 'install'
         parameter is True, try to install any missing dependencies."""
         print "Resolving dependencies for %s..." % str(self.tool_env['pkg_name']).upper()
-        ret_env = {}
-        parent_env = {'parent': self.tool_env}
-        d = shogun(self.conf)
-        if d.is_installed(parent_env):
-            ret_env = d.get_env(parent_env)
-        elif install:
-            ret_env = d.install(parent_env)
-        else:
+        deps = graph.resolve(self, install)
+        ret_env = deps[shogun]
+        if ret_env is None and not install:
             # Not installed, not installing, but checking if it were installed
             return False
-        if ret_env.has_key('env_script'):
+        if ret_env is not None and ret_env.has_key('env_script'):
             self.tool_env['shogun_env_script'] = ret_env['env_script']
         else:
             print "----- ERROR: Could not install Shogun -----"
@@ -16,9 +16,11 @@ from shogun_fab import Shogun as shogun
 from util import base_conf
 from util import util
 from util import common
+from util import graph
 import os
 
 class EasySVM(base_conf.Deployment):
+    dependencies = [shogun]
     
     def install_arff(self):
         common.install_required_python_libraries(self.tool_env, ['antlr_python_runtime'])
@@ -43,17 +45,12 @@ class EasySVM(base_conf.Deployment):
         if not self.install_arff():
             print "ERROR: Could not install ARFF"
             return False
-        parent_env = {'parent': self.tool_env}
-        ret_env = {}
-        d = shogun(self.conf)
-        if d.is_installed(parent_env):
-            ret_env = d.get_env(parent_env)
-        elif install:
-            ret_env = d.install(parent_env)
-        else:
+        deps = graph.resolve(self, install)
+        ret_env = deps[shogun]
+        if ret_env is None and not install:
             # Not installed, not installing, but checking if it were installed
             return False
-        if ret_env.has_key('env_script'):
+        if ret_env is not None and ret_env.has_key('env_script'):
             self.tool_env['shogun_env_script'] = ret_env['env_script']
         else:
             print "----- ERROR: Could not install Shogun -----"
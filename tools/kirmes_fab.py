@@ -17,44 +17,36 @@ from weblogo_fab import Weblogo as weblogo
 from util import base_conf
 from util import util
 from util import common
+from util import graph
 import os
 
 class Kirmes(base_conf.Deployment):
+    dependencies = [shogun, weblogo]
     
     def resolve_dependencies(self, install=True):
         """ Install any tool dependencies. If the optional 'install' parameter
         is False, only check if the dependencies are installed but do not try to 
         install them. """
         print "Resolving dependencies for %s..." % str(self.tool_env['pkg_name']).upper()
-        ret_env = {}
-        parent_env = {'parent': self.tool_env}
-        d = shogun(self.conf)
-        if d.is_installed(parent_env):
-            ret_env = d.get_env(parent_env)
-        elif install:
-            ret_env = d.install(parent_env)
-        else:
+        deps = graph.resolve(self, install, self._dependency_resolved)
+        ret_env = deps[shogun]
+        if ret_env is None and not install:
             # Not installed, not installing, but checking if it were installed
             return False
-        if ret_env.has_key('env_script'):
-            self.tool_env['shogun_env_script'] = ret_env['env_script']
-        else:
+        if ret_env is None or not ret_env.has_key('env_script'):
             print "----- ERROR: Could not install Shogun -----"
             return False
-        parent_env = {'parent': self.tool_env} # Reset parent_env
-        d = weblogo(self.conf)
-        if d.is_installed(parent_env):
-            ret_env = d.get_env(parent_env)
-        elif install:
-            ret_env = d.install(parent_env)
-        else:
-            # Not installed, not installing, but checking if it were installed
+        if deps[weblogo] is None:
             return False
-        if not ret_env['installed']:
-            return False 
         self.tool_env['dependencies_ok'] = True
         return True
     
+    def _dependency_resolved(self, cls, ret_env):
+        # Set as soon as Shogun is resolved so Weblogo, resolved after it,
+        # gets it in its parent environment
+        if cls is shogun and ret_env is not None and ret_env.has_key('env_script'):
+            self.tool_env['shogun_env_script'] = ret_env['env_script']
+    
     def set_env(self, local_env={}):
         """ Setup the values for the global environment for the current tool. """
         self.tool_env['pkg_name'] = 'kirmes'
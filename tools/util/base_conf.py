@@ -6,8 +6,12 @@ class Deployment(object):
     name) at the time of tool installation (see individual tool's invocation 
     command on how to do so).
     """
+    # Deployment classes of the tools this tool needs (see util/graph.py)
+    dependencies = []
+
     def __init__(self, conf=None):
-        self.work_dir = os.path.join('/tmp', "fab_tmp")
+        # Each tool gets its own work dir, as make_tmp_dir removes it when done
+        self.work_dir = os.path.join('/tmp', "fab_tmp_%s" % self.__class__.__name__.lower())
         self.tool_env={ 'galaxy_dir': '',
                         'install_dir_root': '',
                         'work_dir': self.work_dir,
@@ -0,0 +1,164 @@
+""" Resolve tool dependencies as a graph. Each Deployment class lists the
+Deployment classes it needs in its 'dependencies' attribute; the graph of a
+tool is built from those lists and every dependency in it is checked (and,
+if need be, installed) once, after the dependencies it needs in turn.
+Dependencies that do not depend on each other are checked at the same time,
+each in its own process because Fabric's env and connections are not thread
+safe. They are installed one at a time though: being independent in the
+graph does not make them independent on the host, where installers share
+apt's dpkg lock, pip and so on. Whether a tool is installed is remembered
+per host, tool and version for the rest of the session, so tools sharing a
+dependency (e.g., Shogun) do not check it over and over. """
+import multiprocessing
+
+from fabric.api import env
+from fabric import state
+
+# (host, pkg_name, version) -> the tool's environment if it is installed, or
+# None if it is not
+_installed = {}
+# (host, Deployment class) -> the key of the class's entry in _installed
+_checked = {}
+
+def dependency_graph(cls):
+    """ Return a dict mapping cls and every class it depends on, directly or
+    not, to the classes it directly depends on. Raises ValueError if the
+    dependencies form a cycle. """
+    graph = {}
+    def visit(c, path):
+        if c in path:
+            raise ValueError("Circular dependency: %s" % ' -> '.join([p.__name__ for p in path + [c]]))
+        if c in graph:
+            return
+        graph[c] = list(getattr(c, 'dependencies', []))
+        for d in graph[c]:
+            visit(d, path + [c])
+    visit(cls, [])
+    return graph
+
+def install_order(graph):
+    """ Split the classes in graph into a list of generations: each class
+    comes after all of the classes it depends on, and the classes within a
+    generation do not depend on each other. """
+    remaining = dict([(c, set(deps)) for c, deps in graph.items()])
+    generations = []
+    while remaining:
+        ready = [c for c, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError("Circular dependency among: %s" % ', '.join([c.__name__ for c in remaining]))
+        ready.sort(key=lambda c: c.__name__)
+        for c in ready:
+            del remaining[c]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+        generations.append(ready)
+    return generations
+
+def is_installed(deployment, local_env={}):
+    """ Memoized deployment.is_installed: return the environment of the tool
+    if it is installed (see common.compose_successful_return), or None. """
+    if not deployment.tool_env['env_set']:
+        deployment.set_env(local_env)
+    key = (env.host_string, deployment.tool_env['pkg_name'], deployment.tool_env['version'])
+    _checked[(env.host_string, deployment.__class__)] = key
+    if not _installed.has_key(key):
+        if deployment.is_installed(local_env):
+            _installed[key] = deployment.get_env(local_env)
+        else:
+            _installed[key] = None
+    return _installed[key]
+
+def remembered(cls, install=True):
+    """ Return the key of the session's result for Deployment class cls if
+    that result settles it (i.e., the tool is installed, or it is not but
+    install is False), or None if the tool has to be checked or installed. """
+    key = _checked.get((env.host_string, cls))
+    if key and (_installed[key] is not None or not install):
+        return key
+    return None
+
+def resolve_node(cls, conf, parent_env, install=True):
+    """ Check if the tool of Deployment class cls is installed and, if not
+    and install is True, install it. Return the tool's environment, or None
+    if it is not installed, along with its key in the session's results. """
+    key = remembered(cls, install)
+    if key:
+        return key, _installed[key]
+    d = cls(conf)
+    ret_env = is_installed(d, dict(parent_env))
+    key = _checked[(env.host_string, cls)]
+    if ret_env is None and install:
+        ret_env = d.install(dict(parent_env))
+        if not ret_env or not ret_env['installed']:
+            ret_env = None
+        _installed[key] = ret_env
+    return key, ret_env
+
+def _check_in_child(cls, conf, parent_env, conn):
+    # The parent's connections are shared with this process; drop them
+    # (without closing them) so this one opens its own
+    state.connections.clear()
+    try:
+        conn.send(resolve_node(cls, conf, parent_env, install=False))
+    except BaseException, e:
+        print "ERROR checking %s: %s" % (cls.__name__, e)
+        conn.send((None, None))
+
+def check_in_parallel(classes, conf, parent_env):
+    """ Check if the tools of the given Deployment classes are installed,
+    each in its own process, and remember the results for the session. A
+    tool whose check fails is left to be checked again. """
+    children = []
+    for cls in classes:
+        parent_conn, child_conn = multiprocessing.Pipe(False)
+        p = multiprocessing.Process(target=_check_in_child,
+            args=(cls, conf, parent_env, child_conn))
+        p.start()
+        child_conn.close()
+        children.append((cls, p, parent_conn))
+    for cls, p, conn in children:
+        try:
+            key, ret_env = conn.recv()
+        except EOFError: # The child died without sending its result
+            key, ret_env = None, None
+        p.join()
+        if key is not None:
+            _installed[key] = ret_env
+            _checked[(env.host_string, cls)] = key
+
+def resolve(deployment, install=True, on_resolved=None):
+    """ Check, and if install is True install, all of the dependencies of
+    deployment, each once and in dependency order. Return a dict mapping
+    each dependency's Deployment class to its environment (see
+    common.compose_successful_return), or to None if it is not installed.
+    A dependency whose own dependencies are not installed is skipped.
+    on_resolved, if given, is called with each dependency's class and
+    environment as soon as it is resolved, e.g. to add to
+    deployment.tool_env what the dependencies resolved after it need;
+    they get deployment.tool_env as it is then as their parent. """
+    graph = dependency_graph(deployment.__class__)
+    results = {}
+    def done(cls, ret_env):
+        results[cls] = ret_env
+        if on_resolved:
+            on_resolved(cls, ret_env)
+    for generation in install_order(graph):
+        todo = []
+        for cls in generation:
+            if cls is deployment.__class__:
+                continue
+            missing = [d.__name__ for d in graph[cls] if results.get(d) is None]
+            if missing:
+                print "Skipping %s: requires %s" % (cls.__name__, ', '.join(missing))
+                done(cls, None)
+            elif remembered(cls, install):
+                done(cls, _installed[remembered(cls, install)])
+            else:
+                todo.append(cls)
+        if len(todo) > 1:
+            check_in_parallel(todo, deployment.conf, {'parent': deployment.tool_env})
+        for cls in todo:
+            # Rebuilt for every dependency so it has what on_resolved added
+            parent_env = {'parent': dict(deployment.tool_env)}
+            done(cls, resolve_node(cls, deployment.conf, parent_env, install)[1])
+    return results
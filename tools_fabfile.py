@@ -18,6 +18,10 @@ from fabric.contrib.console import confirm
 from fabric.contrib.files import exists, settings, hide
 from fabric.colors import green, yellow, red
 
+from util.scheduler import _job, _run_jobs
+from util.recipes import _load_recipes, _recipe_jobs
+from util.remote_script import RemoteScript
+
 # -- Adjust this link if using content from another location
 CDN_ROOT_URL = "http://userwww.service.emory.edu/~eafgan/content"
 
@@ -62,10 +66,9 @@ def install_tools():
     if not exists(env.install_dir):
         sudo("mkdir -p %s" % env.install_dir)
         sudo("chown %s %s" % (env.galaxy_user, os.path.split(env.install_dir)[0]))
-    _required_packages()
     # _required_libraries() # currently, nothing there
     # _support_programs() # currently, nothing there
-    _install_tools()
+    _install_tools() # Includes _required_packages
     answer = confirm("Would you like to install Galaxy?")
     if answer:
         ok = _install_galaxy()
@@ -106,7 +109,8 @@ def _if_installed(pname):
 
 @contextmanager
 def _make_tmp_dir():
-    work_dir = os.path.join(env.tmp_dir, "fab_tmp")
+    # Installers run in parallel (see _install_tools) each get their own
+    work_dir = os.path.join(env.tmp_dir, "fab_tmp_%s" % env.job_name if env.get('job_name') else "fab_tmp")
     install_cmd = sudo if env.use_sudo else run
     if not exists(work_dir):
         install_cmd("mkdir %s" % work_dir)
@@ -203,43 +207,47 @@ def _install_galaxy():
 
 def _install_tools():
     """Install external tools (galaxy tool dependencies).
+    Most tools are installed from the recipes in conf_files/tool_recipes.yaml
+    (see util/recipes.py); the ones below need their own _install_* function.
+    The installers run in parallel, each as soon as the ones it requires are
+    done; 'build' installers compile and are limited to the number of cores,
+    while 'fetch' ones mostly download prebuilt files (see util/scheduler.py).
+    A failed installer does not stop the others.
+    """
+    pkgs = ['packages'] # Compilers and unzip
+    jobs = [_job('packages', _required_packages, 'fetch'),
+            # _job('fastx_toolkit', _install_fastx_toolkit, requires=pkgs),
+            _job('abyss', _install_abyss, requires=pkgs),
+            # _job('R', _install_R, requires=pkgs),
+            # _job('rpy', _install_rpy, requires=['R']),
+            _job('ucsc_tools', _install_ucsc_tools, 'fetch'),
+            _job('emboss_phylip', _install_emboss_phylip, requires=pkgs),
+            _job('hyphy', _install_hyphy, requires=pkgs),
+            _job('freebayes', _install_freebayes, requires=pkgs),
+            _job('fastqc', _install_fastqc, 'fetch', requires=pkgs)]
+    jobs += _recipe_jobs(_load_recipes())
+    return _run_jobs(jobs)
+
+def _finish_install(pkg_name, install_dir, path='bin', update_default=False, script=None):
+    """ Write install_dir's env.sh, putting path (relative to install_dir) on
+        PATH or, if path is None, leaving it empty. Then link the package's
+        default version to install_dir if it has none yet, or always if
+        update_default and env.update_default are set.
+        These steps are run as one remote script, appended to script (a
+        RemoteScript run as root) if given.
     """
-    _install_bowtie()
-    _install_bwa()
-    _install_samtools()
-    # _install_fastx_toolkit()
-    _install_maq()
-    _install_bfast()
-    _install_abyss()
-    # _install_R()
-    # _install_rpy()
-    _install_ucsc_tools()
-    _install_velvet()
-    _install_macs()
-    _install_tophat()
-    _install_cufflinks()
-    _install_megablast()
-    _install_blast()
-    _install_sputnik()
-    _install_taxonomy()
-    _install_add_scores()
-    _install_emboss_phylip()
-    _install_hyphy()
-    _install_lastz()
-    _install_perm()
-    _install_gatk()
-    _install_srma()
-    _install_beam()
-    _install_pass()
-    _install_lps_tool()
-    _install_plink()
-    # _install_fbat() # Not available
-    _install_haploview()
-    _install_eigenstrat()
-    _install_mosaik()
-    _install_freebayes()
-    _install_picard()
-    _install_fastqc()
+    install_dir_root = os.path.join(env.install_dir, pkg_name)
+    script = script or RemoteScript("%s env.sh and default link" % pkg_name, use_sudo=True)
+    if path is None:
+        script.add("touch %s/env.sh" % install_dir)
+    else:
+        script.add("echo 'PATH=%s:$PATH' > %s/env.sh" % (os.path.join(install_dir, path).rstrip('/'), install_dir))
+    script.add("chmod +x %s/env.sh" % install_dir)
+    if update_default and env.update_default:
+        script.add('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
+    else:
+        script.add('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
+    script.run()
 
 def _install_R():
     version = "2.11.1"
@@ -256,10 +264,7 @@ def _install_R():
                     print(yellow("Making R..."))
                     sudo("make")
                     sudo("make install")
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
+    _finish_install(pkg_name, install_dir)
     print(green("----- R %s installed to %s -----" % (version, install_dir)))
 
 def _install_rpy():
@@ -289,19 +294,11 @@ def _install_ucsc_tools():
     pkg_name = 'ucsc_tools'
     tools = ["liftOver", "twoBitToFa", "wigToBigWig"]
     install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
+    script = RemoteScript("UCSC tools", use_sudo=True)
+    script.add("mkdir -p %s && cd %s" % (install_dir, install_dir))
     for tool in tools:
-        with cd(install_dir):
-            if not exists(tool):
-                install_cmd = sudo if env.use_sudo else run
-                install_cmd("wget %s%s" % (url, tool))
-                install_cmd("chmod 755 %s" % tool)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
+        script.add("[ -e %s ] || { wget %s%s && chmod 755 %s; }" % (tool, url, tool, tool), "Download %s" % tool)
+    _finish_install(pkg_name, install_dir, path='', script=script)
     print(green("----- UCSC Tools installed to %s -----" % install_dir))
 
 def _install_ucsc_tools_src():
@@ -312,84 +309,6 @@ def _install_ucsc_tools_src():
         with cd(work_dir):
             run("wget %s" % url)
 
-# @_if_not_installed("bowtie")
-def _install_bowtie():
-    """Install the bowtie short read aligner."""
-    version = "0.12.7"
-    mirror_info = "?use_mirror=cdnetworks-us-2"
-    url = "http://downloads.sourceforge.net/project/bowtie-bio/bowtie/%s/bowtie-%s-src.zip" % (version, version)
-    pkg_name = 'bowtie'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s%s -O %s" % (url, mirror_info, os.path.split(url)[-1]))
-            run("unzip %s" % os.path.split(url)[-1])
-            with cd("bowtie-%s" % version):
-                run("make")
-                for fname in run("find -perm -100 -name 'bowtie*'").split("\n"):
-                    install_cmd("mv -f %s %s" % (fname.strip(), install_dir))
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- bowtie %s installed to %s -----" % (version, install_dir)))
-
-# @_if_not_installed("bwa")
-def _install_bwa():
-    version = "0.5.7"
-    mirror_info = "?use_mirror=cdnetworks-us-1"
-    url = "http://downloads.sourceforge.net/project/bio-bwa/bwa-%s.tar.bz2" % (
-            version)
-    pkg_name = 'bwa'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s%s -O %s" % (url, mirror_info, os.path.split(url)[-1]))
-            run("tar -xjvpf %s" % (os.path.split(url)[-1]))
-            with cd("bwa-%s" % version):
-                run("make")
-                install_cmd("mv bwa %s" % install_dir)
-                install_cmd("mv solid2fastq.pl %s" % install_dir)
-                install_cmd("mv qualfa2fq.pl %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- BWA %s installed to %s -----" % (version, install_dir)))
-
-# @_if_not_installed("samtools")
-def _install_samtools():
-    version = "0.1.12"
-    vext = "a"
-    mirror_info = "?use_mirror=cdnetworks-us-1"
-    url = "http://downloads.sourceforge.net/project/samtools/samtools/%s/" \
-            "samtools-%s%s.tar.bz2" % (version, version, vext)
-    pkg_name = 'samtools'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s%s -O %s" % (url, mirror_info, os.path.split(url)[-1]))
-            run("tar -xjvpf %s" % (os.path.split(url)[-1]))
-            with cd("samtools-%s%s" % (version, vext)):
-                run("sed -i.bak -r -e 's/-lcurses/-lncurses/g' Makefile")
-                run("make")
-                for install in ["samtools", "misc/maq2sam-long"]:
-                    install_cmd("mv -f %s %s" % (install, install_dir))
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- SAMtools %s installed to %s -----" % (version, install_dir)))
-
 # @_if_not_installed("fastq_quality_boxplot_graph.sh")
 def _install_fastx_toolkit():
     version = "0.0.13"
@@ -414,61 +333,9 @@ def _install_fastx_toolkit():
                 run("export PKG_CONFIG_PATH=%s/lib; ./configure --prefix=%s" % (install_dir, install_dir))
                 run("make")
                 install_cmd("make install")
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
+    _finish_install(pkg_name, install_dir)
     print(green("----- FASTX Toolkit %s installed to %s -----" % (version, install_dir)))
 
-# @_if_not_installed("maq")
-def _install_maq():
-    version = "0.7.1"
-    mirror_info = "?use_mirror=cdnetworks-us-1"
-    url = "http://downloads.sourceforge.net/project/maq/maq/%s/maq-%s.tar.bz2" \
-            % (version, version)
-    pkg_name = 'maq'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s%s -O %s" % (url, mirror_info, os.path.split(url)[-1]))
-            run("tar -xjvpf %s" % (os.path.split(url)[-1]))
-            install_cmd = sudo if env.use_sudo else run
-            with cd("maq-%s" % version):
-                run("./configure --prefix=%s" % (install_dir))
-                run("make")
-                install_cmd("make install")
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- MAQ %s installed to %s -----" % (version, install_dir)))
-
-# @_if_not_installed("bfast")
-def _install_bfast():
-    version = "0.7.0"
-    vext = "a"
-    url = "http://downloads.sourceforge.net/project/bfast/bfast/%s/bfast-%s%s.tar.gz"\
-            % (version, version, vext)
-    pkg_name = 'bfast'
-    install_dir = os.path.join(env.install_dir, pkg_name, "%s%s" % (version, vext))
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s" % (url))
-            run("tar -xzvpf %s" % (os.path.split(url)[-1]))
-            install_cmd = sudo if env.use_sudo else run
-            with cd("bfast-%s%s" % (version, vext)):
-                run("./configure --prefix=%s" % (install_dir))
-                run("make")
-                install_cmd("make install")
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- BFAST %s installed to %s -----" % (version, install_dir)))
-
 # @_if_not_installed("ABYSS")
 def _install_abyss():
     version = "1.3.1"
@@ -490,210 +357,9 @@ def _install_abyss():
                 run("./configure --prefix=%s --with-mpi=/opt/galaxy/pkg/openmpi" % install_dir)
                 run("make")
                 install_cmd("make install")
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
+    _finish_install(pkg_name, install_dir, update_default=True)
     print(green("----- ABySS %s installed to %s -----" % (version, install_dir)))
 
-def _install_velvet():
-    version = "1.1.06"
-    url = "http://www.ebi.ac.uk/~zerbino/velvet/velvet_%s.tgz" % version
-    pkg_name = "velvet"
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s" % url)
-            run("tar -xvzf %s" % os.path.split(url)[-1])
-            with cd("velvet_%s" % version):
-                run(r"""perl -i.orig -p -e 's/^(.*)\$\(LDFLAGS\)(.*$)/$1 $2 \$\(LDFLAGS\)/' Makefile""") # velvetg won't link on precise unless -lm comes after the object files
-                run("make")
-                for fname in run("find -perm -100 -name 'velvet*'").split("\n"):
-                    with settings(warn_only=True):
-                        tmp_cmd = "mv -f %s %s" % (fname, install_dir)
-                        print "tmp_cmd: %s" % tmp_cmd
-                        install_cmd(tmp_cmd)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- Velvet %s installed to %s -----" % (version, install_dir)))
-
-def _install_macs():
-    version = "1.4.1"
-    url = "http://liulab.dfci.harvard.edu/MACS/src/MACS-%s.tar.gz" % version
-    pkg_name = "macs"
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget --user=macs --password=chipseq %s" % url)
-            run("tar -xvzf %s" % os.path.split(url)[-1])
-            install_cmd = sudo if env.use_sudo else run
-            with cd("MACS-%s" % version):
-                install_cmd("python setup.py install --prefix %s" % install_dir)
-                # TODO: include prefix location into PYTHONPATH as part of env.sh:
-                # (e.g., "%s/lib/python2.6/site-packages/MACS-1.3.7.1-py2.6.egg-info" % install_dir)
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("echo 'PYTHONPATH=%s/lib/python2.6/site-packages:$PYTHONPATH' >> %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- MACS %s installed to %s -----" % (version, install_dir)))
-
-def _install_tophat():
-    version = '1.3.3'
-    url = 'http://tophat.cbcb.umd.edu/downloads/tophat-%s.Linux_x86_64.tar.gz' % version
-    pkg_name = "tophat"
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s" % url)
-            run("tar -xvzf %s" % os.path.split(url)[-1])
-            with cd(os.path.split(url)[-1].split('.tar.gz')[0]):
-                install_cmd("mv * %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- TopHat %s installed to %s -----" % (version, install_dir)))
-
-def _install_cufflinks():
-    version = '1.1.0'
-    url = 'http://cufflinks.cbcb.umd.edu/downloads/cufflinks-%s.Linux_x86_64.tar.gz' % version
-    pkg_name = "cufflinks"
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s" % url)
-            run("tar -xvzf %s" % os.path.split(url)[-1])
-            with cd(os.path.split(url)[-1].split('.tar.gz')[0]):
-                install_cmd("mv * %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- Cufflinks %s installed to %s -----" % (version, install_dir)))
-
-def _install_megablast():
-    version = '2.2.22'
-    url = 'ftp://ftp.ncbi.nlm.nih.gov/blast/executables/release/%s/blast-%s-x64-linux.tar.gz' % (version, version)
-    pkg_name = 'blast'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s" % url)
-            run("tar -xvzf %s" % os.path.split(url)[-1])
-            with cd('blast-%s/bin' % version):
-                    install_cmd("mv * %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- MEGABLAST %s installed to %s -----" % (version, install_dir)))
-
-def _install_blast():
-    version = '2.2.25+'
-    url = 'ftp://ftp.ncbi.nlm.nih.gov/blast/executables/blast+/%s/ncbi-blast-%s-x64-linux.tar.gz' % (version[:-1], version)
-    pkg_name = 'blast'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s" % url)
-            run("tar -xvzf %s" % os.path.split(url)[-1])
-            with cd('ncbi-blast-%s/bin' % version):
-                    install_cmd("mv * %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- BLAST %s installed to %s -----" % (version, install_dir)))
-
-def _install_sputnik():
-    version = 'r1'
-    url = 'http://bitbucket.org/natefoo/sputnik-mononucleotide/downloads/sputnik_%s_linux2.6_x86_64' % version
-    pkg_name = 'sputnik'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget -O sputnik %s" % url)
-            install_cmd("mv sputnik %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh %s/sputnik" % (install_dir, install_dir))
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_taxonomy():
-    version = 'r2'
-    url = 'http://bitbucket.org/natefoo/taxonomy/downloads/taxonomy_%s_linux2.6_x86_64.tar.gz' % version
-    pkg_name = 'taxonomy'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s" % url)
-            run("tar -xvzf %s" % os.path.split(url)[-1])
-            with cd(os.path.split(url)[-1].split('.tar.gz')[0]):
-                install_cmd("mv * %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_add_scores():
-    version = 'r1'
-    url = 'http://bitbucket.org/natefoo/add_scores/downloads/add_scores_%s_linux2.6_x86_64' % version
-    pkg_name = 'add_scores'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget -O add_scores %s" % url)
-            install_cmd("mv add_scores %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh %s/add_scores" % (install_dir, install_dir))
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
 def _install_emboss_phylip():
     version = '5.0.0'
     url = 'ftp://emboss.open-bio.org/pub/EMBOSS/old/%s/EMBOSS-%s.tar.gz' % (version, version)
@@ -720,10 +386,7 @@ def _install_emboss_phylip():
                 run("./configure --prefix=%s" % install_dir)
                 run("make")
                 install_cmd("make install")
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
+    _finish_install(pkg_name, install_dir)
     print(green("----- EMBOSS+PHYLIP %s/%s installed to %s -----" % (version, phylip_version, install_dir)))
 
 def _install_hyphy():
@@ -752,272 +415,9 @@ def _install_hyphy():
             with cd("build"):
                 run("bash build.sh SP")
             install_cmd("mv build/* %s" % install_dir)
-    sudo("touch %s/env.sh" % install_dir)
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
+    _finish_install(pkg_name, install_dir, path=None)
     print(green("----- HYPHY %s installed to %s -----" % (version, install_dir)))
 
-def _install_lastz():
-    version = '1.01.88'
-    url = 'http://www.bx.psu.edu/~rsharris/lastz/older/lastz-%s.tar.gz' % version
-    pkg_name = 'lastz'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s" % url)
-            run("tar -xvzf %s" % os.path.split(url)[-1])
-            with cd('lastz-distrib-%s' % version):
-                run("sed -i -e 's/GCC_VERSION == 40302/GCC_VERSION >= 40302/' src/quantum.c")
-                run(r"sed -i -e 's/-Werror //' src/Makefile") # lastz.c defines 3 variables it doesn't use, and -Werror breaks the build
-                run("make")
-                install_cmd("make LASTZ_INSTALL=%s install" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- LASTZ %s installed to %s -----" % (version, install_dir)))
-
-def _install_perm():
-    version = '3.0'
-    url = 'http://perm.googlecode.com/files/PerM_Linux64%28noOpenMp%29.gz'
-    pkg_name = 'perm'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget -O PerM.gz %s" % url)
-            run("gunzip PerM.gz")
-            install_cmd("mv PerM %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh %s/PerM" % (install_dir, install_dir))
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- PerM %s installed to %s -----" % (version, install_dir)))
-
-def _install_gatk():
-    version = '1.2-65-ge4a583a'
-    url = 'ftp://ftp.broadinstitute.org/pub/gsa/GenomeAnalysisTK/GenomeAnalysisTK-%s.tar.bz2' % version
-    pkg_name = 'gatk'
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-       install_cmd("mkdir -p %s" % install_dir)
-       install_cmd("mkdir -p %s/bin" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget -O gatk.tar.bz2 %s" % url)
-            run("tar -xjf gatk.tar.bz2")
-            install_cmd("cp GenomeAnalysisTK-%s/GenomeAnalysisTK.jar %s/bin" % ( version, install_dir) )
-    # Create shell script to wrap jar
-    sudo("echo '#!/bin/sh' > %s/bin/gatk" % ( install_dir ) )
-    sudo("echo 'java -jar %s/bin/GenomeAnalysisTK.jar $@' >> %s/bin/gatk" % ( install_dir, install_dir ) )
-    sudo("chmod +x %s/bin/gatk" % install_dir)
-    # env file
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    # default link
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    # Link jar to Galaxy's jar dir
-    jar_dir = os.path.join(env.galaxy_home, 'tool-data', 'shared', 'jars', pkg_name)
-    if not exists(jar_dir):
-        install_cmd("mkdir -p %s" % jar_dir)
-    tool_dir = os.path.join(env.install_dir, pkg_name, 'default', 'bin')
-    install_cmd('ln --force --symbolic %s/*.jar %s/.' % (tool_dir, jar_dir))
-    install_cmd('chown --recursive %s:%s %s' % (env.galaxy_user, env.galaxy_user, jar_dir))
-    print(green("----- GATK %s installed to %s -----" % (version, install_dir)))
-
-def _install_srma():
-    version = '0.1.15'
-    mirror_info = "?use_mirror=voxel"
-    url = 'http://downloads.sourceforge.net/project/srma/srma/%s/srma-%s.jar' \
-            % (version[:3], version)
-    pkg_name = 'srma'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s%s -O %s" % (url, mirror_info, os.path.split(url)[-1]))
-            install_cmd("mv srma-%s.jar %s" % (version, install_dir))
-            install_cmd("ln -s srma-%s.jar %s/srma.jar" % (version, install_dir))
-    sudo("touch %s/env.sh" % install_dir)
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- SRMA %s installed to %s -----" % (version, install_dir)))
-
-def _install_beam():
-    version = '2.0'
-    url = 'http://www.stat.psu.edu/~yuzhang/software/beam2.tar'
-    pkg_name = 'beam'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s -O %s" % (url, os.path.split(url)[-1]))
-            run("tar xf %s" % (os.path.split(url)[-1]))
-            install_cmd("mv BEAM2 %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_pass():
-    version = '2.0'
-    url = 'http://www.stat.psu.edu/~yuzhang/software/pass2.tar'
-    pkg_name = 'pass'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s -O %s" % (url, os.path.split(url)[-1]))
-            run("tar xf %s" % (os.path.split(url)[-1]))
-            install_cmd("mv pass2 %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_lps_tool():
-    version = '2010.09.30'
-    url = 'http://www.bx.psu.edu/miller_lab/dist/lps_tool.%s.tar.gz' % version
-    pkg_name = 'lps_tool'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s -O %s" % (url, os.path.split(url)[-1]))
-            run("tar zxf %s" % (os.path.split(url)[-1]))
-            install_cmd("./lps_tool.%s/MCRInstaller.bin -P bean421.installLocation=\"%s/MCR\" -silent" % (version, install_dir))
-            install_cmd("mv lps_tool.%s/lps_tool %s" % (version, install_dir))
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("echo 'MCRROOT=%s/MCR/v711; export MCRROOT' >> %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_plink():
-    version = '1.07'
-    url = 'http://pngu.mgh.harvard.edu/~purcell/plink/dist/plink-%s-x86_64.zip' % version
-    pkg_name = 'plink'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s -O %s" % (url, os.path.split(url)[-1]))
-            run("unzip %s" % (os.path.split(url)[-1]))
-            install_cmd("mv plink-%s-x86_64/plink %s" % (version, install_dir))
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_fbat():
-    version = '2.0.3'
-    url = 'http://www.biostat.harvard.edu/~fbat/software/fbat%s_linux64.tar.gz' % version.replace('.', '')
-    pkg_name = 'fbat'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s -O %s" % (url, os.path.split(url)[-1]))
-            run("tar zxf %s" % (os.path.split(url)[-1]))
-            install_cmd("mv fbat %s" % install_dir)
-    sudo("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_haploview():
-    version = '4.2b'
-    url = 'http://www.broadinstitute.org/ftp/pub/mpg/haploview/Haploview_beta.jar'
-    pkg_name = 'haploview'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s -O %s" % (url, os.path.split(url)[-1]))
-            install_cmd("mv %s %s" % (os.path.split(url)[-1], install_dir))
-            install_cmd("ln -s %s %s/haploview.jar" % (os.path.split(url)[-1], install_dir))
-    sudo("touch %s/env.sh" % install_dir)
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_eigenstrat():
-    version = '3.0'
-    url = 'http://www.hsph.harvard.edu/faculty/alkes-price/files/EIG%s.tar.gz' % version
-    pkg_name = 'eigenstrat'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s -O %s" % (url, os.path.split(url)[-1]))
-            run("tar zxf %s" % (os.path.split(url)[-1]))
-            install_cmd("mv bin %s" % install_dir)
-    sudo("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
-def _install_mosaik():
-    version = "1.1.0021"
-    url = "http://mosaik-aligner.googlecode.com/files/Mosaik-%s-Linux-x64.tar.bz2" % version
-    pkg_name = 'mosaik'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s -O %s" % (url, os.path.split(url)[-1]))
-            install_cmd("tar -xjvpf %s -C %s" % (os.path.split(url)[-1], install_dir))
-    with cd(install_dir):
-        with cd("mosaik-aligner"):
-            install_cmd("rm -rf data/ MosaikTools/ src/")
-        install_cmd("mv mosaik-aligner/* .")
-        install_cmd("rm -rf mosaik-aligner")
-    install_cmd("echo 'PATH=%s/bin:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    install_cmd("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
-
 def _install_freebayes():
     version = time.strftime("%Y-%m-%d") # set version to today's date considering it's a repo
     url = "git://github.com/ekg/freebayes.git"
@@ -1032,46 +432,9 @@ def _install_freebayes():
             with cd("freebayes"):
                 install_cmd("make")
                 install_cmd("mv bin/* %s" % install_dir)
-    install_cmd("echo 'PATH=%s:$PATH' > %s/env.sh" % (install_dir, install_dir))
-    install_cmd("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
+    _finish_install(pkg_name, install_dir, path='', update_default=True)
     print(green("----- %s %s installed to %s -----" % (pkg_name, version, install_dir)))
 
-def _install_picard():
-    version = '1.55'
-    mirror_info = "?use_mirror=voxel"
-    url = 'http://downloads.sourceforge.net/project/picard/picard-tools/%s/picard-tools-%s.zip' \
-            % (version, version)
-    pkg_name = 'picard'
-    install_dir = os.path.join(env.install_dir, pkg_name, version)
-    install_cmd = sudo if env.use_sudo else run
-    if not exists(install_dir):
-        install_cmd("mkdir -p %s" % install_dir)
-    with _make_tmp_dir() as work_dir:
-        with cd(work_dir):
-            run("wget %s%s -O %s" % (url, mirror_info, os.path.split(url)[-1]))
-            run("unzip %s" % (os.path.split(url)[-1]))
-            install_cmd("mv picard-tools-%s/*.jar %s" % (version, install_dir))
-    sudo("touch %s/env.sh" % install_dir)
-    sudo("chmod +x %s/env.sh" % install_dir)
-    install_dir_root = os.path.join(env.install_dir, pkg_name)
-    if env.update_default:
-        sudo('ln --symbolic --no-dereference --force %s %s/default' % (install_dir, install_dir_root))
-    else:
-        sudo('if [ ! -d %s/default ]; then ln -s %s %s/default; fi' % (install_dir_root, install_dir, install_dir_root))
-    # set up the jars directory
-    jar_dir = os.path.join(env.galaxy_home, 'tool-data', 'shared', 'jars', 'picard')
-    if not exists(jar_dir):
-        install_cmd("mkdir -p %s" % jar_dir)
-    tool_dir = os.path.join(env.install_dir, pkg_name, 'default')
-    install_cmd('ln --force --symbolic %s/*.jar %s/.' % (tool_dir, jar_dir))
-    install_cmd('chown --recursive %s:%s %s' % (env.galaxy_user, env.galaxy_user, jar_dir))
-    print(green("----- Picard %s installed to %s and linked to %s -----" % (version, install_dir, jar_dir)))
-
 def _install_fastqc():
     """ This tool is installed in Galaxy's jars dir """
     version = '0.10.0'
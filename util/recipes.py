@@ -0,0 +1,121 @@
+""" Install tools described by the recipes in conf_files/tool_recipes.yaml
+    (see there for the recipe format).
+    All of the steps of a recipe are run on the host as a single script (see
+    util/remote_script.py), instead of one SSH command per step.
+    Downloads are kept in a cache directory on the host shared by all
+    recipes, under the recipe's name and version, so reinstalling a tool does
+    not download it again, and are checked against the recipe's checksum if
+    it has one.
+"""
+import os
+import pipes
+
+import yaml
+from fabric.api import *
+from fabric.colors import green
+
+from util.scheduler import _job
+from util.remote_script import RemoteScript
+
+RECIPES_FILE = os.path.join('conf_files', 'tool_recipes.yaml')
+
+def _load_recipes(recipes_file=RECIPES_FILE):
+    """ Return the enabled recipes, in the order they are listed.
+    """
+    with open(recipes_file) as f:
+        recipes = yaml.safe_load(f)['recipes']
+    return [r for r in recipes if r.get('enabled', True)]
+
+def _recipe_jobs(recipes):
+    """ Scheduler jobs (see util/scheduler.py) installing recipes.
+    """
+    return [_job(r['name'], lambda r=r: _install_recipe(r), r.get('kind', 'build'), r.get('requires'))
+            for r in recipes]
+
+def _recipe_values(recipe):
+    version = str(recipe['version'])
+    package = recipe.get('package', recipe['name'])
+    values = {'name': recipe['name'], 'package': package, 'version': version,
+              'install_root': os.path.join(env.install_dir, package),
+              'install_dir': os.path.join(env.install_dir, package, version)}
+    for key, value in recipe.get('vars', {}).items():
+        values[key] = str(value)
+    return values
+
+def _unpack_command(file_name, cached):
+    q = pipes.quote(cached)
+    if file_name.endswith('.zip'):
+        return "unzip -q %s" % q
+    if file_name.endswith('.tar.gz') or file_name.endswith('.tgz'):
+        return "tar -xzf %s" % q
+    if file_name.endswith('.tar.bz2'):
+        return "tar -xjf %s" % q
+    if file_name.endswith('.tar'):
+        return "tar -xf %s" % q
+    if file_name.endswith('.gz'):
+        return "gunzip -c %s > %s" % (q, pipes.quote(file_name[:-3]))
+    return "cp %s ." % q
+
+def _recipe_script(recipe):
+    """ The RemoteScript (see util/remote_script.py) installing recipe.
+    """
+    v = _recipe_values(recipe)
+    t = lambda s: str(s) % v
+    sudo_cmd = 'sudo ' if env.use_sudo else ''
+    url = t(recipe['url'])
+    file_name = t(recipe.get('file', os.path.basename(url.split('?')[0])))
+    # Keyed by version too: several recipes download to a fixed file name
+    cache_root = os.path.join(env.tmp_dir, 'fab_download_cache')
+    cache_dir = os.path.join(cache_root, v['name'], v['version'])
+    cached = os.path.join(cache_dir, file_name)
+    install_dir = v['install_dir']
+    script = RemoteScript("%s %s" % (v['name'], v['version']))
+    script.add("work_dir=$(%smktemp -d %s) && %schown %s \"$work_dir\" && trap '%srm -rf \"$work_dir\"' EXIT"
+                % (sudo_cmd, os.path.join(env.tmp_dir, 'fab_tmp_%s.XXXXXX' % v['name']), sudo_cmd, env.user, sudo_cmd),
+               "Create work dir")
+    script.add("{ [ -d %s ] || { %smkdir -p %s && %schown %s %s; }; } && mkdir -p %s"
+                % (cache_root, sudo_cmd, cache_root, sudo_cmd, env.user, cache_root, cache_dir),
+               "Create download cache")
+    script.add("[ -s %s ] || { wget -nv %s -O %s.part.$$ %s && mv %s.part.$$ %s; }"
+                % (pipes.quote(cached), t(recipe.get('wget', '')), pipes.quote(cached), pipes.quote(url),
+                   pipes.quote(cached), pipes.quote(cached)),
+               "Download %s" % url)
+    for algorithm in ['md5', 'sha256']:
+        if recipe.get(algorithm):
+            script.add("echo %s | %ssum -c --status || { echo 'Checksum mismatch'; rm -f %s; exit 1; }"
+                        % (pipes.quote("%s  %s" % (recipe[algorithm], cached)), algorithm, pipes.quote(cached)),
+                       "Check %s of %s" % (algorithm, file_name))
+    script.add('cd "$work_dir" && %s' % _unpack_command(file_name, cached), "Unpack %s" % file_name)
+    script.add("%smkdir -p %s" % (sudo_cmd, install_dir))
+    script.add('cd "$work_dir"/%s' % t(recipe.get('dir', '.')))
+    for step in recipe.get('build', []):
+        script.add(t(step))
+    for step in recipe.get('install', []):
+        script.add(t(step), sudo=True)
+    env_lines = []
+    if recipe.get('path') is not None:
+        env_lines.append("PATH=%s:$PATH" % os.path.join(install_dir, t(recipe['path'])).rstrip('/'))
+    env_lines += [t(line) for line in recipe.get('env', [])]
+    script.add("printf '%%s\\n' %s | %stee %s/env.sh > /dev/null && %schmod +x %s/env.sh"
+                % (' '.join([pipes.quote(l) for l in env_lines]), sudo_cmd, install_dir, sudo_cmd, install_dir)
+               if env_lines else "%stouch %s/env.sh && %schmod +x %s/env.sh" % (sudo_cmd, install_dir, sudo_cmd, install_dir),
+               "Write env.sh")
+    if recipe.get('update_default') and env.update_default:
+        script.add("%sln --symbolic --no-dereference --force %s %s/default" % (sudo_cmd, install_dir, v['install_root']))
+    else:
+        script.add("[ -d %s/default ] || %sln -s %s %s/default" % (v['install_root'], sudo_cmd, install_dir, v['install_root']))
+    if recipe.get('jars'):
+        jar_dir = os.path.join(env.galaxy_home, 'tool-data', 'shared', 'jars', v['package'])
+        script.add("%smkdir -p %s && %sln --force --symbolic %s/%s %s/. && %schown --recursive %s:%s %s"
+                    % (sudo_cmd, jar_dir, sudo_cmd, os.path.join(v['install_root'], 'default'), t(recipe['jars']),
+                       jar_dir, sudo_cmd, env.galaxy_user, env.galaxy_user, jar_dir),
+                   "Link jars into %s" % jar_dir)
+    return script
+
+def _install_recipe(recipe):
+    """ Install the tool described by recipe on the current host.
+    """
+    v = _recipe_values(recipe)
+    results = _recipe_script(recipe).run()
+    if not [r for r in results if r['rc'] != 0]:
+        print(green("----- %s %s installed to %s -----" % (v['name'], v['version'], v['install_dir'])))
@@ -0,0 +1,100 @@
+""" Run a series of shell commands on the current host as one script, in a
+    single SSH command (and a single login shell) instead of one per command.
+    The script is sent base64 encoded and run by bash with no stdin. Every
+    command is labeled, and its exit code and duration are reported back; by
+    default the script stops at the first command that fails.
+    For example:
+
+        script = RemoteScript("xvfb links", use_sudo=True)
+        for rc in range(7):
+            script.add("ln -sf /etc/init.d/xvfb /etc/rc%s.d/K01xvfb" % rc)
+        script.run()
+
+    Commands run in the same shell, one after the other, so a command can
+    use the working directory and variables set by earlier ones. Only use it
+    for commands that do not depend on Python logic in between.
+"""
+import re
+import pipes
+import base64
+
+from fabric.api import *
+from fabric.colors import red, yellow
+
+MARKER = '##remote_script##'
+
+class RemoteScript(object):
+    def __init__(self, name, use_sudo=False, stop_on_error=True):
+        """ use_sudo runs the whole script with sudo; individual commands can
+            also be run with sudo (see add), which has to work without a
+            password.
+        """
+        self.name = name
+        self.use_sudo = use_sudo
+        self.stop_on_error = stop_on_error
+        self.steps = []
+
+    def add(self, command, label=None, sudo=False):
+        """ Append command, shown and reported as label (the command itself by
+            default). With sudo, only this command is run with sudo (when
+            env.use_sudo is set). Returns the script, so calls can be chained.
+        """
+        if sudo and env.use_sudo and not self.use_sudo:
+            command = "sudo sh -c %s" % pipes.quote(command)
+        self.steps.append({'label': label or command, 'command': command})
+        return self
+
+    def script(self):
+        """ The bash script running the commands.
+        """
+        lines = []
+        for i, step in enumerate(self.steps):
+            lines += ["echo %s" % pipes.quote("%s %s >>> %s" % (MARKER, i, step['label'])),
+                      "__start=$(date +%s%N)",
+                      "{",
+                      step['command'],
+                      "}",
+                      "__rc=$?",
+                      "echo \"%s %s $__rc $(( ($(date +%%s%%N) - __start) / 1000000 ))\"" % (MARKER, i)]
+            if self.stop_on_error:
+                lines.append("[ $__rc -eq 0 ] || exit $__rc")
+        lines.append("exit 0")
+        return '\n'.join(lines) + '\n'
+
+    def run(self):
+        """ Run the script on the current host. Returns a list of the results
+            of the commands in order, each a dict with the command's label, rc
+            (its exit code, or None if it did not run) and seconds. Aborts if
+            a command fails, unless env.warn_only is set.
+        """
+        if not self.steps:
+            return []
+        # The script is run from a file with stdin at /dev/null: piped into
+        # bash, any command reading stdin would eat the rest of the script
+        command = ("f=$(mktemp /tmp/remote_script.XXXXXX) && echo %s | base64 -d > $f && "
+                   "{ bash $f < /dev/null; rc=$?; rm -f $f; exit $rc; }" % base64.b64encode(self.script()))
+        print(yellow("Running '%s' (%s commands)" % (self.name, len(self.steps))))
+        with settings(warn_only=True):
+            output = (sudo if self.use_sudo and env.use_sudo else run)(command)
+        results = [{'label': step['label'], 'rc': None, 'seconds': None} for step in self.steps]
+        started = None
+        for line in output.splitlines():
+            m = re.match(r'^%s (\d+) (>>> |(\d+) (\d+)\s*$)' % MARKER, line.strip())
+            if m and m.group(3) is None:
+                started = int(m.group(1))
+            elif m:
+                i = int(m.group(1))
+                results[i]['rc'] = int(m.group(3))
+                results[i]['seconds'] = int(m.group(4)) / 1000.0
+        if output.failed and started is not None and results[started]['rc'] is None:
+            # The command exited the script itself
+            results[started]['rc'] = output.return_code
+        failed = [r for r in results if r['rc']]
+        if output.failed and not failed:
+            failed = [{'label': self.name, 'rc': output.return_code}]
+        if failed:
+            message = "'%s' failed at '%s' (exit code %s)" % (self.name, failed[0]['label'], failed[0]['rc'])
+            if self.stop_on_error and not env.warn_only:
+                abort(message)
+            print(red(message))
+        return results
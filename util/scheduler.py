@@ -0,0 +1,136 @@
+""" Run a set of installer functions against the current host in parallel.
+    Each job is a function along with the jobs it requires and its kind:
+    'fetch' jobs mostly download and unpack prebuilt files and can run many
+    at a time, while 'build' jobs compile and are limited to the number of
+    cores on the host. A job starts as soon as the jobs it requires have
+    finished, so downloads overlap each other and the compilation of other
+    tools.
+    Fabric's env and connections are not thread safe (e.g. cd() changes the
+    global env), so every job runs in a child process that opens its own
+    connections. A job that fails only causes the jobs requiring it to be
+    skipped; all jobs' results and durations are listed in a summary table.
+"""
+import os
+import sys
+import time
+import tempfile
+import traceback
+import multiprocessing
+import datetime as dt
+
+from fabric.api import *
+from fabric import state
+from fabric.colors import green, yellow, red
+
+FETCH_SLOTS = 6 # Fetch jobs run at the same time
+POLL = 0.5 # Seconds between checks for finished jobs
+
+def _job(name, func, kind='build', requires=None):
+    """ Describe a job running func; kind is 'fetch' or 'build'.
+    """
+    return {'name': name, 'func': func, 'kind': kind, 'requires': requires or []}
+
+def _host_cores():
+    with settings(hide('everything'), warn_only=True):
+        cores = run("grep -c ^processor /proc/cpuinfo")
+    try:
+        return max(int(cores.strip()), 1)
+    except ValueError:
+        return 1
+
+def _job_main(job, log_file, conn):
+    """ Body of the child process running job; sends the error, if any, to conn.
+    """
+    # The parent's connections are shared with this process; drop them
+    # (without closing them) so this job opens its own
+    state.connections.clear()
+    env.job_name = job['name']
+    sys.stdout = sys.stderr = open(log_file, 'w', 0)
+    try:
+        job['func']()
+        conn.send(None)
+    except SystemExit: # abort() has logged why
+        conn.send("aborted")
+    except BaseException, e:
+        traceback.print_exc()
+        conn.send(str(e) or e.__class__.__name__)
+
+def _run_jobs(jobs, build_slots=None, fetch_slots=FETCH_SLOTS, log_dir=None):
+    """ Run jobs (see _job) and print a summary of the results. Returns True
+        if all of the jobs succeeded.
+    """
+    build_slots = build_slots or _host_cores()
+    log_dir = log_dir or tempfile.mkdtemp(prefix='install_logs_')
+    slots = {'build': build_slots, 'fetch': fetch_slots}
+    names = [job['name'] for job in jobs]
+    for job in jobs:
+        if job['kind'] not in slots:
+            raise ValueError("Job '%s' has unknown kind '%s'; expected one of %s"
+                % (job['name'], job['kind'], ', '.join(sorted(slots))))
+        for req in job['requires']:
+            if req not in names:
+                raise ValueError("Job '%s' requires unknown job '%s'" % (job['name'], req))
+    print(yellow("Running %s jobs, up to %s builds and %s fetches at a time; logs are in '%s'"
+        % (len(jobs), build_slots, fetch_slots, log_dir)))
+    pending = list(jobs)
+    running = {} # name -> (process, connection, job, start time)
+    status = {} # name -> {'status', 'kind', 'duration', 'error'}
+    while pending or running:
+        for job in list(pending):
+            failed = [r for r in job['requires'] if status.get(r, {}).get('status') in ('failed', 'skipped')]
+            if failed:
+                pending.remove(job)
+                status[job['name']] = {'status': 'skipped', 'kind': job['kind'], 'duration': None,
+                                       'error': "requires %s" % ', '.join(failed)}
+                print(red("Skipping '%s': it requires %s" % (job['name'], ', '.join(failed))))
+                continue
+            if [r for r in job['requires'] if status.get(r, {}).get('status') != 'ok']:
+                continue
+            if len([r for r in running.values() if r[2]['kind'] == job['kind']]) >= slots[job['kind']]:
+                continue
+            pending.remove(job)
+            log_file = os.path.join(log_dir, '%s.log' % job['name'])
+            parent_conn, child_conn = multiprocessing.Pipe(False)
+            p = multiprocessing.Process(target=_job_main, args=(job, log_file, child_conn))
+            p.start()
+            running[job['name']] = (p, parent_conn, job, time.time())
+            print("Started '%s' (%s)" % (job['name'], job['kind']))
+        if pending and not running:
+            # Nothing is running and nothing can start: the remaining jobs
+            # require each other
+            for job in pending:
+                status[job['name']] = {'status': 'skipped', 'kind': job['kind'], 'duration': None,
+                                       'error': "dependency cycle"}
+                print(red("Skipping '%s': dependency cycle" % job['name']))
+            pending = []
+            continue
+        time.sleep(POLL)
+        for name, (p, conn, job, start) in running.items():
+            if p.is_alive():
+                continue
+            p.join()
+            del running[name]
+            duration = time.time() - start
+            error = conn.recv() if conn.poll() else "exited with code %s" % p.exitcode
+            status[name] = {'status': 'failed' if error else 'ok', 'kind': job['kind'],
+                            'duration': duration, 'error': error}
+            if error:
+                print(red("'%s' FAILED after %s: %s" % (name, dt.timedelta(seconds=int(duration)), error)))
+            else:
+                print(green("'%s' done in %s" % (name, dt.timedelta(seconds=int(duration)))))
+    _print_summary(jobs, status, log_dir)
+    return not [s for s in status.values() if s['status'] != 'ok']
+
+def _print_summary(jobs, status, log_dir):
+    width = max([len(job['name']) for job in jobs] + [4])
+    header = "%-*s %-6s %-8s %10s  %s" % (width, 'tool', 'kind', 'status', 'duration', 'notes')
+    print(header)
+    print('-' * len(header))
+    for job in jobs:
+        s = status[job['name']]
+        line = "%-*s %-6s %-8s %10s  %s" % (width, job['name'], s['kind'], s['status'],
+            dt.timedelta(seconds=int(s['duration'])) if s['duration'] is not None else '-',
+            s['error'] or '')
+        if s['status'] == 'failed':
+            line += " (see %s)" % os.path.join(log_dir, '%s.log' % job['name'])
+        print(line if s['status'] == 'ok' else red(line))
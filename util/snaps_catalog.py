@@ -0,0 +1,232 @@
+""" Read and publish the snapshot catalog (snaps.yaml) kept in a bucket,
+    which tells CloudMan which snapshot to create each of its file systems from.
+    The last copy read from each bucket is cached locally together with its
+    ETag, so reading an unchanged catalog costs a single HEAD request.
+    Publishing is optimistic: the new catalog only replaces the one it was
+    made from (checked by ETag, and sent with If-Match), so two concurrent
+    updates cannot silently overwrite each other. Every replaced catalog is
+    kept under a dated history key, and a JSON index of the file systems
+    (snaps.json) is published next to it for readers that only need to look
+    up a snapshot by file system and region. The index records the ETag of
+    the catalog it was made from and is replaced conditionally as well.
+"""
+import os
+import json
+import shutil
+import tempfile
+import datetime as dt
+
+import yaml
+from boto.exception import S3ResponseError
+from fabric.colors import red, yellow
+
+import s3_transfer
+
+CATALOG_KEY = 'snaps.yaml'
+INDEX_KEY = 'snaps.json'
+HISTORY_PREFIX = 'snaps_history/'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.snaps_catalog')
+CONFLICT_RETRIES = 3 # Times a publish that lost a race is redone on the newer catalog
+ALL_USERS = 'http://acs.amazonaws.com/groups/global/AllUsers'
+
+class CatalogConflict(Exception):
+    """ The catalog in the bucket changed since it was read.
+    """
+    pass
+
+def _cache_paths(bucket_name):
+    cache_dir = os.path.join(CACHE_DIR, bucket_name)
+    return os.path.join(cache_dir, CATALOG_KEY), os.path.join(cache_dir, CATALOG_KEY + '.etag')
+
+def _cache_catalog(bucket_name, local_file, etag):
+    """ Move local_file into the cache as bucket_name's catalog with the given ETag.
+    """
+    catalog_file, etag_file = _cache_paths(bucket_name)
+    if not os.path.isdir(os.path.dirname(catalog_file)):
+        os.makedirs(os.path.dirname(catalog_file))
+    shutil.move(local_file, catalog_file)
+    with open(etag_file, 'w') as f:
+        f.write(etag)
+
+def _cached_etag(bucket_name):
+    catalog_file, etag_file = _cache_paths(bucket_name)
+    if os.path.exists(catalog_file) and os.path.exists(etag_file):
+        with open(etag_file) as f:
+            return f.read().strip()
+    return None
+
+def _read_catalog(bucket):
+    """ Return the catalog in bucket as a dict along with its ETag, or
+        (None, None) if the bucket has no catalog. The cached copy is used
+        when its ETag matches the catalog's.
+    """
+    key = bucket.get_key(CATALOG_KEY)
+    if key is None:
+        print(red("Could not find '%s' in bucket '%s'" % (CATALOG_KEY, bucket.name)))
+        return None, None
+    catalog_file = _cache_paths(bucket.name)[0]
+    if _cached_etag(bucket.name) != key.etag:
+        fd, tmp_file = tempfile.mkstemp(prefix='snaps-', suffix='.yaml')
+        os.close(fd)
+        try:
+            s3_transfer.download_key(key, tmp_file)
+            _cache_catalog(bucket.name, tmp_file, key.etag)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    with open(catalog_file) as f:
+        return yaml.safe_load(f), key.etag
+
+def _set_snapshot(catalog, filesystem, snap_id, size):
+    """ Point filesystem's entry in catalog at snap_id. Returns False if the
+        catalog has no such file system.
+    """
+    found = False
+    for fs in catalog.get('static_filesystems', []):
+        if fs.get('filesystem') == filesystem:
+            fs['snap_id'] = snap_id
+            fs['size'] = size
+            found = True
+    return found
+
+def _catalog_index(catalog, region):
+    """ The JSON index of catalog: each file system's entry, keyed by file
+        system name and then region.
+    """
+    filesystems = {}
+    for fs in catalog.get('static_filesystems', []):
+        entry = dict([(k, v) for k, v in fs.items() if k != 'filesystem'])
+        filesystems.setdefault(fs.get('filesystem'), {})[region] = entry
+    return {'updated': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'filesystems': filesystems}
+
+def _is_public(key):
+    try:
+        return any([g.uri == ALL_USERS and g.permission in ('READ', 'FULL_CONTROL')
+                    for g in key.get_acl().acl.grants])
+    except S3ResponseError:
+        return False
+
+def _history_key_name(key):
+    """ Name the catalog in key is kept under once replaced, after the time it
+        was published.
+    """
+    try:
+        published = dt.datetime.strptime(key.last_modified, "%a, %d %b %Y %H:%M:%S GMT")
+    except (TypeError, ValueError):
+        published = dt.datetime.utcnow()
+    return "%ssnaps-%s.yaml" % (HISTORY_PREFIX, published.strftime('%Y-%m-%d-%H%M%S'))
+
+def _publish_catalog(bucket, catalog, etag, region, **metadata):
+    """ Replace the catalog in bucket with catalog, provided the one there still
+        has the given ETag (raises CatalogConflict otherwise). Once replaced,
+        the old catalog is kept under a history key and the index is updated;
+        the catalog's ACL is kept.
+    """
+    key = bucket.get_key(CATALOG_KEY)
+    if key is None or key.etag != etag:
+        raise CatalogConflict("'%s' in bucket '%s' changed since it was read" % (CATALOG_KEY, bucket.name))
+    acl_headers = {}
+    if _is_public(key):
+        acl_headers['x-amz-acl'] = 'public-read'
+    history_key = _history_key_name(key)
+    metadata['date_uploaded'] = str(dt.datetime.utcnow())
+    tmp_dir = tempfile.mkdtemp(prefix='snaps-')
+    try:
+        # Keep a copy of the catalog being replaced for its history entry,
+        # which is only written once the replacement has gone through
+        old_catalog_file = os.path.join(tmp_dir, 'old-' + CATALOG_KEY)
+        if _cached_etag(bucket.name) == etag:
+            shutil.copy(_cache_paths(bucket.name)[0], old_catalog_file)
+        else:
+            s3_transfer.download_key(key, old_catalog_file)
+        catalog_file = os.path.join(tmp_dir, CATALOG_KEY)
+        with open(catalog_file, 'w') as f:
+            yaml.safe_dump(catalog, f, default_flow_style=False)
+        try:
+            s3_transfer.upload_file(bucket, CATALOG_KEY, catalog_file, metadata=metadata,
+                headers=dict(acl_headers, **{'If-Match': etag}))
+        except S3ResponseError, e:
+            if e.status == 412: # If-Match failed: someone published in between
+                raise CatalogConflict("'%s' in bucket '%s' changed while publishing" % (CATALOG_KEY, bucket.name))
+            raise
+        new_etag = bucket.get_key(CATALOG_KEY).etag
+        s3_transfer.upload_file(bucket, history_key, old_catalog_file, headers=dict(acl_headers))
+        _publish_index(bucket, catalog, new_etag, region, tmp_dir, acl_headers, **metadata)
+        _cache_catalog(bucket.name, catalog_file, new_etag)
+    finally:
+        shutil.rmtree(tmp_dir)
+    print(yellow("Published '%s' to bucket '%s' (previous one kept as '%s')" % (CATALOG_KEY, bucket.name, history_key)))
+    return True
+
+def _publish_index(bucket, catalog, catalog_etag, region, tmp_dir, acl_headers, **metadata):
+    """ Publish the index of catalog, whose ETag in bucket is catalog_etag.
+        The index records that ETag and is only replaced if it did not change
+        since it was read; if it did, and the catalog was meanwhile replaced
+        too, the index is left to the newer catalog's publisher.
+    """
+    index = _catalog_index(catalog, region)
+    index['catalog_etag'] = catalog_etag
+    index_file = os.path.join(tmp_dir, INDEX_KEY)
+    with open(index_file, 'w') as f:
+        json.dump(index, f, sort_keys=True)
+    for attempt in range(CONFLICT_RETRIES + 1):
+        index_key = bucket.get_key(INDEX_KEY)
+        condition = {'If-Match': index_key.etag} if index_key else {'If-None-Match': '*'}
+        try:
+            s3_transfer.upload_file(bucket, INDEX_KEY, index_file, metadata=metadata,
+                headers=dict(acl_headers, **condition))
+            return True
+        except S3ResponseError, e:
+            if e.status != 412:
+                raise
+        if bucket.get_key(CATALOG_KEY).etag != catalog_etag:
+            print(yellow("'%s' in bucket '%s' was replaced again; leaving '%s' to its publisher"
+                % (CATALOG_KEY, bucket.name, INDEX_KEY)))
+            return False
+    print(red("Gave up publishing '%s' to bucket '%s' after %s conflicting updates"
+        % (INDEX_KEY, bucket.name, CONFLICT_RETRIES + 1)))
+    return False
+
+def _update_catalogs(buckets, filesystem, region_snaps, size, **metadata):
+    """ Point filesystem's entry at a new snapshot in the catalog of several
+        regions. buckets maps a region to its bucket and region_snaps a region
+        to its snapshot ID. Every catalog is read and checked before any is
+        published, so a missing catalog or file system leaves all of them
+        unchanged. A catalog that changes while publishing is read again and
+        the update redone on it. Returns True if every catalog was published.
+    """
+    pending = {}
+    for region, snap_id in region_snaps.items():
+        catalog, etag = _read_catalog(buckets[region])
+        if catalog is None or not _set_snapshot(catalog, filesystem, snap_id, size):
+            if catalog is not None:
+                print(red("No file system '%s' in '%s' in bucket '%s'" % (filesystem, CATALOG_KEY, buckets[region].name)))
+            print(red("Not updating '%s' in any region" % CATALOG_KEY))
+            return False
+        pending[region] = (catalog, etag)
+    ok = True
+    for region in sorted(pending):
+        catalog, etag = pending[region]
+        ok = _publish_with_retries(buckets[region], catalog, etag, region, filesystem,
+            region_snaps[region], size, **metadata) and ok
+    return ok
+
+def _publish_with_retries(bucket, catalog, etag, region, filesystem, snap_id, size, **metadata):
+    """ Publish catalog, redoing the update on a newer catalog each time the
+        publish loses a race with another one.
+    """
+    for attempt in range(CONFLICT_RETRIES + 1):
+        try:
+            return _publish_catalog(bucket, catalog, etag, region, **dict(metadata))
+        except CatalogConflict, e:
+            print(yellow("%s; reading it again" % e))
+            catalog, etag = _read_catalog(bucket)
+            if catalog is None or not _set_snapshot(catalog, filesystem, snap_id, size):
+                return False
+        except (S3ResponseError, IOError, s3_transfer.TransferError), e:
+            print(red("Failed to publish '%s' to bucket '%s': %s" % (CATALOG_KEY, bucket.name, e)))
+            return False
+    print(red("Gave up publishing '%s' to bucket '%s' after %s conflicting updates"
+        % (CATALOG_KEY, bucket.name, CONFLICT_RETRIES + 1)))
+    return False
@@ -0,0 +1,128 @@
+""" Map file systems and block devices on an instance to the EBS volumes
+    attached to it.
+    Only the volumes attached to the instance are requested from the API (using
+    the attachment.instance-id filter), and the results are cached for the rest
+    of the session. Device names are matched whatever the kernel calls them:
+    /dev/sdf attachments show up as /dev/xvdf on Xen and as an NVMe device whose
+    serial number is the volume ID on Nitro instances.
+"""
+import os
+import re
+
+from fabric.api import *
+from fabric.contrib.files import *
+from fabric.colors import red
+from boto.exception import EC2ResponseError
+
+_volume_cache = {} # instance ID -> volumes attached to it
+_device_cache = {} # (host, path) -> block device the path is on
+
+def _attached_volumes(ec2_conn, instance_id, refresh=False):
+    """ Return the volumes attached to instance_id.
+    """
+    if refresh or instance_id not in _volume_cache:
+        try:
+            _volume_cache[instance_id] = ec2_conn.get_all_volumes(
+                filters={'attachment.instance-id': instance_id})
+        except EC2ResponseError, e:
+            print(red("Error checking for attached volumes: {0}".format(e)))
+            return []
+    return _volume_cache[instance_id]
+
+def _forget_volumes(instance_id):
+    """ Drop what is cached about instance_id, e.g. after attaching or
+        detaching a volume.
+    """
+    _volume_cache.pop(instance_id, None)
+    for key in [k for k in _device_cache if k[0] == env.host_string]:
+        del _device_cache[key]
+
+def _attach_device(volume):
+    """ Device a volume was attached as. Eucalyptus reports it as
+        'unknown,requested:/dev/sdb'.
+    """
+    device = volume.attach_data.device or ''
+    return device.split(':')[-1]
+
+def _device_key(device):
+    """ Name of a device ignoring the sd/xvd/hd prefix renames, e.g. 'f' for
+        both /dev/sdf and /dev/xvdf, and 'a1' for /dev/sda1 and /dev/xvda1.
+    """
+    return re.sub(r'^(xv|s|h)d', '', os.path.basename(device))
+
+def _nvme_serials():
+    """ Map NVMe block devices on the current host to their serial numbers;
+        for EBS volumes the serial is the volume ID without the dash.
+    """
+    with settings(hide('everything'), warn_only=True):
+        out = run('for d in /sys/block/nvme*; do [ -e $d/device/serial ] && '
+                  'echo "$(basename $d) $(cat $d/device/serial)"; done')
+    serials = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            serials['/dev/%s' % parts[0]] = parts[1].strip()
+    return serials
+
+def _device_for_path(path):
+    """ Block device the file system holding path is mounted from.
+    """
+    key = (env.host_string, path)
+    if key not in _device_cache:
+        with settings(hide('everything'), warn_only=True):
+            device = run("findmnt -n -o SOURCE --target %s" % path)
+            if device.failed or not device.strip():
+                device = run("df -P %s | tail -n 1 | awk '{print $1}'" % path)
+        _device_cache[key] = device.strip()
+    return _device_cache[key]
+
+def _volume_for_device(ec2_conn, instance_id, device):
+    """ Return the volume attached to instance_id that is device on the
+        current host, or None.
+    """
+    volumes = _attached_volumes(ec2_conn, instance_id)
+    nvme = re.match(r'^(/dev/nvme\d+n\d+)(p\d+)?$', device)
+    if nvme:
+        serial = _nvme_serials().get(nvme.group(1), '')
+        volume_id = re.sub(r'^vol-?', 'vol-', serial)
+        for volume in volumes:
+            if volume.id == volume_id:
+                return volume
+        return None
+    key = _device_key(device)
+    for volume in volumes:
+        if _device_key(_attach_device(volume)) == key:
+            return volume
+    # A file system on a partition of a volume attached as a whole device
+    key = key.rstrip('0123456789')
+    for volume in volumes:
+        if _device_key(_attach_device(volume)) == key:
+            return volume
+    return None
+
+def _volume_for_path(ec2_conn, instance_id, path):
+    """ Return the volume holding the file system at path on the current host
+        and the block device it is mounted from; the volume is None if it
+        cannot be found.
+    """
+    device = _device_for_path(path)
+    return _volume_for_device(ec2_conn, instance_id, device), device
+
+def _root_volume(ec2_conn, instance_id):
+    """ Return the volume the root file system of the current host is on,
+        or None.
+    """
+    return _volume_for_path(ec2_conn, instance_id, '/')[0]
+
+def _local_device(attach_device, volume_id):
+    """ Block device on the current host that a volume attached as
+        attach_device (e.g. /dev/sdf) shows up as.
+    """
+    for device, serial in _nvme_serials().items():
+        if re.sub(r'^vol-?', 'vol-', serial) == volume_id:
+            return device
+    with settings(hide('everything'), warn_only=True):
+        for device in [attach_device, re.sub(r'/(s|h)d', '/xvd', attach_device)]:
+            if run("test -b %s" % device).succeeded:
+                return device
+    return attach_device
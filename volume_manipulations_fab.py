@@ -4,24 +4,41 @@ automatically taking care of the system level operations.
 Fabric (http://docs.fabfile.org) is used to manage the automation of a remote server.
 
 Usage:
-    fab -f volume_manipulations_fab.py -i key_file -H servername make_snapshot[:galaxy]
+    fab -f volume_manipulations_fab.py -i key_file -H servername make_snapshot[:galaxy][,online=True]
+    fab -f volume_manipulations_fab.py replicate_snapshot:<snap_id>,"<region>;<region>"[,filesystem=<name>]
+
+EC2 and S3 requests go to AWS unless CM_EC2_URL and/or CM_S3_URL are set in the
+environment, e.g. to a local stand-in such as moto (http://localhost:5000).
 """
 
-import os, os.path, time, urllib, yaml
+import os, os.path, time
 import datetime as dt
+from urlparse import urlparse
 boto = __import__("boto")
+from boto.regioninfo import RegionInfo
 from boto.ec2.connection import EC2Connection
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 from boto.exception import EC2ResponseError, S3ResponseError
 
-from fabric.api import sudo, run, env
+from fabric.api import sudo, run, env, put, hide, abort
 from fabric.contrib.console import confirm
 from fabric.contrib.files import exists, settings
 from fabric.colors import red, green, yellow
 
+from util.volumes import _volume_for_path, _attach_device, _local_device, _forget_volumes
+from util.snaps_catalog import _update_catalogs
+
 GALAXY_HOME = "/mnt/galaxyTools/galaxy-central"
+GALAXY_URL = "http://127.0.0.1:8080"
+GALAXY_START_TIMEOUT = 600 # Seconds Galaxy is given to start answering requests
 DEFAULT_BUCKET_NAME = 'cloudman'
+DEFAULT_REGION = 'us-east-1'
+# Bucket holding snaps.yaml for each region snapshots are replicated to; defaults to <DEFAULT_BUCKET_NAME>-<region>
+REGION_BUCKETS = {DEFAULT_REGION: DEFAULT_BUCKET_NAME}
+# Regions make_snapshot offers to copy new snapshots to, e.g. ['us-west-1', 'eu-west-1']
+REPLICATION_REGIONS = []
+# Seconds after which the instance thaws a file system frozen for an online snapshot by itself
+FREEZE_TIMEOUT = 300
 # -- Adjust this link if using content from another location
 CDN_ROOT_URL = "http://userwww.service.emory.edu/~eafgan/content"
 
@@ -37,7 +54,7 @@ env.user = 'ubuntu'
 env.use_sudo = True
 env.shell = "/bin/bash -l -c"
 
-def make_snapshot(galaxy=None):
+def make_snapshot(galaxy=None, online=False):
     """ Create a snapshot of an existing volume that is currently attached to an
     instance, taking care of the unmounting and detaching. If you specify the
     optional argument (:galaxy), the script will pull the latest Galaxy code 
@@ -52,9 +69,15 @@ def make_snapshot(galaxy=None):
     Except for potentially Galaxy, MAKE SURE there are no running processes 
     using the volume and that no one is logged into the instance and sitting 
     in the given directory.
+    
+    With online=True (make_snapshot:galaxy,online=True), the volume stays
+    mounted and attached: the file system is frozen (fsfreeze/xfs_freeze) only
+    until the snapshot has been started, which captures its point-in-time
+    state, and Galaxy is started again while the snapshot completes.
     """
     time_start = dt.datetime.utcnow()
     print "Start time: %s" % time_start
+    online = str(online).lower() in ('true', 'yes', '1')
     # Check if we're creating a snapshot where Galaxy is installed & running
     if galaxy=='galaxy':
         galaxy=True
@@ -63,67 +86,161 @@ def make_snapshot(galaxy=None):
         galaxy=False
         # Ask the user what is the path of the volume that should be snapshoted
         fs_path = raw_input("What is the path for the file system to be snapshoted? ")
+    if online and not _freeze_command(fs_path):
+        print(red("ERROR: neither fsfreeze nor xfs_freeze can freeze '%s'; run make_snapshot without online=True" % fs_path))
+        return
     if galaxy:
+        galaxy_stopped = dt.datetime.utcnow()
         commit_num = _update_galaxy()
         _clean_galaxy_dir()
     
     instance_id = run("curl --silent http://169.254.169.254/latest/meta-data/instance-id")
     availability_zone = run("curl --silent http://169.254.169.254/latest/meta-data/placement/availability-zone")
     instance_region = availability_zone[:-1] # Truncate zone letter to get region name
-    # Find the device where the file system is mounted to
-    device_id = sudo("df | grep '%s' | awk '{print $1}'" % fs_path)
-    # Find the EBS volume where the file system resides
+    # Find the EBS volume where the file system resides and the device it is mounted from
     ec2_conn = _get_ec2_conn(instance_region)
-    vol_list = ec2_conn.get_all_volumes()
-    fs_vol = None
-    for vol in vol_list:
-        if vol.attach_data.instance_id==instance_id and vol.attach_data.status=='attached' and vol.attach_data.device == device_id:
-            fs_vol = vol
+    fs_vol, device_id = _volume_for_path(ec2_conn, instance_id, fs_path)
     if fs_vol:
-        print(yellow("Detected that '%s' is mounted from device '%s' and attached as volume '%s'" % (fs_path, device_id, fs_vol.id)))
-        sudo("umount %s" % fs_path)
-        _detach(ec2_conn, instance_id, fs_vol.id)
+        attach_device = _attach_device(fs_vol)
+        print(yellow("Detected that '%s' is mounted from device '%s' and attached as volume '%s' (%s)" % (fs_path, device_id, fs_vol.id, attach_device)))
         if galaxy:
             desc = "Galaxy (at commit %s) and tools" % commit_num
         else:
             desc = raw_input("Provide a short snapshot description: ")
-        snap_id = _create_snapshot(ec2_conn, fs_vol.id, desc)
+        if online:
+            snapshot = _start_online_snapshot(ec2_conn, fs_vol.id, fs_path, desc)
+            if galaxy:
+                _restart_galaxy_after_snapshot(galaxy_stopped)
+            snap_id = _wait_for_snapshot(ec2_conn, snapshot, fs_vol.id)
+        else:
+            sudo("umount %s" % fs_path)
+            _detach(ec2_conn, instance_id, fs_vol.id)
+            _forget_volumes(instance_id)
+            snap_id = _create_snapshot(ec2_conn, fs_vol.id, desc)
         print(green("--------------------------"))
         print(green("New snapshot ID: %s" % snap_id))
         print(green("--------------------------"))
         if galaxy:
-            if confirm("Would you like to update the file 'snaps.yaml' in '%s' bucket on S3 to include reference to the new Galaxy snapshot ID: '%s'" % (DEFAULT_BUCKET_NAME, snap_id)):
-                _update_snaps_latest_file('galaxyTools', snap_id, fs_vol.size, commit_num='Galaxy at commit %s' % commit_num)
-        if confirm("Would you like to make the newly created snapshot '%s' public?" % snap_id):
+            if confirm("Would you like to update the file 'snaps.yaml' in '%s' bucket on S3 to include reference to the new Galaxy snapshot ID: '%s'" % (_region_bucket(instance_region), snap_id)):
+                _update_snaps_latest_file('galaxyTools', snap_id, fs_vol.size, instance_region, commit_num='Galaxy at commit %s' % commit_num)
+        public = confirm("Would you like to make the newly created snapshot '%s' public?" % snap_id)
+        if public:
             ec2_conn.modify_snapshot_attribute(snap_id, attribute='createVolumePermission', operation='add', groups=['all'])
-        answer = confirm("Would you like to attach the *old* volume '%s' used to make the new snapshot back to instance '%s' and mount it as '%s'?" % (fs_vol.id, instance_id, fs_path))
-        if answer:
-            _attach(ec2_conn, instance_id, fs_vol.id, device_id)
-            sudo("mount %s %s" % (device_id, fs_path))
+        if REPLICATION_REGIONS and confirm("Would you like to copy snapshot '%s' to regions %s?" % (snap_id, ', '.join(REPLICATION_REGIONS))):
             if galaxy:
-                _start_galaxy()
-        elif confirm("Would you like to delete the *old* volume '%s' then?" % fs_vol.id):
-            _delete_volume(ec2_conn, fs_vol.id)
-        if not answer: # Old volume was not re-attached, maybe crete a new one 
-            if confirm("Would you like to create a new volume from the *new* snapshot '%s', attach it to the instance '%s' and mount it as '%s'?" % (snap_id, instance_id, fs_path)):
-                try:
-                    new_vol = ec2_conn.create_volume(fs_vol.size, fs_vol.zone, snapshot=snap_id)
-                    print(yellow("Created new volume of size '%s' from snapshot '%s' with ID '%s'" % (new_vol.size, snap_id, new_vol.id)))
-                    _attach(ec2_conn, instance_id, new_vol.id, device_id)
-                    sudo("mount %s %s" % (device_id, fs_path))
-                    if galaxy:
-                        answer = confirm("Would you like to start Galaxy on instance?")
-                        if answer:
-                            _start_galaxy()
-                except EC2ResponseError, e:
-                    print(red("Error creating volume: %s" % e))
+                _replicate_snapshot(snap_id, instance_region, REPLICATION_REGIONS, 'galaxyTools', public,
+                    commit_num='Galaxy at commit %s' % commit_num)
+            else:
+                _replicate_snapshot(snap_id, instance_region, REPLICATION_REGIONS, public=public)
+        if not online: # Otherwise the volume is still attached and mounted
+            answer = confirm("Would you like to attach the *old* volume '%s' used to make the new snapshot back to instance '%s' and mount it as '%s'?" % (fs_vol.id, instance_id, fs_path))
+            if answer:
+                _attach(ec2_conn, instance_id, fs_vol.id, attach_device)
+                device_id = _local_device(attach_device, fs_vol.id)
+                sudo("mount %s %s" % (device_id, fs_path))
+                if galaxy:
+                    _restart_galaxy_after_snapshot(galaxy_stopped)
+            elif confirm("Would you like to delete the *old* volume '%s' then?" % fs_vol.id):
+                _delete_volume(ec2_conn, fs_vol.id)
+            if not answer: # Old volume was not re-attached, maybe crete a new one 
+                if confirm("Would you like to create a new volume from the *new* snapshot '%s', attach it to the instance '%s' and mount it as '%s'?" % (snap_id, instance_id, fs_path)):
+                    try:
+                        new_vol = ec2_conn.create_volume(fs_vol.size, fs_vol.zone, snapshot=snap_id)
+                        print(yellow("Created new volume of size '%s' from snapshot '%s' with ID '%s'" % (new_vol.size, snap_id, new_vol.id)))
+                        _attach(ec2_conn, instance_id, new_vol.id, attach_device)
+                        device_id = _local_device(attach_device, new_vol.id)
+                        sudo("mount %s %s" % (device_id, fs_path))
+                        _hydrate_volume(fs_path, device_id)
+                        if galaxy:
+                            answer = confirm("Would you like to start Galaxy on instance?")
+                            if answer and not _start_galaxy():
+                                print(red("Galaxy did not start; see %s/paster.log" % GALAXY_HOME))
+                    except EC2ResponseError, e:
+                        print(red("Error creating volume: %s" % e))
         print(green("----- Done snapshoting volume '%s' for file system '%s' -----" % (fs_vol.id, fs_path)))
     else:
-        print(red("ERROR: cannot run this script without boto"))
+        print(red("ERROR: could not find the EBS volume attached to instance '%s' that '%s' is mounted from (device '%s')" % (instance_id, fs_path, device_id)))
     time_end = dt.datetime.utcnow()
     print(yellow("Duration of snapshoting: %s" % str(time_end-time_start)))
 
+def replicate_snapshot(snap_id, regions, source_region=DEFAULT_REGION, filesystem=None, public=False):
+    """Copy snapshot snap_id from source_region to every region in regions (separated
+    by ';') concurrently. Once all of the copies have completed, point filesystem's
+    entry in each region's snaps.yaml at the copy in that region (none are updated if
+    any copy fails). Copies are made public if public is set."""
+    time_start = dt.datetime.utcnow()
+    print "Start time: %s" % time_start
+    regions = [r.strip() for r in regions.split(';') if r.strip()]
+    public = str(public).lower() in ('true', 'yes', '1')
+    _replicate_snapshot(snap_id, source_region, regions, filesystem, public)
+    time_end = dt.datetime.utcnow()
+    print(yellow("Duration of snapshot replication: %s" % str(time_end-time_start)))
+
 ## ----- Helper methods -----
+def _replicate_snapshot(snap_id, source_region, regions, filesystem=None, public=False, **kwargs):
+    source_conn = _get_ec2_conn(source_region)
+    source_snap = source_conn.get_all_snapshots([snap_id])[0]
+    copies = {}
+    for region in regions:
+        ec2_conn = _get_ec2_conn(region)
+        try:
+            copy_id = ec2_conn.copy_snapshot(source_region, snap_id,
+                description="Copy of %s from %s: %s" % (snap_id, source_region, source_snap.description))
+            print(yellow("Copying snapshot '%s' to region '%s' as '%s'" % (snap_id, region, copy_id)))
+            copies[region] = (ec2_conn, copy_id)
+        except EC2ResponseError, e:
+            print(red("ERROR starting copy of snapshot '%s' to region '%s': %s" % (snap_id, region, e)))
+    statuses = _wait_for_snapshots(copies)
+    failed = [region for region in regions if statuses.get(region) != 'completed']
+    if failed:
+        print(red("Copying snapshot '%s' to regions %s failed; not updating any snaps.yaml" % (snap_id, ', '.join(failed))))
+        return False
+    for region, (ec2_conn, copy_id) in copies.items():
+        if public:
+            ec2_conn.modify_snapshot_attribute(copy_id, attribute='createVolumePermission', operation='add', groups=['all'])
+    print(green("Snapshot '%s' copied to %s" % (snap_id, ', '.join(["%s (%s)" % (region, copies[region][1]) for region in regions]))))
+    if filesystem:
+        return _update_snaps_latest_files(filesystem, dict([(region, copy_id) for region, (ec2_conn, copy_id) in copies.items()]),
+            source_snap.volume_size, **kwargs)
+    return True
+
+def _wait_for_snapshots(snapshots, poll=6):
+    """Wait for several snapshots, possibly in different regions, reporting the progress
+    of all of them together. snapshots maps a label (e.g. the region) to (ec2_conn, snap_id).
+    Returns a dict of each label's final status ('completed' or 'error')."""
+    s_time = dt.datetime.now()
+    statuses = {}
+    while len(statuses) < len(snapshots):
+        progress = []
+        for label, (ec2_conn, snap_id) in sorted(snapshots.items()):
+            if label in statuses:
+                continue
+            snapshot = ec2_conn.get_all_snapshots([snap_id])[0]
+            if snapshot.status in ('completed', 'error'):
+                statuses[label] = snapshot.status
+                print "Snapshot '%s' (%s) %s after %s" % (snap_id, label, snapshot.status, str(dt.datetime.now()-s_time).split('.')[0])
+            else:
+                progress.append("%s: %s %s" % (label, snapshot.id, snapshot.progress or '0%'))
+        if progress:
+            print "Snapshot progress (%s): %s" % (str(dt.datetime.now()-s_time).split('.')[0], '; '.join(progress))
+            time.sleep(poll)
+    return statuses
+
+def _region_bucket(region):
+    return REGION_BUCKETS.get(region, '%s-%s' % (DEFAULT_BUCKET_NAME, region))
+
+def _update_snaps_latest_files(filesystem, region_snaps, vol_size, **kwargs):
+    """Update filesystem's entry in the snaps.yaml of several regions' buckets
+    (region_snaps maps a region to its snapshot ID). All files are read and
+    checked first so that a problem with one of them leaves all of them unchanged."""
+    buckets = {}
+    for region in region_snaps:
+        buckets[region] = _get_bucket(_region_bucket(region))
+        if buckets[region] is None:
+            print(red("Not updating snaps.yaml in any region"))
+            return False
+    return _update_catalogs(buckets, filesystem, region_snaps, vol_size, **kwargs)
+
 def _update_galaxy():
     _stop_galaxy()
     # Because of a conflict in static/welcome.html file on cloud Galaxy and the
@@ -136,11 +253,8 @@ def _update_galaxy():
         sudo('cd %s; rm datatypes_conf.xml' % GALAXY_HOME)
     print(yellow("Upgrading Galaxy database"))
     sudo('su galaxy -c "cd %s; sh manage_db.sh upgrade"' % GALAXY_HOME)
-    # Start & stop Galaxy now to ensure all of the recent eggs get downloaded
-    # before a snapshot is created
-    print(yellow("Testing Galaxy via full start-stop"))
-    _start_galaxy()
-    _stop_galaxy()
+    # Fetch all of the recent eggs now to ensure they are included in the snapshot
+    _fetch_galaxy_eggs()
     return commit_num
 
 def _clean_galaxy_dir():
@@ -186,45 +300,66 @@ def _stop_galaxy():
 def _start_galaxy():
     print(yellow("Starting Galaxy"))
     sudo('su galaxy -c "source /etc/bash.bashrc; source /home/galaxy/.bash_profile; export SGE_ROOT=/opt/sge; cd /mnt/galaxyTools/galaxy-central; sh run.sh --daemon"')
-    # Wait for Galaxy to start - obviously this may result in an infinite
-    # loop so watch it...
-    # Also, this assumes Galaxy runs on 127.0.0.1:8080
-    counter = 0
-    while True:
-        galaxy_accessible = run('curl --silent 127.0.0.1:8080 > /dev/null; echo $?')
-        if galaxy_accessible == '0':
-            print(yellow("Galaxy started"))
-            break
-        print("Waiting for Galaxy to start...")
-        time.sleep(6)
-        counter += 1
-        if counter > 20:
-            print(red("This seems to be taking longer than expected. Manual check?"))
-
-def _update_snaps_latest_file(filesystem, snap_id, vol_size, **kwargs):
-    bucket_name = DEFAULT_BUCKET_NAME
-    remote_file_name = 'snaps.yaml'
-    remote_url = 'http://s3.amazonaws.com/%s/%s' % (bucket_name, remote_file_name)
-    downloaded_local_file = "downloaded-from-%s_snaps.yaml" % bucket_name
-    old_remote_file = generated_local_file = "snaps.yaml"
-    urllib.urlretrieve(remote_url, downloaded_local_file)
-    with open(downloaded_local_file) as f:
-        snaps_dict = yaml.load(f)
-    for fs in snaps_dict['static_filesystems']:
-        if fs['filesystem'] == filesystem:
-            fs['snap_id'] = snap_id
-            fs['size'] = vol_size
-    with open(generated_local_file, 'w') as f:
-        yaml.dump(snaps_dict, f, default_flow_style=False)
-    # Rename current old_remote_file to include date it was last modified
-    date_uploaded = _get_date_file_last_modified_on_S3(bucket_name, old_remote_file)
-    new_name_for_old_snaps_file = "snaps-%s.yaml" % date_uploaded
-    _rename_file_in_S3(new_name_for_old_snaps_file, bucket_name, old_remote_file)
-    # Save the new file to S3
-    return _save_file_to_bucket(bucket_name, remote_file_name, generated_local_file, **kwargs)
+    return _wait_for_galaxy()
+
+def _restart_galaxy_after_snapshot(galaxy_stopped):
+    """Start Galaxy again once the snapshot no longer needs it stopped, and
+    report how long it was down. The snapshot is not affected if it fails."""
+    if _start_galaxy():
+        print(yellow("Galaxy was down for %s" % str(dt.datetime.utcnow()-galaxy_stopped).split('.')[0]))
+    else:
+        print(red("Galaxy did not start again after the snapshot; see %s/paster.log" % GALAXY_HOME))
+
+def _wait_for_galaxy(timeout=GALAXY_START_TIMEOUT, max_delay=30):
+    """Wait for Galaxy to answer on GALAXY_URL. The checks run on the instance as a
+    single command, backing off exponentially up to max_delay seconds between them.
+    Gives up once timeout seconds have passed or as soon as the Galaxy process is
+    found to have died, showing the end of paster.log. Returns True if Galaxy is up."""
+    pid_file = os.path.join(GALAXY_HOME, "paster.pid")
+    log_file = os.path.join(GALAXY_HOME, "paster.log")
+    script = ("deadline=$((SECONDS + %(timeout)s)); delay=1; "
+              "while true; do "
+              "if curl --silent --max-time 10 --output /dev/null %(url)s; then echo \"Galaxy started after ${SECONDS}s\"; exit 0; fi; "
+              "if [ -f %(pid)s ] && [ ! -d /proc/$(cat %(pid)s) ]; then echo 'Galaxy process died while starting:'; tail -n 20 %(log)s; exit 2; fi; "
+              "if [ $SECONDS -ge $deadline ]; then echo 'Galaxy did not start within %(timeout)ss:'; tail -n 20 %(log)s; exit 3; fi; "
+              "sleep $delay; delay=$((delay * 2 > %(max_delay)s ? %(max_delay)s : delay * 2)); "
+              "done" % {'timeout': timeout, 'url': GALAXY_URL, 'pid': pid_file, 'log': log_file, 'max_delay': max_delay})
+    print("Waiting for Galaxy to start...")
+    with settings(hide('stdout'), warn_only=True):
+        result = run(script)
+    if result.succeeded:
+        print(yellow(result))
+        return True
+    print(red(result))
+    return False
+
+def _fetch_galaxy_eggs():
+    """Download the eggs Galaxy needs without starting it; older Galaxy versions
+    without scripts/fetch_eggs.py are started and stopped instead."""
+    if exists(os.path.join(GALAXY_HOME, "scripts/fetch_eggs.py")):
+        print(yellow("Fetching Galaxy eggs"))
+        config = "universe_wsgi.ini" if exists(os.path.join(GALAXY_HOME, "universe_wsgi.ini")) else "universe_wsgi.ini.sample"
+        sudo('su galaxy -c "cd %s; python scripts/fetch_eggs.py -c %s"' % (GALAXY_HOME, config))
+    else:
+        print(yellow("Fetching Galaxy eggs via full start-stop"))
+        started = _start_galaxy()
+        _stop_galaxy()
+        if not started:
+            abort("Galaxy did not start, so its eggs may not all have been fetched; see %s/paster.log" % GALAXY_HOME)
+
+def _update_snaps_latest_file(filesystem, snap_id, vol_size, region=DEFAULT_REGION, **kwargs):
+    return _update_snaps_latest_files(filesystem, {region: snap_id}, vol_size, **kwargs)
+
+def _get_s3_conn():
+    s3_url = os.environ.get('CM_S3_URL')
+    if s3_url:
+        url = urlparse(s3_url)
+        return S3Connection(host=url.hostname, port=url.port, is_secure=(url.scheme == 'https'),
+                            calling_format=OrdinaryCallingFormat())
+    return S3Connection()
 
 def _get_bucket(bucket_name):
-    s3_conn = S3Connection()
+    s3_conn = _get_s3_conn()
     b = None
     for i in range(0, 5):
         try:
@@ -235,63 +370,6 @@ def _get_bucket(bucket_name):
             return None
     return b
 
-def _get_date_file_last_modified_on_S3(bucket_name, file_name):
-    """Return date file_name was last modified in format YYYY-MM-DD"""
-    b = _get_bucket(bucket_name)
-    if b is not None:
-        try:
-            k = b.get_key(file_name)
-            lm = k.last_modified
-            mlf = time.strptime(lm, "%a, %d %b %Y %H:%M:%S GMT")
-            return time.strftime("%Y-%m-%d", mlf)
-        except S3ResponseError, e:
-            print "Failed to get file '%s' from bucket '%s': %s" % (file_name, bucket_name, e)
-            return ""
-        except ValueError, e:
-            print "Failed to format file '%s' last modified: %s" % (file_name, e)
-            return ""
-
-def _rename_file_in_S3(new_key_name, bucket_name, old_key_name):
-    b = _get_bucket(bucket_name)
-    if b is not None:
-        try:
-            k = b.get_key(old_key_name) # copy any metadata too
-            b.copy_key(new_key_name, bucket_name, old_key_name, metadata=k.metadata, preserve_acl=True)
-            print "Successfully renamed file '%s' in bucket '%s' to '%s'." % (old_key_name, bucket_name, new_key_name)
-            return True
-        except S3ResponseError, e:
-             print "Failed to rename file '%s' in bucket '%s' as file '%s': %s" % (old_key_name, bucket_name, new_key_name, e)
-             return False
-
-def _save_file_to_bucket(bucket_name, remote_filename, local_file, **kwargs):
-    """ Save the local_file to bucket_name as remote_filename. Also, any additional
-    arguments passed as key-value pairs, are stored as file's metadata on S3."""
-    # print "Establishing handle with bucket '%s'..." % bucket_name
-    b = _get_bucket(bucket_name)
-    if b is not None:
-        # print "Establishing handle with key object '%s'..." % remote_filename
-        k = Key( b, remote_filename )
-        print "Attempting to save file '%s' to bucket '%s'..." % (remote_filename, bucket_name)
-        try:
-            # Store some metadata (key-value pairs) about the contents of the file being uploaded
-            # Note that the metadata must be set *before* writing the file
-            k.set_metadata('date_uploaded', str(dt.datetime.utcnow()))
-            for args_key in kwargs:
-                print "Adding metadata to file '%s': %s=%s" % (remote_filename, args_key, kwargs[args_key])
-                k.set_metadata(args_key, kwargs[args_key])
-            print "Saving file '%s'" % local_file
-            k.set_contents_from_filename(local_file)
-            print "Successfully added file '%s' to bucket '%s'." % (remote_filename, bucket_name)
-            answer = confirm("Would you like to make file '%s' publicly readable?" % remote_filename)
-            if answer:
-                k.make_public()
-        except S3ResponseError, e:
-            print "Failed to save file local file '%s' to bucket '%s' as file '%s': %s" % ( local_file, bucket_name, remote_filename, e )
-            return False
-        return True
-    else:
-        return False
-
 def _attach( ec2_conn, instance_id, volume_id, device ):
     """
     Attach EBS volume to the given device (using boto).
@@ -340,6 +418,16 @@ def _detach( ec2_conn, instance_id, volume_id ):
         volumes = ec2_conn.get_all_volumes( [volume_id] )
         volumestatus = volumes[0].status
 
+def _hydrate_volume(fs_path, device_id):
+    """Start reading a volume created from a snapshot in the background so its
+    blocks are fetched before they are needed, hot index files first (see
+    hydrate_volume.py)"""
+    remote_script = '/tmp/hydrate_volume.py'
+    put(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hydrate_volume.py'), remote_script)
+    log_file = '/tmp/hydrate_volume_%s.log' % os.path.basename(fs_path.rstrip('/'))
+    sudo("nohup python %s %s %s > %s 2>&1 &" % (remote_script, fs_path, device_id, log_file), pty=False)
+    print(yellow("Prewarming volume mounted at '%s' in the background; progress is logged to '%s'" % (fs_path, log_file)))
+
 def _create_snapshot(ec2_conn, volume_id, description=None):
     """
     Create a snapshot of the EBS volume with the provided volume_id. 
@@ -348,17 +436,57 @@ def _create_snapshot(ec2_conn, volume_id, description=None):
     s_time = dt.datetime.now()
     print(yellow("Initiating snapshot of EBS volume '%s' in region '%s' (start time %s)" % (volume_id, ec2_conn.region.name, s_time)))
     snapshot = ec2_conn.create_snapshot(volume_id, description=description)
+    return _wait_for_snapshot(ec2_conn, snapshot, volume_id)
+
+def _wait_for_snapshot(ec2_conn, snapshot, volume_id):
     if snapshot: 
-        while snapshot.status != 'completed':
-            print "Snapshot '%s' progress: '%s'; status: '%s'; duration: %s" % (snapshot.id, snapshot.progress, snapshot.status, str(dt.datetime.now()-s_time).split('.')[0])
-            time.sleep(6)
-            snapshot.update()
+        if _wait_for_snapshots({ec2_conn.region.name: (ec2_conn, snapshot.id)})[ec2_conn.region.name] != 'completed':
+            print(red("Creation of snapshot '%s' for volume '%s' failed" % (snapshot.id, volume_id)))
+            return False
         print "Creation of snapshot for volume '%s' completed: '%s'" % (volume_id, snapshot)
         return snapshot.id
     else:
         print "Could not create snapshot from volume with ID '%s'" % volume_id
         return False
 
+def _freeze_command(fs_path):
+    """Command that can freeze the file system at fs_path on the instance, or None"""
+    with settings(hide('everything'), warn_only=True):
+        if fs_path.rstrip('/') == '' or run("mountpoint -q %s" % fs_path).failed:
+            return None # Freezing / would hang the very shell running the commands
+        if run("which fsfreeze").succeeded:
+            return 'fsfreeze'
+        if run("which xfs_freeze").succeeded and run("findmnt -n -o FSTYPE --target %s" % fs_path).strip() == 'xfs':
+            return 'xfs_freeze'
+    return None
+
+def _start_online_snapshot(ec2_conn, volume_id, fs_path, description=None, poll=1):
+    """
+    Start a snapshot of the EBS volume with the provided volume_id while the file
+    system at fs_path stays mounted. Writes to the file system are frozen only until
+    EC2 reports the snapshot as 'pending', at which point its point-in-time state has
+    been captured. Returns the snapshot, which may still be in progress, or None.
+    """
+    freeze = _freeze_command(fs_path)
+    print(yellow("Initiating online snapshot of EBS volume '%s' mounted at '%s' in region '%s'" % (volume_id, fs_path, ec2_conn.region.name)))
+    sudo("sync") # Flush outside of the freeze so it stays short
+    # Should the connection drop before the file system is thawed below, thaw it
+    # from the instance itself instead of leaving it frozen
+    sudo("nohup sh -c 'sleep %s; %s -u %s' > /dev/null 2>&1 &" % (FREEZE_TIMEOUT, freeze, fs_path), pty=False)
+    snapshot = None
+    frozen = dt.datetime.now()
+    sudo("%s -f %s" % (freeze, fs_path))
+    try:
+        snapshot = ec2_conn.create_snapshot(volume_id, description=description)
+        while snapshot.status not in ('pending', 'completed', 'error'):
+            time.sleep(poll)
+            snapshot.update()
+    finally:
+        with settings(warn_only=True):
+            sudo("%s -u %s" % (freeze, fs_path))
+        print(yellow("File system '%s' was frozen for %s" % (fs_path, dt.datetime.now()-frozen)))
+    return snapshot
+
 def _delete_volume(ec2_conn, vol_id):
     try:
         ec2_conn.delete_volume(vol_id)
@@ -366,7 +494,12 @@ def _delete_volume(ec2_conn, vol_id):
     except EC2ResponseError, e:
         print "ERROR deleting volume '%s': %s" % (vol_id, e)
 
-def _get_ec2_conn(instance_region='us-east-1'):
+def _get_ec2_conn(instance_region=DEFAULT_REGION):
+    ec2_url = os.environ.get('CM_EC2_URL')
+    if ec2_url: # A single endpoint standing in for every region
+        url = urlparse(ec2_url)
+        return EC2Connection(region=RegionInfo(name=instance_region, endpoint=url.hostname),
+                             port=url.port, is_secure=(url.scheme == 'https'))
     regions = boto.ec2.regions()
     print "Found regions: %s; trying to match to instance region: %s" % (regions, instance_region)
     region = None